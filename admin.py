@@ -1,10 +1,12 @@
 from django.contrib import admin
 from django.contrib.admin.models import LogEntry
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.localflavor.us.forms import *
 from django import forms
 from roster.models import *
 from roster.fields import *
 from roster.filters import *
+from roster.search import search_people
 
 def schools_as_choices():
     schools = [('', "---------")]
@@ -154,10 +156,28 @@ class PersonAdminForm(forms.ModelForm):
         self.fields['comments'].widget = \
                 forms.widgets.Textarea(attrs={'rows':2, 'cols':60})
 
+class PersonChangeList(ChangeList):
+    """Searches people with the name index rather than LIKE queries,
+    unless too many match to list their ids in a query."""
+    max_matches = 500
+
+    def get_query_set(self, request):
+        matches = None
+        if self.query:
+            matches = search_people(self.query, self.max_matches + 1)
+        if matches is None or len(matches) > self.max_matches:
+            return super(PersonChangeList, self).get_query_set(request)
+        query, self.query = self.query, ''
+        try:
+            qs = super(PersonChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        return qs.filter(id__in=[id for id, name in matches])
+
 class PersonAdmin(admin.ModelAdmin):
     form = PersonAdminForm
     list_display = ['__unicode__', 'lastname', 'get_firstname', 'active_roles']
-    list_filter = ['teams', RoleListFilter, StatusListFilter, 'gender', 'school']
+    list_filter = ['teams', RoleListFilter, StatusListFilter, 'gender', 'school', 'student']
     search_fields = ['^firstname', '^lastname', '^nickname']
     inlines = [PersonTeamInline,
                PersonEmailInline,
@@ -177,6 +197,14 @@ class PersonAdmin(admin.ModelAdmin):
         ('Misc information', {'fields': ['prospective_source', 'comments']}),
     ]
 
+    def get_changelist(self, request, **kwargs):
+        return PersonChangeList
+
+    def queryset(self, request):
+        # select the active roles column for the whole page at once
+        qs = super(PersonAdmin, self).queryset(request)
+        return qs.batch_select(active_personteams=ACTIVE_ROLES)
+
 class RelationshipTypeAdmin(admin.ModelAdmin):
     list_display = ['type', 'parent', 'sort_order']
 
@@ -0,0 +1,115 @@
+# Who a team report is for
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from roster.models import Person, PersonTeam, Relationship, RelationshipType
+from roster.relationships import get_graph
+from roster.versioned import SharedVersion
+
+import hashlib
+
+_version = SharedVersion('roster:audience:version')
+
+def invalidate():
+    """Forget every resolved audience, e.g. after changing memberships
+    or relationships without sending signals (bulk_create, update)."""
+    _version.bump()
+
+@receiver(post_save, sender=PersonTeam)
+@receiver(post_delete, sender=PersonTeam)
+@receiver(post_save, sender=Relationship)
+@receiver(post_delete, sender=Relationship)
+@receiver(post_save, sender=RelationshipType)
+@receiver(post_delete, sender=RelationshipType)
+def _changed(sender, **kwargs):
+    invalidate()
+
+class Audience(object):
+    """The people with one of roles and one of status on one of teams,
+    plus (if parents) the parents of the students among them and (if
+    cc_on_email) the people they cc on emails.
+
+    All of them are found with one query, and the ids found are cached
+    (by the criteria) for ROSTER_AUDIENCE_CACHE_TIMEOUT seconds (default
+    300), or until a membership or relationship changes."""
+
+    # above this many people, people() selects with subqueries rather
+    # than a list of ids, which some databases limit the length of
+    max_ids = 500
+
+    def __init__(self, roles, status, teams, parents=False,
+                 cc_on_email=False):
+        self.roles = sorted(set(roles))
+        self.status = sorted(set(status))
+        self.teams = sorted(set(int(x) for x in teams))
+        self.parents = parents
+        self.cc_on_email = cc_on_email
+
+    def _key(self, what):
+        criteria = repr((self.roles, self.status, self.teams, self.parents,
+                         self.cc_on_email))
+        return 'roster:audience:%s:%s:%s' % (_version.get(), what,
+                                              hashlib.md5(criteria).hexdigest())
+
+    def _cached(self, what, get):
+        key = self._key(what)
+        value = cache.get(key)
+        if value is None:
+            value = get()
+            cache.set(key, value,
+                      getattr(settings, 'ROSTER_AUDIENCE_CACHE_TIMEOUT', 300))
+        return value
+
+    def memberships(self, roles=None):
+        """The team memberships matching the criteria (or with one of
+        roles rather than the audience's roles)."""
+        if roles is None:
+            roles = self.roles
+        return PersonTeam.objects.filter(role__in=roles,
+                                         status__in=self.status,
+                                         team__in=self.teams)
+
+    def _parent_relationships(self):
+        return Relationship.objects.filter(
+                person_from__in=self.memberships(['Student']).values('person'),
+                relationship__parent=True)
+
+    def q(self):
+        """A Q selecting the audience from Person, as subqueries ORed
+        together (so no joins, and no duplicates to remove)."""
+        q = Q(id__in=self.memberships().values('person'))
+        if self.parents:
+            q |= Q(id__in=self._parent_relationships().values('person_to'))
+        if self.cc_on_email:
+            q |= Q(id__in=Relationship.objects.filter(
+                    person_from__in=self.memberships().values('person'),
+                    cc_on_email=True).values('person_to'))
+        return q
+
+    def person_ids(self):
+        return self._cached('ids', lambda:
+                list(Person.objects.filter(self.q()).order_by()
+                                   .values_list('id', flat=True)))
+
+    def people(self, queryset=None):
+        """The audience as a Person queryset (or filtered from queryset,
+        e.g. one with batches selected)."""
+        if queryset is None:
+            queryset = Person.objects.all()
+        ids = self.person_ids()
+        if len(ids) > self.max_ids:
+            return queryset.filter(self.q())
+        return queryset.filter(id__in=ids)
+
+    def parent_links(self):
+        """A dict of the parents in the audience to the student they're
+        in it for (empty unless parents)."""
+        if not self.parents:
+            return {}
+        students = lambda: self.memberships(['Student'])\
+                .values_list('person', flat=True)
+        return self._cached('parents', lambda:
+                get_graph().links(students(), 'parent'))
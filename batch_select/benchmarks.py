@@ -0,0 +1,88 @@
+'''
+Benchmark dataset for the models batch_select is tested with (only there
+when the TESTING_BATCH_SELECT setting is on), see batch_select.harness
+'''
+
+from django.conf import settings
+
+from batch_select.harness import Dataset, bulk_create
+
+datasets = []
+
+if getattr(settings, 'TESTING_BATCH_SELECT', False):
+    from batch_select.models import Batch, Entry, Section, Tag
+
+    class EntryDataset(Dataset):
+        '''
+        entries with tags_per_entry tags each (out of tags tags), spread
+        over sections sections
+        '''
+        name = 'entries'
+        models = (Section, Tag, Entry)
+
+        def __init__(self, tags=100, tags_per_entry=5, sections=20):
+            self.tags = tags
+            self.tags_per_entry = tags_per_entry
+            self.sections = sections
+
+        def build(self, parents):
+            section_ids = bulk_create(Section,
+                    [Section(name='section%d' % i) for i in xrange(self.sections)])
+            tag_ids = bulk_create(Tag,
+                    [Tag(name='tag%d' % i) for i in xrange(self.tags)])
+            entry_ids = bulk_create(Entry,
+                    [Entry(title='entry%d' % i,
+                           section_id=section_ids[i % len(section_ids)])
+                     for i in xrange(parents)])
+            through = Entry.tags.through
+            bulk_create(through,
+                    [through(entry_id=entry_id,
+                             tag_id=tag_ids[(i + j) % len(tag_ids)])
+                     for i, entry_id in enumerate(entry_ids)
+                     for j in xrange(self.tags_per_entry)])
+
+        def scenarios(self):
+            def naive():
+                for entry in Entry.objects.all():
+                    list(entry.tags.all())
+
+            def batch_select():
+                for entry in Entry.objects.batch_select('tags'):
+                    entry.tags_all
+
+            def batch_select_chunked():
+                for entry in Entry.objects.batch_select(Batch('tags').chunked(1000)):
+                    entry.tags_all
+
+            def batch_select_windowed():
+                for entry in Entry.objects.batch_select('tags').iterator(window=1000):
+                    entry.tags_all
+
+            def batch_select_subquery():
+                for entry in Entry.objects.batch_select('tags').batch_subquery():
+                    entry.tags_all
+
+            def batch_select_ids():
+                for entry in Entry.objects.batch_select(Batch('tags').ids()):
+                    entry.tags_all
+
+            def batch_select_reverse_foreign_key():
+                for section in Section.objects.batch_select('entry_set'):
+                    section.entry_set_all
+
+            def prefetch_related():
+                for entry in Entry.objects.prefetch_related('tags'):
+                    list(entry.tags.all())
+
+            return [
+                ('n+1', naive),
+                ('batch_select', batch_select),
+                ('batch_select_chunked', batch_select_chunked),
+                ('batch_select_windowed', batch_select_windowed),
+                ('batch_select_subquery', batch_select_subquery),
+                ('batch_select_ids', batch_select_ids),
+                ('batch_select_reverse_foreign_key', batch_select_reverse_foreign_key),
+                ('prefetch_related', prefetch_related),
+            ]
+
+    datasets.append(EntryDataset())
@@ -0,0 +1,253 @@
+'''
+Keeps what batch_select attaches to each instance in the django cache,
+so a batch that's already been selected for an instance (say the phones
+of a person) isn't queried again until the related objects change.
+
+There's one cache entry per relationship and instance, holding what was
+attached for each variant of the batch (its filters, values etc.). Its
+key includes a version, kept in the cache too, which is changed whenever
+the related model or the through model of the relationship is saved or
+deleted, or the relationship's many-to-many set is changed - so what's
+selected while that happens is cached under the old version, and never
+read. Changes that don't send signals (e.g. QuerySet.update) aren't
+seen, and neither are changes to other models a batch's filters look at.
+
+Relationships are watched for changes from the first time a batch on
+them is selected from the cache in a process. To make sure every
+process invalidates them, including ones that never select the batch,
+declare them when the models are defined, with watch or a BatchManager's
+cached_batches.
+
+Which cache is used is set by the BATCH_SELECT_CACHE setting (defaults
+to 'default'), and how long entries are kept by the timeout given to
+Batch.cache or the BATCH_SELECT_CACHE_TIMEOUT setting (defaults to the
+cache's own timeout). Eviction beyond that is up to the cache backend.
+'''
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import signals
+from django.utils.encoding import smart_str
+
+import hashlib
+import threading
+import uuid
+
+def _get_cache():
+    return get_cache(getattr(settings, 'BATCH_SELECT_CACHE', 'default'))
+
+def _cache_key(model, fieldname, pk):
+    # hash the pk, as it may have characters (e.g. spaces) some cache
+    # backends don't allow in keys
+    return 'batch_select:%s.%s.%s:%s' % (model._meta.app_label,
+                                         model._meta.object_name,
+                                         fieldname,
+                                         hashlib.md5(smart_str(pk)).hexdigest())
+
+def _version_key(key):
+    return '%s:version' % key
+
+def _new_version():
+    # random rather than counting up, so a version that's been evicted
+    # never comes back
+    return uuid.uuid4().hex
+
+class _Watcher(object):
+    '''
+    deletes the cache entries for the instances on the parent end of a
+    relationship when objects on the other end of it change
+    '''
+    def __init__(self, model, relation):
+        self.model = model
+        self.relation = relation
+        self.uid = 'batch_select:%s.%s.%s' % (model._meta.app_label,
+                                              model._meta.object_name,
+                                              relation.fieldname)
+
+    def connect(self):
+        relation = self.relation
+        # senders and how to find the parents of one of their instances,
+        # as (model to query, field to query it by, field holding the
+        # parent's id, whether the instance has that field itself)
+        self.senders = {}
+        if relation.through is None:
+            self.senders[relation.related_model] = \
+                (relation.related_model, 'pk', relation.parent_attname, True)
+        else:
+            self.senders[relation.through] = \
+                (relation.through, 'pk', relation.parent_attname, True)
+            self.senders[relation.related_model] = \
+                (relation.through, relation.child_attname,
+                 relation.parent_attname, False)
+            _m2m_watchers.setdefault(relation.through, []).append(self)
+        for sender in self.senders:
+            _sender_watchers.setdefault(sender, []).append(self)
+
+    def invalidate(self, pks):
+        pks = set(pks)
+        pks.discard(None)
+        if pks:
+            versions = dict((_version_key(_cache_key(self.model, self.relation.fieldname, pk)),
+                             _new_version()) for pk in pks)
+            _get_cache().set_many(versions,
+                                  getattr(settings, 'BATCH_SELECT_CACHE_TIMEOUT', None))
+
+    def _stored_parents(self, query_model, lookup, parent_attname, pk):
+        if pk is None:
+            return []
+        return list(query_model._default_manager.filter(**{ lookup: pk })
+                                                .values_list(parent_attname, flat=True))
+
+    def _stash(self, instance):
+        stashed = instance.__dict__.setdefault('_batch_select_parents', {})
+        return stashed.setdefault(self.uid, set())
+
+    def before_change(self, sender, instance, **kwargs):
+        # the parents the instance belongs to before the change, as it
+        # might be moving to another parent or about to lose its links
+        query_model, lookup, parent_attname, _ = self.senders[sender]
+        self._stash(instance).update(
+            self._stored_parents(query_model, lookup, parent_attname, instance.pk))
+
+    def after_change(self, sender, instance, **kwargs):
+        _, _, parent_attname, on_instance = self.senders[sender]
+        parents = self._stash(instance)
+        if on_instance:
+            parents.add(getattr(instance, parent_attname))
+        self.invalidate(parents)
+        parents.clear()
+
+    def m2m_changed(self, sender, instance, action, model, pk_set, **kwargs):
+        # instance can be on either end of the relationship, depending
+        # on which side the change was made from
+        relation = self.relation
+        parents = set()
+        if isinstance(instance, self.model):
+            parents.add(instance.pk)
+        if issubclass(model, self.model):
+            if pk_set is not None:
+                parents.update(pk_set)
+            elif action == 'pre_clear':
+                parents.update(self._stored_parents(relation.through,
+                                                    relation.child_attname,
+                                                    relation.parent_attname,
+                                                    instance.pk))
+        if action.startswith('post_') or action == 'pre_clear':
+            self.invalidate(parents)
+
+# the watchers by relationship, and by the models whose signals they
+# watch for (through models' m2m_changed signals separately)
+_watchers = {}
+_sender_watchers = {}
+_m2m_watchers = {}
+
+# relationships declared with watch, still to be looked up
+_declared = []
+_lock = threading.RLock()
+
+def _watch(model, relation):
+    with _lock:
+        key = (model, relation.fieldname)
+        if key not in _watchers:
+            watcher = _watchers[key] = _Watcher(model, relation)
+            watcher.connect()
+
+def watch(model, fieldname):
+    '''
+    invalidate the cache entries of model's fieldname relationship
+    whenever the objects on the other end of it change, from now on in
+    this process. The relationship is looked up the first time any model
+    is saved or deleted, so this can be called while the models are
+    still being defined
+    '''
+    with _lock:
+        _declared.append((model, fieldname))
+
+def _watching(watchers, sender):
+    if _declared:
+        from batch_select.models import _Relation, _check_field_exists
+        with _lock:
+            while _declared:
+                model, fieldname = _declared.pop()
+                _watch(model, _Relation(model, _check_field_exists(model, fieldname)))
+    return list(watchers.get(sender, ()))
+
+# connected once, for every model, so watch doesn't have to wait for the
+# models to be loaded
+def _before_change(sender, instance, **kwargs):
+    for watcher in _watching(_sender_watchers, sender):
+        watcher.before_change(sender, instance, **kwargs)
+
+def _after_change(sender, instance, **kwargs):
+    for watcher in _watching(_sender_watchers, sender):
+        watcher.after_change(sender, instance, **kwargs)
+
+def _m2m_changed(sender, **kwargs):
+    for watcher in _watching(_m2m_watchers, sender):
+        watcher.m2m_changed(sender, **kwargs)
+
+for signal in (signals.pre_save, signals.pre_delete):
+    signal.connect(_before_change, dispatch_uid='batch_select.cache')
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(_after_change, dispatch_uid='batch_select.cache')
+signals.m2m_changed.connect(_m2m_changed, dispatch_uid='batch_select.cache')
+
+class BatchCache(object):
+    '''
+    the cache entries for the instances of model a batch on relation
+    would be selected into, with variant telling apart batches on the
+    same relation that would select different things
+    '''
+    def __init__(self, model, relation, variant, timeout=None):
+        self.model = model
+        self.fieldname = relation.fieldname
+        self.variant = variant
+        if timeout is None:
+            timeout = getattr(settings, 'BATCH_SELECT_CACHE_TIMEOUT', None)
+        self.timeout = timeout
+        self.entries = {}
+        self.versioned = {}
+        _watch(model, relation)
+
+    def _key(self, pk):
+        return _cache_key(self.model, self.fieldname, pk)
+
+    def get_many(self, pks):
+        '''
+        returns a dict of the pks found in the cache to what was cached
+        for them
+        '''
+        cache = _get_cache()
+        keys = dict((self._key(pk), pk) for pk in pks)
+        versions = cache.get_many([_version_key(key) for key in keys])
+        missing = dict((_version_key(key), _new_version()) for key in keys
+                       if _version_key(key) not in versions)
+        if missing:
+            cache.set_many(missing, self.timeout)
+            versions.update(missing)
+        # the entry keys as of now, which set_many keeps to, so if an
+        # invalidation changes the versions while the batch is selected
+        # what was selected isn't read back
+        self.versioned = dict((key, '%s:%s' % (key, versions[_version_key(key)]))
+                              for key in keys)
+        self.entries = cache.get_many(self.versioned.values())
+        found = {}
+        for key, pk in keys.items():
+            entry = self.entries.get(self.versioned[key])
+            if entry is not None and self.variant in entry:
+                found[pk] = entry[self.variant]
+        return found
+
+    def set_many(self, values):
+        '''
+        cache the values (a dict of pks to what to cache for them, all
+        of which get_many was called with), keeping whatever is cached for
+        other variants
+        '''
+        data = {}
+        for pk, value in values.items():
+            key = self.versioned[self._key(pk)]
+            entry = data[key] = dict(self.entries.get(key, {}))
+            entry[self.variant] = value
+        if data:
+            _get_cache().set_many(data, self.timeout)
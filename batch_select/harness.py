@@ -0,0 +1,231 @@
+'''
+Benchmarks for batch_select against other ways of getting at related
+objects, e.g. following the relationship for each instance (n+1 queries)
+or Django's prefetch_related.
+
+A dataset builds a number of parent instances with related instances,
+and has scenarios that each read all the parents and their related
+instances in one way. Each scenario is run in its own forked process (so
+the peak memory of one doesn't hide that of another), and measured for:
+
+    wall_time  - seconds taken
+    queries    - number of queries run
+    rows       - number of rows fetched from the database
+    peak_rss   - peak resident memory of the process, in kilobytes
+    rss_growth - how much the peak grew while the scenario ran
+
+Datasets are found in the benchmarks module of each installed app, which
+should have a datasets list of Dataset instances. run_benchmarks writes
+its results as JSON, see the batch_select_benchmark management command.
+'''
+
+from django.conf import settings
+from django.db import connection, connections, transaction, DEFAULT_DB_ALIAS
+from django.utils.importlib import import_module
+
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # not on windows
+    resource = None
+
+def bulk_create(model, instances, size=100):
+    '''
+    bulk_create in slices, so no one insert has too many parameters
+    for the database, and give back the pks of the new rows (in order,
+    so it assumes the table was empty and its pks increase)
+    '''
+    for i in xrange(0, len(instances), size):
+        model._default_manager.bulk_create(instances[i:i+size])
+    return list(model._default_manager.order_by('pk').values_list('pk', flat=True))
+
+class Dataset(object):
+    '''
+    a set of parent instances with related instances, of a given size.
+    Subclasses should give a name, the models to clear out between
+    sizes, and define build and scenarios
+    '''
+    name = None
+    models = ()
+
+    def clear(self):
+        for model in reversed(self.models):
+            model._default_manager.all().delete()
+
+    def build(self, parents):
+        '''
+        create parents parent instances, and their related instances
+        '''
+        raise NotImplementedError
+
+    def scenarios(self):
+        '''
+        a list of (name, function) pairs. Each function should read the
+        parent instances and all of their related instances
+        '''
+        raise NotImplementedError
+
+    # scenarios that do a query per parent, so are skipped above
+    # run_benchmarks' naive_limit
+    naive_scenarios = ('n+1',)
+
+class _RowCountingCursor(object):
+    # wraps a database cursor, counting the rows fetched through it
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter[0] += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.counter[0] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.counter[0] += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.counter[0] += 1
+            yield row
+
+def _max_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _measure(scenario):
+    # django.db.connection is a proxy that can't have attributes deleted,
+    # so patch the connection itself, with an instance attribute that
+    # hides its cursor method until it's deleted again
+    wrapper = connections[DEFAULT_DB_ALIAS]
+    counter = [0]
+    cursor = wrapper.cursor
+    use_debug_cursor = wrapper.use_debug_cursor
+    wrapper.cursor = lambda: _RowCountingCursor(cursor(), counter)
+    wrapper.use_debug_cursor = True
+    wrapper.queries = []
+    try:
+        rss_before = _max_rss()
+        start = time.time()
+        scenario()
+        wall_time = time.time() - start
+        rss_after = _max_rss()
+    finally:
+        del wrapper.cursor
+        wrapper.use_debug_cursor = use_debug_cursor
+
+    result = {
+        'wall_time': wall_time,
+        'queries': len(wrapper.queries),
+        'rows': counter[0],
+        'peak_rss': rss_after,
+        'rss_growth': None,
+    }
+    if rss_after is not None:
+        result['rss_growth'] = rss_after - rss_before
+    return result
+
+def _run_forked(scenario):
+    # the child uses the database connection it inherits while the
+    # parent waits, and leaves without closing it (os._exit), so it's
+    # still good for the parent afterwards
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                result = _measure(scenario)
+            except Exception, e:
+                result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+                status = 1
+            with os.fdopen(write_fd, 'w') as output:
+                json.dump(result, output)
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as input:
+        data = input.read()
+    os.waitpid(pid, 0)
+    if not data:
+        return {'error': 'the scenario\'s process died'}
+    return json.loads(data)
+
+def run_scenario(scenario, fork=None):
+    '''
+    measure a scenario, in a forked process if possible (or fork is True)
+    '''
+    if fork is None:
+        fork = hasattr(os, 'fork')
+    if fork:
+        return _run_forked(scenario)
+    return _measure(scenario)
+
+def find_datasets():
+    '''
+    the datasets of all the installed apps, by name
+    '''
+    datasets = {}
+    for app in settings.INSTALLED_APPS:
+        try:
+            module = import_module('%s.benchmarks' % app)
+        except ImportError:
+            continue
+        for dataset in getattr(module, 'datasets', []):
+            datasets[dataset.name] = dataset
+    return datasets
+
+def run_benchmarks(datasets, sizes=(1000, 10000, 100000), naive_limit=10000,
+                   fork=None, log=None):
+    '''
+    build each dataset at each size and run all its scenarios on it,
+    returning the results as a dict ready to be written out as JSON
+    (naive scenarios are skipped for sizes above naive_limit)
+    '''
+    results = []
+    for dataset in datasets:
+        for size in sizes:
+            dataset.clear()
+            dataset.build(size)
+            transaction.commit_unless_managed()
+            for name, scenario in dataset.scenarios():
+                result = {'dataset': dataset.name, 'parents': size,
+                          'scenario': name}
+                if name in dataset.naive_scenarios and \
+                        naive_limit is not None and size > naive_limit:
+                    result['skipped'] = True
+                else:
+                    result.update(run_scenario(scenario, fork))
+                if log:
+                    log(result)
+                results.append(result)
+            dataset.clear()
+
+    import django
+    return {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'results': results,
+    }
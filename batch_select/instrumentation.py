@@ -0,0 +1,101 @@
+'''
+Ready-made receivers for the batch_selected signal:
+
+log_batch logs every batch to the 'batch_select' logger, connect it with
+
+    from batch_select.signals import batch_selected
+    from batch_select.instrumentation import log_batch
+    batch_selected.connect(log_batch)
+
+BatchSelectSummaryMiddleware collects the batches selected while
+handling each request, and logs a summary of them (with the slowest
+batches first) to the 'batch_select' logger at the end of the request.
+With DEBUG on, the summary also goes in an X-Batch-Select response
+header. Add 'batch_select.instrumentation.BatchSelectSummaryMiddleware'
+to MIDDLEWARE_CLASSES to use it.
+'''
+
+from django.conf import settings
+
+from batch_select.signals import batch_selected
+
+import logging
+import threading
+
+logger = logging.getLogger('batch_select')
+
+def _describe(model, relation, parents, rows, query_time, group_time, **kwargs):
+    return '%s.%s: %d parents, %d rows, %.1fms query, %.1fms grouping' % \
+            (model.__name__, relation, parents, rows,
+             query_time * 1000, group_time * 1000)
+
+def log_batch(sender, **kwargs):
+    logger.debug(_describe(sender, **kwargs),
+                 extra={'batch': dict(kwargs, model=sender)})
+
+class RequestSummary(object):
+    '''
+    the batches selected while handling one request
+    '''
+    def __init__(self):
+        self.batches = []
+
+    def add(self, model, **kwargs):
+        self.batches.append(dict(kwargs, model=model))
+
+    def totals(self):
+        return {
+            'batches': len(self.batches),
+            'queries': sum(batch['queries'] for batch in self.batches),
+            'rows': sum(batch['rows'] for batch in self.batches),
+            'query_time': sum(batch['query_time'] for batch in self.batches),
+            'group_time': sum(batch['group_time'] for batch in self.batches),
+        }
+
+    def slowest(self, count=3):
+        return sorted(self.batches, reverse=True,
+                      key=lambda batch: batch['query_time'] + batch['group_time'])[:count]
+
+    def __unicode__(self):
+        totals = self.totals()
+        summary = '%d batches, %d queries, %d rows, %.1fms query, %.1fms grouping' % \
+                (totals['batches'], totals['queries'], totals['rows'],
+                 totals['query_time'] * 1000, totals['group_time'] * 1000)
+        slowest = '; '.join(_describe(**batch) for batch in self.slowest())
+        if slowest:
+            summary = '%s (slowest: %s)' % (summary, slowest)
+        return summary
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+_current = threading.local()
+
+def current_summary():
+    '''
+    the summary for the request being handled in this thread, or None
+    '''
+    return getattr(_current, 'summary', None)
+
+def _collect(sender, **kwargs):
+    summary = current_summary()
+    if summary is not None:
+        kwargs.pop('signal', None)
+        summary.add(sender, **kwargs)
+
+batch_selected.connect(_collect, dispatch_uid='batch_select.instrumentation')
+
+class BatchSelectSummaryMiddleware(object):
+
+    def process_request(self, request):
+        _current.summary = RequestSummary()
+
+    def process_response(self, request, response):
+        summary = current_summary()
+        _current.summary = None
+        if summary is not None and summary.batches:
+            logger.info('%s %s: %s' % (request.method, request.path, summary),
+                        extra={'batch_summary': summary.totals()})
+            if settings.DEBUG:
+                response['X-Batch-Select'] = str(summary)
+        return response
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.simple import DjangoTestSuiteRunner
+
+from optparse import make_option
+import json
+
+from batch_select.harness import find_datasets, run_benchmarks
+
+class Command(BaseCommand):
+    help = ('Benchmarks batch_select against n+1 queries and prefetch_related '
+            'on synthetic datasets, in a test database, and writes the '
+            'results out as JSON.')
+    args = '[--dataset name ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dataset', action='append', dest='datasets', default=[],
+            help='Dataset to run (can be given more than once, defaults to all).'),
+        make_option('--sizes', dest='sizes', default='1000,10000,100000',
+            help='Comma separated numbers of parent objects to run with.'),
+        make_option('--naive-limit', dest='naive_limit', type='int', default=10000,
+            help='Skip the n+1 query scenarios above this many parents.'),
+        make_option('--output', dest='output', default='batch_select_benchmark.json',
+            help='File to write the results to.'),
+        make_option('--no-fork', action='store_false', dest='fork', default=None,
+            help='Run the scenarios in this process, rather than forking one for each.'),
+    )
+
+    def handle(self, *args, **options):
+        available = find_datasets()
+        names = options['datasets'] or sorted(available)
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise CommandError('Unknown dataset(s) %s, choose from %s' %
+                               (', '.join(unknown), ', '.join(sorted(available))))
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes should be numbers separated by commas')
+
+        verbosity = int(options.get('verbosity', 1))
+        def log(result):
+            if verbosity:
+                self.stdout.write('%s\n' % json.dumps(result, sort_keys=True))
+
+        # never run against the real database
+        runner = DjangoTestSuiteRunner(verbosity=verbosity, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            report = run_benchmarks([available[name] for name in names],
+                                    sizes=sizes,
+                                    naive_limit=options['naive_limit'],
+                                    fork=options['fork'],
+                                    log=log)
+        finally:
+            runner.teardown_databases(old_config)
+
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        if verbosity:
+            self.stdout.write('Wrote %d results to %s\n' %
+                              (len(report['results']), options['output']))
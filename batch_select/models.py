@@ -1,10 +1,23 @@
 from django.db.models.query import QuerySet
-from django.db import models, connection
+from django.db import models, connection, connections
 from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.constants import LOOKUP_SEP, GET_ITERATOR_CHUNK_SIZE
+from django.db.models.sql.datastructures import EmptyResultSet
 
 from django.conf import settings
 
+from array import array
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+import hashlib
+import re
+import threading
+import time
+
 from replay import Replay
+from cache import BatchCache, watch
+from signals import batch_selected
 
 def _not_exists(fieldname):
     raise FieldDoesNotExist('"%s" is not a ManyToManyField or a reverse ForeignKey relationship' % fieldname)
@@ -24,6 +37,89 @@ def _check_field_exists(model, fieldname):
             _not_exists(fieldname)
     return fieldname
 
+def _split_path(fieldname):
+    # e.g. 'personteam_set__team__program' gives
+    # ('personteam_set', ['team', 'program'])
+    fieldnames = fieldname.split(LOOKUP_SEP)
+    return fieldnames[0], fieldnames[1:]
+
+def _get_field(model, fieldname):
+    # like _check_field_exists, but any kind of relationship will do
+    # (including a plain ForeignKey) and we also hand back the model
+    # on the other end of it
+    try:
+        field_object, _, direct, m2m = model._meta.get_field_by_name(fieldname)
+    except FieldDoesNotExist:
+        if fieldname.endswith('_set'):
+            return _get_field(model, fieldname[:-len('_set')])
+        else:
+            raise
+    if direct:
+        if not getattr(field_object, 'rel', None):
+            raise FieldDoesNotExist('"%s" is not a relationship' % fieldname)
+        related_model = field_object.rel.to
+    else:
+        related_model = field_object.model
+    return field_object, direct, m2m, related_model
+
+def _check_path_exists(model, path):
+    # the first step of a path has to be something we can batch select,
+    # the steps after that can be any relationship from the previous model
+    fieldname, nested = _split_path(path)
+    _check_field_exists(model, fieldname)
+    for fieldname in [fieldname] + nested:
+        model = _get_field(model, fieldname)[3]
+    return path
+
+class _Relation(object):
+    '''
+    what batch_select needs to know about a many-to-many or
+    reverse foreign key relationship from a model
+    '''
+    def __init__(self, model, fieldname):
+        self.fieldname = fieldname
+        self.through = None
+        # the fields holding the id of the instance on this end of the
+        # relationship (on the through model, or the related model for a
+        # reverse foreign key) and of the related instance (on the
+        # through model)
+        self.child_attname = None
+        field_object, _, direct, m2m = model._meta.get_field_by_name(fieldname)
+        if m2m:
+            if not direct:
+                m2m_field = field_object.field
+                self.related_model = field_object.model
+                self.related_name = m2m_field.name
+                self.id_column = m2m_field.m2m_reverse_name()
+                self.accessor_name = field_object.get_accessor_name()
+                self.cache_name = m2m_field.related_query_name()
+                parent_name = m2m_field.m2m_reverse_field_name()
+                child_name = m2m_field.m2m_field_name()
+            else:
+                m2m_field = field_object
+                self.related_model = m2m_field.rel.to # model on other end of relationship
+                self.related_name = m2m_field.related_query_name()
+                self.id_column = m2m_field.m2m_column_name()
+                self.accessor_name = self.cache_name = m2m_field.name
+                parent_name = m2m_field.m2m_field_name()
+                child_name = m2m_field.m2m_reverse_field_name()
+            self.db_table = m2m_field.m2m_db_table()
+            self.through = m2m_field.rel.through
+            self.parent_attname = self.through._meta.get_field(parent_name).attname
+            self.child_attname = self.through._meta.get_field(child_name).attname
+        elif not direct:
+            # handle reverse foreign key relationships
+            fk_field = field_object.field
+            self.related_model = field_object.model
+            self.related_name  = fk_field.name
+            self.id_column = fk_field.column
+            self.db_table = self.related_model._meta.db_table
+            self.parent_attname = fk_field.attname
+            self.accessor_name = field_object.get_accessor_name()
+            self.cache_name = fk_field.related_query_name()
+        else:
+            _not_exists(fieldname)
+
 def _id_attr(id_column):
     # mangle the id column name, so we can make sure
     # the postgres doesn't complain about not quoting
@@ -40,7 +136,334 @@ def _select_related_instances(related_model, related_name, ids, db_table, id_col
                             .extra(select=select)
     return related_instances
 
-def batch_select(model, instances, target_field_name, fieldname, filter=None):
+def _chunked(ids, chunk_size):
+    if not chunk_size:
+        return [ids]
+    return [ids[i:i+chunk_size] for i in xrange(0, len(ids), chunk_size)]
+
+def _fetch_chunk(related_instances):
+    # runs in a worker thread, which django gives its own connection,
+    # so make sure that connection doesn't outlive the thread's work
+    try:
+        return list(related_instances)
+    finally:
+        connections[related_instances.db].close()
+
+def _fetch_all(queries, workers=None):
+    # the results of each query, run concurrently on workers threads
+    # if there's more than one
+    if workers and len(queries) > 1:
+        pool = ThreadPool(min(workers, len(queries)))
+        try:
+            return pool.map(_fetch_chunk, queries)
+        finally:
+            pool.close()
+            pool.join()
+    return [list(query) for query in queries]
+
+def _select_forward_related(instances, field_object, chunk_size=None,
+                            workers=None):
+    # fetch the objects on the other end of a ForeignKey for all the
+    # instances in one query (or one per chunk_size of them), and fill in
+    # the field's cache on each instance so following the ForeignKey
+    # doesn't query again
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'BATCH_SELECT_CHUNK_SIZE', None)
+    if workers is None:
+        workers = getattr(settings, 'BATCH_SELECT_WORKERS', None)
+    rel_field = field_object.rel.get_related_field()
+    values = set(getattr(instance, field_object.attname) for instance in instances)
+    values.discard(None)
+    related = {}
+    if values:
+        manager = field_object.rel.to._default_manager
+        queries = [manager.filter(**{ ('%s__in' % rel_field.name): chunk })
+                   for chunk in _chunked(list(values), chunk_size)]
+        for related_instances in _fetch_all(queries, workers):
+            for related_instance in related_instances:
+                related[getattr(related_instance, rel_field.attname)] = related_instance
+    cache_name = field_object.get_cache_name()
+    for instance in instances:
+        setattr(instance, cache_name,
+                related.get(getattr(instance, field_object.attname)))
+    return related.values()
+
+def _select_nested(model, instances, fieldnames, **options):
+    # follow the rest of a batch path from the already selected
+    # instances, doing one query per step of the path
+    fieldname, nested = fieldnames[0], fieldnames[1:]
+    field_object, direct, m2m, related_model = _get_field(model, fieldname)
+    if direct and not m2m:
+        related_instances = _select_forward_related(instances, field_object,
+                                                    **options)
+    else:
+        target_field_name = '%s_all' % fieldname
+        batch_select(model, instances, target_field_name, fieldname, **options)
+        related_instances = [related_instance for instance in instances
+                             for related_instance in getattr(instance, target_field_name)]
+    if nested and related_instances:
+        _select_nested(related_model, related_instances, nested, **options)
+
+def _select_through_fields(related_instances, relation, fields, filter):
+    # the batch query already joins the through table, so columns from
+    # it (e.g. PersonPhone.primary) can be selected or filtered on
+    # without another query or another join
+    through = relation.through
+    if through is None:
+        raise FieldDoesNotExist('"%s" is not a ManyToManyField, so has no through model' % relation.fieldname)
+    qn = connection.ops.quote_name
+    select, where, params = {}, [], []
+    for name in list(fields) + filter.keys():
+        field = through._meta.get_field(name)
+        select[field.attname] = '%s.%s' % (qn(relation.db_table), qn(field.column))
+    for name, value in filter.items():
+        field = through._meta.get_field(name)
+        where.append('%s = %%s' % select[field.attname])
+        params.append(field.get_prep_value(value))
+    return related_instances.extra(select=select, where=where, params=params)
+
+def _project(related_instances, relation, projection):
+    # turn the batch query into a values() or values_list() query,
+    # which also selects the id of the instance each row belongs to
+    id_attr = _id_attr(relation.id_column)
+    meta = relation.related_model._meta
+    kind = projection[0]
+    if kind == 'ids':
+        return related_instances.values_list(id_attr, meta.pk.name)
+    fields = projection[1] or [field.name for field in meta.fields]
+    if kind == 'values':
+        return related_instances.values(id_attr, *fields)
+    return related_instances.values_list(id_attr, *fields)
+
+def _aggregate(related_instances, relation, aggregates):
+    # group the batch query by the id of the instance each row belongs
+    # to, so only one row of aggregates per instance comes back (and
+    # clear any ordering, which would end up in the GROUP BY)
+    id_attr = _id_attr(relation.id_column)
+    return related_instances.order_by().values(id_attr).annotate(**aggregates)
+
+class _SqlTemplate(object):
+    '''
+    the compiled sql of a batch query, split around the placeholder for
+    the ids of the instances to select for, so it can be run again for
+    any other ids without building and compiling the query again
+    '''
+    def __init__(self, related_instances, sentinel):
+        self.related_instances = related_instances
+        self.db = related_instances.db
+        try:
+            sql, params = related_instances.query \
+                            .get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            self.sql = None
+            return
+        positions = [i for i, param in enumerate(params) if param == sentinel]
+        if len(positions) != 1:
+            raise ValueError('can\'t find where the ids go in the batch query')
+        self.position = positions[0]
+        self.params = list(params)
+        placeholders = [match for match in re.finditer('%%|%s', sql)
+                        if match.group() == '%s']
+        placeholder = placeholders[self.position]
+        self.sql = (sql[:placeholder.start()], sql[placeholder.end():])
+    
+    def as_sql(self, ids):
+        if self.sql is None or not ids:
+            return None
+        before, after = self.sql
+        sql = '%s%s%s' % (before, ', '.join(['%s'] * len(ids)), after)
+        params = self.params[:self.position] + list(ids) + \
+                 self.params[self.position + 1:]
+        return sql, params
+    
+    def fetch(self, ids):
+        query = self.as_sql(ids)
+        if query is None:
+            return
+        sql, params = query
+        cursor = connections[self.db].cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(GET_ITERATOR_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield _instance_from_row(self.related_instances, row)
+
+class _TemplateQuery(object):
+    # stands in for the batch query of a chunk of ids
+    def __init__(self, template, ids):
+        self.template = template
+        self.db = template.db
+        self.ids = ids
+    
+    def __iter__(self):
+        return self.template.fetch(self.ids)
+    
+    def as_sql(self):
+        return self.template.as_sql(self.ids)
+
+def _query_sql(related_instances):
+    # the sql and params a batch query runs, or None if it doesn't run
+    if isinstance(related_instances, _TemplateQuery):
+        return related_instances.as_sql()
+    try:
+        return related_instances.query \
+                    .get_compiler(related_instances.db).as_sql()
+    except EmptyResultSet:
+        return None
+
+# compiled batch queries, least recently used first
+_sql_templates = OrderedDict()
+_sql_templates_lock = threading.Lock()
+
+def _integer_pk(model):
+    # whether model's primary key (or what it refers to) is an integer
+    field = model._meta.pk
+    while field.rel:
+        field = field.rel.get_related_field()
+    return isinstance(field, (models.AutoField, models.IntegerField))
+
+def _sentinel(model):
+    # a value for the ids in a batch query that's easy to spot among
+    # the query's params, of the right type for model's primary key
+    if _integer_pk(model):
+        return -7364019
+    return u'__batch_select_ids__'
+
+def _get_sql_template(key, model, relation, *args):
+    size = getattr(settings, 'BATCH_SELECT_SQL_CACHE_SIZE', 100)
+    if not size:
+        return None
+    with _sql_templates_lock:
+        if key in _sql_templates:
+            template = _sql_templates[key] = _sql_templates.pop(key)
+            return template
+    
+    sentinel = _sentinel(model)
+    related_instances = _batch_query(relation, [sentinel], *args)
+    template = None
+    if _can_union(related_instances):
+        try:
+            template = _SqlTemplate(related_instances, sentinel)
+        except ValueError:
+            pass
+    # remember queries that can't be templated too, so we don't keep
+    # compiling them to find that out
+    with _sql_templates_lock:
+        _sql_templates[key] = template
+        while len(_sql_templates) > size:
+            _sql_templates.popitem(last=False)
+    return template
+
+def _batch_query(relation, ids, filter=None, through_fields=(), through_filter={},
+                 projection=None, aggregates=None):
+    related_instances = _select_related_instances(relation.related_model,
+                                                  relation.related_name, 
+                                                  ids, relation.db_table,
+                                                  relation.id_column)
+    if through_fields or through_filter:
+        related_instances = _select_through_fields(related_instances, relation,
+                                                   through_fields, through_filter)
+    if filter:
+        related_instances = filter(related_instances)
+    if projection:
+        related_instances = _project(related_instances, relation, projection)
+    elif aggregates:
+        related_instances = _aggregate(related_instances, relation, aggregates)
+    return related_instances
+
+def _split_row(row, id_attr, projection):
+    # gives the id of the instance a row of the batch query belongs to,
+    # and what to attach to that instance for the row
+    if not projection:
+        return getattr(row, id_attr), row
+    kind = projection[0]
+    if kind == 'values':
+        return row.pop(id_attr), row
+    if kind == 'ids' or projection[2]: # flat
+        return row[0], row[1]
+    return row[0], row[1:]
+
+def _attach(instances, target_field_name, relation, fetched, nested,
+            projection=None, **options):
+    # fetched holds the related instances for each chunk. each parent's
+    # children all come from the same chunk, so merging the chunks keeps
+    # any ordering set on the batch
+    if projection and projection[0] == 'ids' and \
+            _integer_pk(relation.related_model):
+        new_group = lambda: array('l')
+    else:
+        new_group = list
+    grouped = {}
+    id_attr = _id_attr(relation.id_column)
+    for related_instances in fetched:
+        for row in related_instances:
+            instance_id, value = _split_row(row, id_attr, projection)
+            group = grouped.get(instance_id)
+            if group is None:
+                group = grouped[instance_id] = new_group()
+            group.append(value)
+    
+    for instance in instances:
+        setattr(instance, target_field_name, grouped.get(instance.pk, new_group()))
+    
+    if nested:
+        related_instances = [related_instance for group in grouped.itervalues()
+                             for related_instance in group]
+        if related_instances:
+            _select_nested(relation.related_model, related_instances, nested,
+                           **options)
+    
+    return instances
+
+def _attach_aggregates(instances, relation, fetched, aggregates):
+    grouped = {}
+    id_attr = _id_attr(relation.id_column)
+    for rows in fetched:
+        for row in rows:
+            grouped[row.pop(id_attr)] = row
+    
+    # instances without any related instances get what aggregating
+    # an empty queryset would give
+    empty = dict((name, 0 if isinstance(aggregate, models.Count) else None)
+                 for name, aggregate in aggregates.items())
+    for instance in instances:
+        row = grouped.get(instance.pk, empty)
+        for name in aggregates:
+            setattr(instance, name, row[name])
+    
+    return instances
+
+def _seed_prefetch_cache(instances, target_field_name, relation):
+    # make the related manager's all() give back what was batch selected,
+    # in the same way prefetch_related does
+    for instance in instances:
+        prefetched = instance.__dict__.setdefault('_prefetched_objects_cache', {})
+        prefetched.pop(relation.cache_name, None)
+        related_instances = getattr(instance, relation.accessor_name).all()
+        related_instances._result_cache = list(getattr(instance, target_field_name))
+        related_instances._prefetch_done = True
+        prefetched[relation.cache_name] = related_instances
+
+def _restore_cached(instances, names, cached):
+    # set the cached values on the instances they were cached for, and
+    # give back the values to cache for the rest
+    fresh = {}
+    for instance in instances:
+        values = cached.get(instance.pk)
+        if values is None:
+            fresh[instance.pk] = [getattr(instance, name) for name in names]
+        else:
+            for name, value in zip(names, values):
+                setattr(instance, name, value)
+    return fresh
+
+def batch_select(model, instances, target_field_name, fieldname, filter=None,
+                 chunk_size=None, workers=None, through_fields=(),
+                 through_filter={}, projection=None, aggregates=None,
+                 cache=None, sql_key=None, prefetch=False,
+                 parent_query=None):
     '''
     basically do an extra-query to select the many-to-many
     field values into the instances given. e.g. so we can get all
@@ -56,56 +479,407 @@ def batch_select(model, instances, target_field_name, fieldname, filter=None):
     filter is a function that can be used alter the extra-query - it 
     takes a queryset and returns a filtered version of the queryset
     
+    fieldname can also be a path such as 'personteam_set__team__program',
+    in which case each step after the first is selected from the objects
+    found by the step before, with one query per step. Many-valued steps
+    are attached as '<step>_all' lists, ForeignKey steps fill in the
+    ForeignKey's cache so following it doesn't query. filter only
+    applies to the first step.
+    
+    through_fields names columns of a ManyToManyField's through model
+    (e.g. 'primary' on PersonPhone) to attach to each related instance,
+    and through_filter restricts the extra-query to related instances
+    whose through rows have the given values (e.g. {'primary': True}).
+    Both come from the through table the extra-query already joins.
+    
+    projection attaches rows rather than model instances, which saves
+    building an instance per row: ('values', fields) gives dicts and
+    ('values_list', fields, flat) tuples, as the QuerySet methods of
+    the same name would (fields defaults to all the fields of the
+    related model). ('ids',) gives an array('l') of the related
+    instances' primary keys (a list, if they aren't integers). A
+    projection can't be used with a path.
+    
+    aggregates is a dict of names to aggregates (e.g. Sum('hours')),
+    which are worked out per instance by grouping the extra-query and
+    attached under those names instead of target_field_name, so none
+    of the related instances are fetched. Instances without related
+    instances get 0 for a Count and None for anything else.
+    
+    cache is a (timeout, variant) pair, which keeps what is attached to
+    each instance in the django cache (see batch_select.cache) for
+    timeout seconds, so only instances not found there are queried.
+    variant has to be different for every filter, through, projection
+    or aggregates the relationship is selected with. cache can't be
+    used with a path.
+    
+    prefetch also fills in the related manager's cache (as
+    prefetch_related does), so e.g. entry.tags.all() gives the selected
+    tags without a query. It's up to the caller to make sure the
+    extra-query selects all the related instances - so no filter - and
+    it can't be used with a projection or aggregates.
+    
+    parent_query is a queryset giving the pks of the instances (e.g.
+    Entry.objects.filter(...).values('pk')), which the extra-query then
+    uses as a subquery instead of a list of the instances' ids. That
+    saves sending a long list of ids back to the database, so it's
+    worth it for large numbers of instances. It's ignored if some of
+    the instances were found in the cache.
+    
+    sql_key is a hashable key, that has to be different for every
+    filter and through the relationship is selected with. The first
+    time the key is seen the extra-query's sql is compiled and kept,
+    and after that only the ids are put into the kept sql (keeps the
+    last BATCH_SELECT_SQL_CACHE_SIZE, defaulting to 100, queries - or
+    none if it's 0). It's ignored for projections and aggregates, and
+    for queries that use select_related, annotate, defer, only or
+    distinct.
+    
+    chunk_size splits the extra-query into several queries, each with
+    at most chunk_size ids in its IN clause (defaults to the
+    BATCH_SELECT_CHUNK_SIZE setting, or no chunking). workers runs
+    those chunks concurrently on that many threads (defaults to the
+    BATCH_SELECT_WORKERS setting) - each thread uses its own database
+    connection, so it won't see uncommitted changes made by the caller.
+    
     NB: this is a semi-private API at the moment, but may be useful if you
     dont want to change your model/manager.
     '''
     
-    fieldname = _check_field_exists(model, fieldname)
+    fieldname, nested = _split_path(fieldname)
+    relation = _Relation(model, _check_field_exists(model, fieldname))
+    if nested and projection:
+        raise ValueError('"%s" is a path, so values can\'t be selected for it' %
+                         LOOKUP_SEP.join([fieldname] + nested))
+    if aggregates and (nested or projection):
+        raise ValueError('aggregates can\'t be selected for "%s" with a path or values' %
+                         LOOKUP_SEP.join([fieldname] + nested))
+    if nested and cache:
+        raise ValueError('"%s" is a path, so can\'t be cached' %
+                         LOOKUP_SEP.join([fieldname] + nested))
+    if prefetch and (projection or aggregates):
+        raise ValueError('"%s" can\'t be prefetched with values or aggregates' %
+                         fieldname)
     
     instances = list(instances)
-    ids = [instance.pk for instance in instances]
     
-    field_object, model, direct, m2m = model._meta.get_field_by_name(fieldname)
-    if m2m:
-        if not direct:
-            m2m_field = field_object.field
-            related_model = field_object.model
-            related_name = m2m_field.name
-            id_column = m2m_field.m2m_reverse_name()
-            db_table = m2m_field.m2m_db_table()
+    cached = {}
+    if cache:
+        timeout, variant = cache
+        batch_cache = BatchCache(model, relation, variant, timeout)
+        cached = batch_cache.get_many([instance.pk for instance in instances])
+    ids = [instance.pk for instance in instances if instance.pk not in cached]
+    
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'BATCH_SELECT_CHUNK_SIZE', None)
+    if workers is None:
+        workers = getattr(settings, 'BATCH_SELECT_WORKERS', None)
+    
+    template = None
+    if parent_query is not None and not cached:
+        # the ids stay in the database
+        chunks = [parent_query]
+    else:
+        chunks = _chunked(ids, chunk_size)
+        if sql_key is not None and not (projection or aggregates):
+            template = _get_sql_template((model, fieldname, sql_key), model,
+                                         relation, filter, through_fields,
+                                         through_filter)
+    
+    if template is not None:
+        queries = [_TemplateQuery(template, chunk) for chunk in chunks]
+    else:
+        queries = [_batch_query(relation, chunk, filter, through_fields,
+                                through_filter, projection, aggregates)
+                   for chunk in chunks]
+    
+    # only work out the sql if something is listening for it
+    instrumented = bool(batch_selected.receivers)
+    if instrumented:
+        sql = [query for query in map(_query_sql, queries) if query is not None]
+    
+    start = time.time()
+    fetched = _fetch_all(queries, workers)
+    query_time = time.time() - start
+    
+    start = time.time()
+    if aggregates:
+        names = sorted(aggregates)
+        _attach_aggregates(instances, relation, fetched, aggregates)
+    else:
+        names = [target_field_name]
+        _attach(instances, target_field_name, relation, fetched, [],
+                projection)
+    
+    if cache:
+        batch_cache.set_many(_restore_cached(instances, names, cached))
+    if prefetch:
+        _seed_prefetch_cache(instances, target_field_name, relation)
+    group_time = time.time() - start
+    
+    if instrumented:
+        batch_selected.send(sender=model, relation=fieldname,
+                            target=target_field_name, parents=len(instances),
+                            ids=len(ids), rows=sum(map(len, fetched)),
+                            queries=len(sql), query_time=query_time,
+                            group_time=group_time, sql=sql, union=False)
+    
+    if nested:
+        related_instances = [related_instance for instance in instances
+                             for related_instance in getattr(instance, target_field_name)]
+        if related_instances:
+            _select_nested(relation.related_model, related_instances, nested,
+                           chunk_size=chunk_size, workers=workers)
+    return instances
+
+# options a Batch can have and still be part of a union
+_UNION_OPTIONS = set(['through_fields', 'through_filter'])
+
+def _can_union(related_instances):
+    # the rows of these queries are turned back into instances by
+    # _instance_from_row, which only knows about plain model columns
+    # (distinct can add ordering columns to the select)
+    query = related_instances.query
+    return not (query.select_related or query.aggregate_select or
+                query.deferred_loading[0] or query.distinct)
+
+def _instance_from_row(related_instances, row):
+    # build an instance from a row in the same way QuerySet.iterator
+    # does. the union loses the column types some backends (e.g. sqlite)
+    # use to convert values, so the values go through to_python again
+    model = related_instances.model
+    extra_select = related_instances.query.extra_select.keys()
+    start = len(extra_select)
+    values = [value if value is None else field.to_python(value)
+              for field, value in zip(model._meta.fields, row[start:])]
+    instance = model(*values)
+    instance._state.db = related_instances.db
+    instance._state.adding = False
+    for i, name in enumerate(extra_select):
+        setattr(instance, name, row[i])
+    return instance
+
+def _union_columns(related_instances, relation):
+    # the field each column of a batch query's rows comes from, with the
+    # extra select columns first (the id of the instance a row belongs
+    # to, and any through fields), or None if it's not known
+    id_attr = _id_attr(relation.id_column)
+    through_fields = {}
+    if relation.through is not None:
+        through_fields = dict((field.attname, field)
+                              for field in relation.through._meta.fields)
+    id_model = relation.through or relation.related_model
+    id_field = [field for field in id_model._meta.fields
+                if field.attname == relation.parent_attname][0]
+    columns = []
+    for name in related_instances.query.extra_select:
+        if name == id_attr:
+            columns.append(id_field)
         else:
-            m2m_field = field_object
-            related_model = m2m_field.rel.to # model on other end of relationship
-            related_name = m2m_field.related_query_name()
-            id_column = m2m_field.m2m_column_name()
-            db_table  = m2m_field.m2m_db_table()
-    elif not direct:
-        # handle reverse foreign key relationships
-        fk_field = field_object.field
-        related_model = field_object.model
-        related_name  = fk_field.name
-        id_column = fk_field.column
-        db_table = related_model._meta.db_table
+            columns.append(through_fields.get(name))
+    return columns + list(related_instances.model._meta.fields)
+
+def _union_ordering(related_instances):
+    # the ordering of a batch query, as (column of its rows, descending)
+    # pairs - or None if it orders by something that isn't one of its
+    # columns (e.g. a related model's field), so can't be kept in a union
+    query = related_instances.query
+    if query.extra_order_by:
+        ordering = query.extra_order_by
+    elif not query.default_ordering:
+        ordering = query.order_by
+    else:
+        ordering = query.order_by or query.model._meta.ordering
+    extra_select = query.extra_select.keys()
+    fields = query.model._meta.fields
+    columns = []
+    for name in ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            name = query.model._meta.pk.attname
+        if name in extra_select:
+            column = extra_select.index(name)
+        else:
+            # by attname, as a ForeignKey by name orders by the related
+            # model's ordering
+            matches = [i for i, field in enumerate(fields)
+                       if name == field.attname]
+            if not matches:
+                return None
+            column = len(extra_select) + matches[0]
+        columns.append((column, descending != (not query.standard_ordering)))
+    return columns
+
+def _null(field, db_connection):
+    # postgres works out the type of a union's columns a pair of queries
+    # at a time, so a column that's a bare NULL in the first two is text
+    # and won't match e.g. an integer in a later one. Other databases
+    # look at all the queries (mysql) or don't mind (sqlite)
+    if field is None or db_connection.vendor != 'postgresql':
+        return 'NULL'
+    if isinstance(field, models.AutoField):
+        field = models.IntegerField()
+    db_type = field.db_type(connection=db_connection)
+    if not db_type:
+        return 'NULL'
+    # without any CHECK constraint that comes with the type
+    return 'CAST(NULL AS %s)' % db_type.split(' CHECK')[0]
+
+def _fetch_union(queries, relations, executed=None):
+    # run the queries as one UNION ALL statement. every query gets its
+    # own range of columns (NULL in the rows of the other queries), so
+    # queries on different models fit together, and a leading column
+    # says which query each row came from. the order of a subquery
+    # doesn't carry through a union, so the union is ordered by that
+    # column and then each query's own ordering (see _union_ordering)
+    if not queries:
+        return []
+    db_connection = connections[queries[0].db]
+    qn = db_connection.ops.quote_name
+    compiled = []
+    for i, (related_instances, relation) in enumerate(zip(queries, relations)):
+        try:
+            sql, params = related_instances.query \
+                            .get_compiler(related_instances.db).as_sql()
+        except EmptyResultSet:
+            continue
+        compiled.append((i, sql, params,
+                         _union_columns(related_instances, relation),
+                         _union_ordering(related_instances)))
     
-    related_instances = _select_related_instances(related_model, related_name, 
-                                                  ids, db_table, id_column)
+    parts, union_params, slices, order_by = [], [], {}, ['1']
+    offset = 1
+    for i, sql, params, columns, ordering in compiled:
+        alias = qn('__batch%d' % i)
+        select = ['%d AS %s' % (i, qn('__batch'))]
+        for j, _, _, other_columns, _ in compiled:
+            if j == i:
+                select.append('%s.*' % alias)
+            else:
+                select.extend(_null(field, db_connection)
+                              for field in other_columns)
+        parts.append('SELECT %s FROM (%s) %s' % (', '.join(select), sql, alias))
+        union_params.extend(params)
+        slices[i] = (offset, offset + len(columns))
+        # the other queries' columns are all NULL in this query's rows,
+        # so ordering by them too doesn't change its order
+        order_by.extend('%d%s' % (offset + column + 1, descending and ' DESC' or '')
+                        for column, descending in ordering)
+        offset += len(columns)
     
-    if filter:
-        related_instances = filter(related_instances)
+    fetched = [[] for _ in queries]
+    if not parts:
+        return fetched
     
-    grouped = {}
-    id_attr = _id_attr(id_column)
-    for related_instance in related_instances:
-        instance_id = getattr(related_instance, id_attr)
-        group = grouped.get(instance_id, [])
-        group.append(related_instance)
-        grouped[instance_id] = group
+    sql = '%s ORDER BY %s' % (' UNION ALL '.join(parts), ', '.join(order_by))
+    if executed is not None:
+        executed.append((sql, union_params))
+    cursor = db_connection.cursor()
+    cursor.execute(sql, union_params)
+    while True:
+        rows = cursor.fetchmany(GET_ITERATOR_CHUNK_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            i = int(row[0])
+            start, end = slices[i]
+            fetched[i].append(_instance_from_row(queries[i], row[start:end]))
+    return fetched
+
+def batch_select_union(model, instances, batches, chunk_size=None):
+    '''
+    select several Batches into the instances given, in the same way as
+    calling batch_select for each of them, but with the extra-queries
+    for all the batches sent to the database as a single UNION ALL
+    query (one per chunk of ids if chunk_size, or the
+    BATCH_SELECT_CHUNK_SIZE setting, is given) - so one round trip
+    instead of one per batch
     
-    for instance in instances:
-        setattr(instance, target_field_name, grouped.get(instance.pk, []))
+    batches that can't be part of the union (they use select_related,
+    annotate, defer or only, have their own chunking or are on another
+    database) are selected separately with batch_select
+    '''
+    instances = list(instances)
+    ids = [instance.pk for instance in instances]
+    
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'BATCH_SELECT_CHUNK_SIZE', None)
+    chunks = [chunk for chunk in _chunked(ids, chunk_size) if chunk]
+    
+    unioned, separate = [], []
+    for batch in batches:
+        if not chunks or not set(batch.options) <= _UNION_OPTIONS:
+            separate.append(batch)
+            continue
+        fieldname, nested = _split_path(batch.m2m_fieldname)
+        relation = _Relation(model, _check_field_exists(model, fieldname))
+        queries = [_batch_query(relation, chunk, batch.replay, **batch.options)
+                   for chunk in chunks]
+        if _can_union(queries[0]) and \
+                _union_ordering(queries[0]) is not None and \
+                (not unioned or unioned[0][3][0].db == queries[0].db):
+            unioned.append((batch, relation, nested, queries))
+        else:
+            separate.append(batch)
     
+    if len(unioned) < 2:
+        separate.extend(batch for batch, _, _, _ in unioned)
+        unioned = []
+    
+    fetched = [[] for _ in unioned]
+    relations = [unioned_batch[1] for unioned_batch in unioned]
+    sql = []
+    start = time.time()
+    for chunk_index in xrange(len(chunks)):
+        chunk_queries = [queries[chunk_index] for _, _, _, queries in unioned]
+        for batch_fetched, rows in zip(fetched, _fetch_union(chunk_queries,
+                                                             relations, sql)):
+            batch_fetched.append(rows)
+    query_time = time.time() - start
+    
+    for (batch, relation, nested, _), batch_fetched in zip(unioned, fetched):
+        start = time.time()
+        _attach(instances, batch.target_field_name, relation, batch_fetched, nested)
+        batch_selected.send(sender=model, relation=relation.fieldname,
+                            target=batch.target_field_name,
+                            parents=len(instances), ids=len(ids),
+                            rows=sum(map(len, batch_fetched)),
+                            queries=len(sql), query_time=query_time,
+                            group_time=time.time() - start, sql=sql,
+                            union=True)
+    
+    for batch in separate:
+        instances = batch._select(model, instances)
     return instances
 
+def _freeze(value):
+    # something hashable with a stable repr, that's the same for equal
+    # arguments to a Batch, e.g. Q objects and aggregates compare on their
+    # contents, model instances on their pk and querysets on their sql
+    if isinstance(value, models.Model):
+        return (value.__class__.__name__, value.pk)
+    if isinstance(value, QuerySet):
+        try:
+            return (value.__class__.__name__, unicode(value.query))
+        except EmptyResultSet:
+            return (value.__class__.__name__, None)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(item) for item in value))
+    if hasattr(value, '__dict__') and not callable(value):
+        return (value.__class__.__name__, _freeze(value.__dict__))
+    return value
+
+# options that don't change what a Batch selects
+_RUN_OPTIONS = set(['chunk_size', 'workers', 'cache', 'prefetch', 'lazy'])
+
+# replays that change which related instances a Batch selects
+_FILTERING_REPLAYS = set(['filter', 'exclude', 'extra'])
+
 class Batch(Replay):
     # functions on QuerySet that we can invoke via this batch object
     __replayable__ = ('filter', 'exclude', 'annotate', 
@@ -115,14 +889,199 @@ class Batch(Replay):
     def __init__(self, m2m_fieldname, **filter):
         super(Batch,self).__init__()
         self.m2m_fieldname = m2m_fieldname
-        self.target_field_name = '%s_all' % m2m_fieldname
+        self.target_field_name = '%s_all' % _split_path(m2m_fieldname)[0]
+        # extra keyword arguments passed through to batch_select
+        self.options = {}
         if filter: # add a filter replay method
             self._add_replay('filter', *(), **filter)
     
     def clone(self):
         cloned = super(Batch, self).clone(self.m2m_fieldname)
         cloned.target_field_name = self.target_field_name
+        cloned.options = self.options.copy()
+        return cloned
+    
+    def _set_options(self, **options):
+        cloned = self.clone()
+        cloned.options.update(options)
         return cloned
+    
+    def chunked(self, chunk_size, workers=None):
+        '''
+        split the batch query into chunks of at most chunk_size
+        parent ids, optionally running them on workers threads
+        '''
+        return self._set_options(chunk_size=chunk_size, workers=workers)
+    
+    def through(self, *fields, **filter):
+        '''
+        attach the named columns of the through model to each related
+        instance, and only select related instances whose through rows
+        match filter, e.g. Batch('emails').through('primary') or
+        Batch('emails').through(primary=True)
+        '''
+        return self._set_options(through_fields=fields, through_filter=filter)
+    
+    def values(self, *fields):
+        '''
+        attach a dict of the given fields for each related instance,
+        rather than the instance itself
+        '''
+        return self._set_options(projection=('values', fields))
+    
+    def values_list(self, *fields, **kwargs):
+        '''
+        attach a tuple of the given fields (or just the field, if flat)
+        for each related instance, rather than the instance itself
+        '''
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s'
+                    % (kwargs.keys(),))
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when values_list is called with more than one field.")
+        return self._set_options(projection=('values_list', fields, flat))
+    
+    def ids(self):
+        '''
+        attach an array('l') of the related instances' primary keys (a
+        list if they aren't integers), rather than the instances themselves
+        '''
+        return self._set_options(projection=('ids',))
+    
+    def aggregate(self, *aggregates, **named_aggregates):
+        '''
+        attach aggregates over each instance's related instances,
+        rather than the related instances, e.g.
+        Batch('timerecord_set').aggregate(Sum('hours')) attaches hours_sum
+        '''
+        for aggregate in aggregates:
+            name = aggregate.default_alias.replace(LOOKUP_SEP, '_')
+            named_aggregates[name] = aggregate
+        return self._set_options(aggregates=named_aggregates)
+    
+    def cache(self, timeout=None):
+        '''
+        keep what the batch selects for each instance in the cache for
+        timeout seconds (defaults to the BATCH_SELECT_CACHE_TIMEOUT
+        setting), and only query for the instances not found there. The
+        relationship should be in the model's BatchManager's
+        cached_batches, so every process invalidates it
+        '''
+        return self._set_options(cache=timeout)
+    
+    def prefetch(self):
+        '''
+        also fill in the related manager's cache, so e.g. entry.tags.all()
+        gives the batch selected tags without another query (not
+        allowed for batches that filter which related instances they
+        select, as all() would then be missing some)
+        '''
+        return self._set_options(prefetch=True)
+    
+    def lazy(self):
+        '''
+        don't select the batch until its attribute is first read on one
+        of the instances, and then select it for all of them at once -
+        so a batch nothing reads costs nothing
+        '''
+        return self._set_options(lazy=True)
+    
+    def _attribute_names(self):
+        # the attributes the batch is selected into
+        aggregates = self.options.get('aggregates')
+        if aggregates:
+            return sorted(aggregates)
+        return [self.target_field_name]
+    
+    def _check_prefetch(self):
+        if not self.options.get('prefetch'):
+            return
+        filtering = [name for name, _, _ in self._replays
+                     if name in _FILTERING_REPLAYS]
+        if filtering or self.options.get('through_filter'):
+            raise ValueError('"%s" filters which related instances it selects, so can\'t be prefetched' %
+                             self.m2m_fieldname)
+    
+    def _identity(self):
+        return (self.__class__, self.m2m_fieldname, self.target_field_name,
+                _freeze(self._replays), _freeze(self.options))
+    
+    def _variant(self):
+        # tells apart batches on the same relationship that select
+        # different things, and stays the same between processes
+        options = dict((name, value) for name, value in self.options.items()
+                       if name not in _RUN_OPTIONS)
+        frozen = _freeze((self._replays, options))
+        return hashlib.md5(repr(frozen)).hexdigest()
+    
+    def _select(self, model, instances, parent_query=None):
+        options = dict(self.options, sql_key=self._variant(),
+                       parent_query=parent_query)
+        options.pop('lazy', None)
+        if 'cache' in options:
+            options['cache'] = (options['cache'], options['sql_key'])
+        return batch_select(model, instances,
+                            self.target_field_name,
+                            self.m2m_fieldname,
+                            self.replay,
+                            **options)
+
+class _LazyBatchAttribute(object):
+    '''
+    stands in for an attribute a lazy Batch selects into, until it's
+    first read on one of the instances the batch is for
+    '''
+    def __init__(self, name):
+        self.name = name
+    
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        loader = instance.__dict__.get('_batch_select_lazy', {}).get(self.name)
+        if loader is None:
+            raise AttributeError("'%s' object has no attribute '%s'" %
+                                 (owner.__name__, self.name))
+        loader.load()
+        return instance.__dict__[self.name]
+
+def _add_lazy_attributes(model, names):
+    for name in names:
+        existing = getattr(model, name, None)
+        if isinstance(existing, _LazyBatchAttribute):
+            continue
+        if existing is not None or name in model._meta.get_all_field_names():
+            raise ValueError('"%s" is already an attribute of %s, so can\'t be lazily batch selected' %
+                             (name, model.__name__))
+        setattr(model, name, _LazyBatchAttribute(name))
+
+class _LazyBatch(object):
+    '''
+    selects a lazy Batch into all the instances it's for, the first time
+    one of them needs it
+    '''
+    def __init__(self, model, batch, instances):
+        self.model = model
+        self.batch = batch
+        self.instances = instances
+        self.names = batch._attribute_names()
+        for instance in instances:
+            lazy = instance.__dict__.setdefault('_batch_select_lazy', {})
+            for name in self.names:
+                lazy[name] = self
+    
+    def load(self):
+        instances, self.instances = self.instances, None
+        if instances is None:
+            return
+        for instance in instances:
+            lazy = instance.__dict__['_batch_select_lazy']
+            for name in self.names:
+                if lazy.get(name) is self:
+                    del lazy[name]
+        # the selected attributes end up in each instance's __dict__,
+        # which takes precedence over the _LazyBatchAttribute
+        self.batch._select(self.model, instances)
 
 class BatchQuerySet(QuerySet):
     
@@ -131,6 +1090,8 @@ class BatchQuerySet(QuerySet):
         batches = getattr(self, '_batches', None)
         if batches:
             query._batches = set(batches)
+        query._batch_union = getattr(self, '_batch_union', None)
+        query._batch_subquery = getattr(self, '_batch_subquery', None)
         return query
     
     def _create_batch(self, batch_or_str, target_field_name=None):
@@ -138,9 +1099,13 @@ class BatchQuerySet(QuerySet):
         if isinstance(batch_or_str, basestring):
             batch = Batch(batch_or_str)
         if target_field_name:
+            batch = batch.clone()
             batch.target_field_name = target_field_name
         
-        _check_field_exists(self.model, batch.m2m_fieldname)
+        _check_path_exists(self.model, batch.m2m_fieldname)
+        batch._check_prefetch()
+        if batch.options.get('lazy'):
+            _add_lazy_attributes(self.model, batch._attribute_names())
         return batch
     
     def batch_select(self, *batches, **named_batches):
@@ -153,28 +1118,141 @@ class BatchQuerySet(QuerySet):
         query._batches = batches
         return query
     
-    def iterator(self):
+    def batch_count(self, *batches, **named_batches):
+        '''
+        attach the number of related instances, e.g.
+        Person.objects.batch_count('phones') gives each person a
+        phones_count (or the name given as a keyword argument)
+        '''
+        batches = [(batch, None) for batch in batches] + \
+                  [(batch, name) for name, batch in named_batches.items()]
+        counts = []
+        for batch, name in batches:
+            batch = self._create_batch(batch)
+            name = name or '%s_count' % batch.m2m_fieldname
+            counts.append(batch.aggregate(**{ name: models.Count('pk') }))
+        return self.batch_select(*counts)
+    
+    def batch_aggregate(self, batch, *aggregates, **named_aggregates):
+        '''
+        attach aggregates over the related instances, e.g.
+        Person.objects.batch_aggregate('timerecord_set', Sum('hours'))
+        gives each person an hours_sum
+        '''
+        batch = self._create_batch(batch)
+        return self.batch_select(batch.aggregate(*aggregates, **named_aggregates))
+    
+    def batch_union(self, union=True):
+        '''
+        select all the batches together as one UNION ALL query, rather
+        than a query per batch (defaults to the BATCH_SELECT_UNION setting)
+        '''
+        query = self._clone()
+        query._batch_union = union
+        return query
+    
+    def batch_subquery(self, threshold=0):
+        '''
+        when there are at least threshold results, select the batches
+        with the query for the results as a subquery, rather than with a
+        list of the results' ids (defaults to the
+        BATCH_SELECT_SUBQUERY_THRESHOLD setting, or never)
+        '''
+        query = self._clone()
+        query._batch_subquery = threshold
+        return query
+    
+    def _parent_query(self, results):
+        # the results' pks as a subquery, if there are enough results for
+        # it to be worth it. A slice can't be used as a subquery on some
+        # databases (and the order_by that goes with it would be lost)
+        threshold = getattr(self, '_batch_subquery', None)
+        if threshold is None:
+            threshold = getattr(settings, 'BATCH_SELECT_SUBQUERY_THRESHOLD', None)
+        if threshold is None or len(results) < threshold:
+            return None
+        if self.query.low_mark or self.query.high_mark is not None:
+            return None
+        return self.order_by().values('pk')
+    
+    def _select_batches(self, results, parent_query=None):
+        union = getattr(self, '_batch_union', None)
+        if union is None:
+            union = getattr(settings, 'BATCH_SELECT_UNION', False)
+        batches = [batch for batch in self._batches
+                   if not batch.options.get('lazy')]
+        if union and len(batches) > 1:
+            results = batch_select_union(self.model, results, batches)
+        else:
+            for batch in batches:
+                results = batch._select(self.model, results, parent_query)
+        
+        lazy_batches = [batch for batch in self._batches
+                        if batch.options.get('lazy')]
+        if lazy_batches:
+            results = list(results)
+            for batch in lazy_batches:
+                _LazyBatch(self.model, batch, results)
+        return results
+    
+    def _windowed(self, result_iter, window):
+        while True:
+            results = list(islice(result_iter, window))
+            if not results:
+                break
+            for result in self._select_batches(results):
+                yield result
+    
+    def iterator(self, window=None):
+        '''
+        as QuerySet.iterator, but with the batches selected in. By
+        default all the results are read before the batches are run,
+        with window the results are read (and the batches run and the
+        results yielded) window at a time, so only that many results and
+        their batched objects need to be held in memory at once
+        '''
         result_iter = super(BatchQuerySet, self).iterator()
         batches = getattr(self, '_batches', None)
         if batches:
+            if window:
+                return self._windowed(result_iter, window)
             results = list(result_iter)
-            for batch in batches:
-                results = batch_select(self.model, results,
-                                       batch.target_field_name,
-                                       batch.m2m_fieldname,
-                                       batch.replay)
-            return iter(results)
+            return iter(self._select_batches(results, self._parent_query(results)))
         return result_iter
 
 class BatchManager(models.Manager):
     use_for_related_fields = True
     
+    # relationships batches are selected from the cache for (see
+    # Batch.cache), which are watched for changes in every process from
+    # when the model is defined, rather than from the first time one of
+    # them is selected from the cache in the process
+    cached_batches = ()
+    
+    def contribute_to_class(self, model, name):
+        super(BatchManager, self).contribute_to_class(model, name)
+        for fieldname in self.cached_batches:
+            watch(model, fieldname)
+    
     def get_query_set(self):
         return BatchQuerySet(self.model)
     
     def batch_select(self, *batches, **named_batches):
         return self.all().batch_select(*batches, **named_batches)
 
+    def batch_count(self, *batches, **named_batches):
+        return self.get_query_set().batch_count(*batches, **named_batches)
+
+    def batch_aggregate(self, batch, *aggregates, **named_aggregates):
+        return self.get_query_set().batch_aggregate(batch, *aggregates,
+                                                    **named_aggregates)
+
+    def batch_union(self, union=True):
+        return self.get_query_set().batch_union(union)
+
+    def batch_subquery(self, threshold=0):
+        return self.get_query_set().batch_subquery(threshold)
+
 if getattr(settings, 'TESTING_BATCH_SELECT', False):
     class Tag(models.Model):
         name = models.CharField(max_length=32)
@@ -189,14 +1267,24 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
     class Location(models.Model):
         name = models.CharField(max_length=32)
     
+    class Author(models.Model):
+        name = models.CharField(max_length=32)
+    
     class Entry(models.Model):
         title = models.CharField(max_length=255)
         section  = models.ForeignKey(Section, blank=True, null=True)
         location = models.ForeignKey(Location, blank=True, null=True)
         tags = models.ManyToManyField(Tag)
+        authors = models.ManyToManyField(Author, through='Authorship')
         
         objects = BatchManager()
     
+    class Authorship(models.Model):
+        # through model with an extra column
+        entry = models.ForeignKey(Entry)
+        author = models.ForeignKey(Author)
+        lead = models.BooleanField(default=False)
+    
     class Country(models.Model):
         # non id pk
         name = models.CharField(primary_key=True, max_length=100)
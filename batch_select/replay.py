@@ -35,6 +35,27 @@ class Replay(object):
         cloned._replays=self._replays[:]
         return cloned
     
+    def _identity(self):
+        # what two replays need to have in common to be equal, subclasses
+        # with more state to compare should add it to this (imported
+        # here, as batch_select.models imports this module)
+        from batch_select.models import _freeze
+        return (self.__class__, _freeze(self._replays))
+    
+    def __eq__(self, other):
+        if not isinstance(other, Replay):
+            return NotImplemented
+        return self._identity() == other._identity()
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+    
+    def __hash__(self):
+        return hash(self._identity())
+    
     def replay(self, target):
         result = target
         for method_name, args, kwargs in self._replays:
@@ -0,0 +1,20 @@
+from django.dispatch import Signal
+
+# sent after each batch is selected, with the model the batch was
+# selected for as the sender:
+#
+#   relation    - the field name of the relationship (the first step of
+#                 a path - later steps send their own signal)
+#   target      - the attribute the batch was selected into
+#   parents     - number of instances the batch was for
+#   ids         - number of instances queried for (the rest were cached)
+#   rows        - number of rows fetched
+#   queries     - number of queries run (0 when everything was cached)
+#   query_time  - seconds spent running the queries and fetching rows
+#   group_time  - seconds spent attaching the rows to the instances
+#   sql         - list of (sql, params) for the queries
+#   union       - whether the batch was part of a UNION ALL query, in
+#                 which case query_time and sql are the whole union's
+batch_selected = Signal(providing_args=['relation', 'target', 'parents', 'ids',
+                                        'rows', 'queries', 'query_time',
+                                        'group_time', 'sql', 'union'])
@@ -5,11 +5,15 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
     from django.db.models.fields import FieldDoesNotExist
     from batch_select.models import Tag, Entry, Section, Batch, Location,\
                                     _select_related_instances, Country,\
-                                    _check_field_exists
+                                    _check_field_exists, Author, Authorship,\
+                                    _sql_templates
     from batch_select.replay import Replay
+    from batch_select.signals import batch_selected
     from django import db
-    from django.db.models import Count
+    from django.core.cache import cache
+    from django.db.models import Count, Max, Min
     import unittest
+    from array import array
     
     def with_debug_queries(fn):
         def _decorated(*arg, **kw):
@@ -492,6 +496,664 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
             batch = Batch('tags').order_by('id').only('id')
             self._check_name_deferred(batch)
         
+        @with_debug_queries
+        def test_batch_chunked(self):
+            batch = Batch('tags').order_by('name').chunked(2)
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entries = list(entries)
+            
+            self.failUnlessEqual([self.entry1, self.entry2, self.entry3, self.entry4],
+                                  entries)
+            
+            # one query for the entries and one per chunk of two entries
+            self.failUnlessEqual(3, len(db.connection.queries))
+            
+            entry1, entry2, entry3, entry4 = entries
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],                       entry2.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+        
+        @with_debug_queries
+        def test_batch_chunk_size_setting(self):
+            old_chunk_size = getattr(settings, 'BATCH_SELECT_CHUNK_SIZE', None)
+            settings.BATCH_SELECT_CHUNK_SIZE = 3
+            try:
+                entries = list(Entry.objects.batch_select('tags').order_by('id'))
+            finally:
+                settings.BATCH_SELECT_CHUNK_SIZE = old_chunk_size
+            
+            self.failUnlessEqual(3, len(db.connection.queries))
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(entries[0].tags_all))
+            self.failUnlessEqual(set([]), set(entries[3].tags_all))
+        
+        @unittest.skipIf(db.connection.vendor == 'sqlite',
+                         'worker threads cannot share an sqlite test database')
+        def test_batch_chunked_workers(self):
+            batch = Batch('tags').order_by('name').chunked(1, workers=2)
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],                       entry2.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+        
+        @with_debug_queries
+        def test_batch_select_nested_foreign_key(self):
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            
+            home = Location.objects.create(name='home')
+            away = Location.objects.create(name='away')
+            
+            entry1 = Entry.objects.create(section=section1, location=home)
+            entry2 = Entry.objects.create(section=section1)
+            entry3 = Entry.objects.create(section=section2, location=away)
+            
+            db.reset_queries()
+            
+            sections = Section.objects.batch_select('entry__location').order_by('id')
+            section1, section2 = list(sections)
+            
+            # one query for each step along the path
+            self.failUnlessEqual(3, len(db.connection.queries))
+            
+            self.failUnlessEqual(set([entry1, entry2]), set(section1.entry_all))
+            self.failUnlessEqual([entry3], section2.entry_all)
+            
+            locations = dict((entry.id, entry.location) for entry in section1.entry_all)
+            self.failUnlessEqual(home, locations[entry1.id])
+            self.failUnless(locations[entry2.id] is None)
+            self.failUnlessEqual(away, section2.entry_all[0].location)
+            
+            self.failUnlessEqual(3, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_select_nested_foreign_key_chunked(self):
+            section = Section.objects.create(name='s1')
+            home = Location.objects.create(name='home')
+            away = Location.objects.create(name='away')
+            Entry.objects.create(section=section, location=home)
+            Entry.objects.create(section=section, location=away)
+            
+            db.reset_queries()
+            
+            batch = Batch('entry__location').chunked(1)
+            section, = list(Section.objects.batch_select(batch))
+            
+            # a query per location, as well as for the section and entries
+            self.failUnlessEqual(4, len(db.connection.queries))
+            self.failUnlessEqual(set([home, away]),
+                                 set(entry.location for entry in section.entry_all))
+            self.failUnlessEqual(4, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_select_nested_m2m(self):
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            
+            entry1 = Entry.objects.create(section=section1)
+            entry2 = Entry.objects.create(section=section2)
+            entry2.tags.add(self.tag1, self.tag3)
+            
+            db.reset_queries()
+            
+            batch = Batch('entry_set__tags').order_by('id')
+            sections = Section.objects.batch_select(batch).order_by('id')
+            section1, section2 = list(sections)
+            
+            self.failUnlessEqual(3, len(db.connection.queries))
+            
+            self.failUnlessEqual([entry1], section1.entry_set_all)
+            self.failUnlessEqual([entry2], section2.entry_set_all)
+            self.failUnlessEqual([], section1.entry_set_all[0].tags_all)
+            self.failUnlessEqual(set([self.tag1, self.tag3]),
+                                 set(section2.entry_set_all[0].tags_all))
+        
+        def test_batch_select_nested_non_existant_field(self):
+            try:
+                Section.objects.batch_select('entry__qwerty')
+                self.fail('selected field that does not exist')
+            except FieldDoesNotExist:
+                pass
+        
+        def test_batch_select_nested_non_relation_field(self):
+            try:
+                Section.objects.batch_select('entry__title')
+                self.fail('selected field that is not a relationship')
+            except FieldDoesNotExist:
+                pass
+        
+        def _create_authorships(self):
+            self.author1 = Author.objects.create(name='author1')
+            self.author2 = Author.objects.create(name='author2')
+            Authorship.objects.create(entry=self.entry1, author=self.author1, lead=True)
+            Authorship.objects.create(entry=self.entry1, author=self.author2)
+            Authorship.objects.create(entry=self.entry2, author=self.author2, lead=True)
+        
+        def test_batch_through_fields(self):
+            self._create_authorships()
+            
+            batch = Batch('authors').through('lead').order_by('id')
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual([self.author1, self.author2], entry1.authors_all)
+            self.failUnlessEqual([True, False],
+                                 [bool(a.lead) for a in entry1.authors_all])
+            self.failUnlessEqual([self.author2], entry2.authors_all)
+            self.failUnlessEqual([True],
+                                 [bool(a.lead) for a in entry2.authors_all])
+            self.failUnlessEqual([], entry3.authors_all)
+        
+        @with_debug_queries
+        def test_batch_through_filter(self):
+            self._create_authorships()
+            
+            db.reset_queries()
+            
+            batch = Batch('authors').through(lead=True)
+            entries = Entry.objects.batch_select(lead_authors=batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.author1], entry1.lead_authors)
+            self.failUnlessEqual([self.author2], entry2.lead_authors)
+            self.failUnlessEqual([], entry3.lead_authors)
+        
+        def test_batch_through_not_m2m(self):
+            Section.objects.create(name='s1')
+            try:
+                list(Section.objects.batch_select(Batch('entry').through('lead')))
+                self.fail('selected through fields on a reverse foreign key')
+            except FieldDoesNotExist:
+                pass
+        
+        @with_debug_queries
+        def test_batch_iterator_window(self):
+            batch = Batch('tags').order_by('name')
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entries = entries.iterator(window=3)
+            
+            # nothing is read until we start iterating
+            self.failUnlessEqual(0, len(db.connection.queries))
+            
+            entry1 = entries.next()
+            self.failUnlessEqual(self.entry1, entry1)
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual([self.entry2, self.entry3, self.entry4],
+                                 [entry2, entry3, entry4])
+            
+            # one more batch query for the second window
+            self.failUnlessEqual(3, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag2],            entry2.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3], entry3.tags_all)
+            self.failUnlessEqual([],                     entry4.tags_all)
+        
+        @with_debug_queries
+        def test_batch_union(self):
+            self._create_authorships()
+            
+            db.reset_queries()
+            
+            entries = Entry.objects.batch_select(
+                            Batch('tags').order_by('name'),
+                            Batch('authors').through('lead').order_by('id'))\
+                        .batch_union().order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            # one query for the entries, one for both batches
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],                       entry2.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+            
+            self.failUnlessEqual([self.author1, self.author2], entry1.authors_all)
+            self.failUnlessEqual(['author1', 'author2'],
+                                 [a.name for a in entry1.authors_all])
+            self.failUnlessEqual([True, False],
+                                 [bool(a.lead) for a in entry1.authors_all])
+            self.failUnlessEqual([self.author2], entry2.authors_all)
+            self.failUnlessEqual([], entry4.authors_all)
+            
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_union_three_batches(self):
+            # padding columns have to fit the columns of every other batch,
+            # and each batch keeps its own order
+            self._create_authorships()
+            
+            db.reset_queries()
+            entries = Entry.objects.batch_select(
+                            Batch('tags').order_by('-name'),
+                            Batch('authors').through('lead').order_by('id'),
+                            Batch('authorship_set').order_by('-id'))\
+                        .batch_union().order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual(2, len(db.connection.queries))
+            self.failUnlessEqual([self.tag3, self.tag2, self.tag1], entry1.tags_all)
+            self.failUnlessEqual([self.author1, self.author2], entry1.authors_all)
+            self.failUnlessEqual(list(Authorship.objects.filter(entry=self.entry1)
+                                                        .order_by('-id')),
+                                 entry1.authorship_set_all)
+        
+        @with_debug_queries
+        def test_batch_union_falls_back(self):
+            # select_related can't be part of the union, which leaves
+            # only one batch in it, so both batches are run separately
+            batch = Batch('tags').select_related()
+            entries = Entry.objects.batch_select(batch, 'authors')\
+                        .batch_union().order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual(3, len(db.connection.queries))
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(entry1.tags_all))
+            self.failUnlessEqual([], entry1.authors_all)
+        
+        def test_batch_values_list(self):
+            batch = Batch('tags').order_by('name').values_list('id', 'name')
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual([(self.tag1.id, 'tag1'), (self.tag2.id, 'tag2'),
+                                  (self.tag3.id, 'tag3')],
+                                 [tuple(row) for row in entry1.tags_all])
+            self.failUnlessEqual([(self.tag2.id, 'tag2')],
+                                 [tuple(row) for row in entry2.tags_all])
+            self.failUnlessEqual([], entry4.tags_all)
+        
+        def test_batch_values_list_flat(self):
+            batch = Batch('tags').order_by('name').values_list('name', flat=True)
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual(['tag1', 'tag2', 'tag3'], entry1.tags_all)
+            self.failUnlessEqual(['tag2', 'tag3'],         entry3.tags_all)
+            self.failUnlessEqual([],                       entry4.tags_all)
+        
+        def test_batch_values(self):
+            batch = Batch('tags').order_by('name').values('name')
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual([{'name': 'tag2'}], entry2.tags_all)
+            self.failUnlessEqual([{'name': 'tag2'}, {'name': 'tag3'}],
+                                 entry3.tags_all)
+        
+        def test_batch_ids(self):
+            batch = Batch('tags').order_by('id').ids()
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnless(isinstance(entry1.tags_all, array))
+            self.failUnlessEqual([self.tag2.id, self.tag1.id, self.tag3.id],
+                                 list(entry1.tags_all))
+            self.failUnlessEqual([self.tag2.id], list(entry2.tags_all))
+            self.failUnlessEqual([], list(entry4.tags_all))
+        
+        def test_batch_ids_non_integer(self):
+            from batch_select.models import batch_select
+            uk = Country.objects.create(name='United Kingdom')
+            brighton = Location.objects.create(name='Brighton')
+            uk.locations.add(brighton)
+            
+            brighton, = batch_select(Location, [brighton], 'country_ids',
+                                     'country', projection=('ids',))
+            self.failUnlessEqual(['United Kingdom'], brighton.country_ids)
+        
+        def test_batch_values_with_path(self):
+            Section.objects.create(name='s1')
+            batch = Batch('entry__tags').values('name')
+            try:
+                list(Section.objects.batch_select(batch))
+                self.fail('selected values for a path')
+            except ValueError:
+                pass
+        
+        @with_debug_queries
+        def test_batch_count(self):
+            entries = Entry.objects.batch_count('tags').order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual(2, len(db.connection.queries))
+            self.failUnlessEqual([3, 1, 2, 0],
+                                 [e.tags_count for e in entry1, entry2, entry3, entry4])
+        
+        def test_batch_count_named(self):
+            entries = Entry.objects.batch_count(tag3s=Batch('tags', name='tag3'))\
+                                   .order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual([1, 0, 1, 0],
+                                 [e.tag3s for e in entry1, entry2, entry3, entry4])
+        
+        def test_batch_count_reverse_foreign_key(self):
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            Entry.objects.filter(id__in=[self.entry1.id, self.entry2.id])\
+                         .update(section=section1)
+            
+            sections = Section.objects.batch_count('entry_set').order_by('id')
+            section1, section2 = list(sections)
+            
+            self.failUnlessEqual(2, section1.entry_set_count)
+            self.failUnlessEqual(0, section2.entry_set_count)
+        
+        @with_debug_queries
+        def test_batch_aggregate(self):
+            entries = Entry.objects.batch_aggregate('tags', Max('name'),
+                                                    first=Min('name'))\
+                                   .order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual(2, len(db.connection.queries))
+            self.failUnlessEqual('tag3', entry1.name_max)
+            self.failUnlessEqual('tag1', entry1.first)
+            self.failUnlessEqual('tag2', entry3.first)
+            self.failUnlessEqual(None,   entry4.name_max)
+            self.failUnlessEqual(None,   entry4.first)
+        
+        @with_debug_queries
+        def test_batch_cache(self):
+            cache.clear()
+            batch = Batch('tags').order_by('name').cache()
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            # only the entries are queried the second time
+            entry1, entry2, entry3, entry4 = list(entries.all())
+            self.failUnlessEqual(3, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+        
+        def test_batch_cache_variants(self):
+            cache.clear()
+            tag2s = Batch('tags', name='tag2').cache()
+            entries = Entry.objects.batch_select('tags', tag2s=tag2s).order_by('id')
+            list(entries)
+            
+            entries = Entry.objects.batch_select(Batch('tags').cache()).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(entry1.tags_all))
+            
+            entries = Entry.objects.batch_select(tag2s=tag2s).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual([self.tag2], entry1.tag2s)
+            self.failUnlessEqual([],          entry4.tag2s)
+        
+        def test_batch_cache_m2m_changed(self):
+            cache.clear()
+            entries = Entry.objects.batch_select(Batch('tags').cache()).order_by('id')
+            list(entries)
+            
+            self.entry1.tags.remove(self.tag1)
+            self.tag3.entry_set.add(self.entry2)
+            
+            entry1, entry2, entry3, entry4 = list(entries.all())
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(entry1.tags_all))
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(entry2.tags_all))
+        
+        def test_batch_cache_related_saved(self):
+            cache.clear()
+            entries = Entry.objects.batch_select(Batch('tags').cache()).order_by('id')
+            list(entries)
+            
+            self.tag2.name = 'renamed'
+            self.tag2.save()
+            self.tag3.delete()
+            
+            entry1, entry2, entry3, entry4 = list(entries.all())
+            self.failUnlessEqual(['renamed'], [tag.name for tag in entry3.tags_all])
+        
+        def test_batch_cache_reverse_foreign_key(self):
+            cache.clear()
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            self.entry1.section = section1
+            self.entry1.save()
+            
+            sections = Section.objects.batch_select(Batch('entry_set').cache())\
+                                      .order_by('id')
+            section1, section2 = list(sections)
+            self.failUnlessEqual([self.entry1], section1.entry_set_all)
+            
+            # moving an entry changes both sections
+            self.entry1.section = section2
+            self.entry1.save()
+            
+            section1, section2 = list(sections.all())
+            self.failUnlessEqual([],            section1.entry_set_all)
+            self.failUnlessEqual([self.entry1], section2.entry_set_all)
+        
+        def test_batch_cache_invalidated_while_selecting(self):
+            from batch_select.cache import BatchCache
+            from batch_select.models import _Relation
+            cache.clear()
+            relation = _Relation(Entry, 'tags')
+            batch_cache = BatchCache(Entry, relation, 'variant')
+            self.failUnlessEqual({}, batch_cache.get_many([self.entry1.pk]))
+            
+            # what was selected before the change isn't read back
+            self.tag1.name = 'renamed'
+            self.tag1.save()
+            batch_cache.set_many({ self.entry1.pk: [self.tag1] })
+            batch_cache = BatchCache(Entry, relation, 'variant')
+            self.failUnlessEqual({}, batch_cache.get_many([self.entry1.pk]))
+        
+        def test_batch_cache_watch(self):
+            from batch_select.cache import watch, _watchers
+            watch(Location, 'country_set')
+            
+            # looked up on the next save, without being selected first
+            Location.objects.create(name='brighton')
+            self.failUnless((Location, 'country') in _watchers)
+        
+        def test_batch_equality(self):
+            self.failUnlessEqual(Batch('tags', name='tag1').order_by('id'),
+                                 Batch('tags', name='tag1').order_by('id'))
+            self.failUnlessEqual(hash(Batch('tags').through(primary=True)),
+                                 hash(Batch('tags').through(primary=True)))
+            self.failIfEqual(Batch('tags'), Batch('tags', name='tag1'))
+            self.failIfEqual(Batch('tags'), Batch('tags').chunked(10))
+            self.failIfEqual(Batch('tags'), Batch('entry'))
+        
+        @with_debug_queries
+        def test_batch_select_duplicate_batches(self):
+            entries = Entry.objects.batch_select(Batch('tags', name='tag1'),
+                                                 Batch('tags', name='tag1'))
+            entries = list(entries.batch_select(Batch('tags', name='tag1')))
+            
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_sql_template(self):
+            _sql_templates.clear()
+            batch = Batch('tags').order_by('name')
+            
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual(1, len(_sql_templates))
+            
+            entries = Entry.objects.batch_select(Batch('tags').order_by('name'))\
+                                   .filter(id__in=[self.entry1.id, self.entry3.id])\
+                                   .order_by('id')
+            entry1, entry3 = list(entries)
+            self.failUnlessEqual(1, len(_sql_templates))
+            self.failUnlessEqual(4, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual(self.entry3.id,
+                                 getattr(entry3.tags_all[0], '__entry_id'))
+        
+        def test_batch_sql_template_non_id_primary_key(self):
+            _sql_templates.clear()
+            uk = Country.objects.create(name='United Kingdom')
+            brighton = Location.objects.create(name='Brighton')
+            uk.locations.add(brighton)
+            
+            for _ in xrange(2):
+                countries = list(Country.objects.batch_select('locations'))
+                self.failUnlessEqual([brighton], countries[0].locations_all)
+        
+        @with_debug_queries
+        def test_batch_prefetch(self):
+            batch = Batch('tags').order_by('name').prefetch()
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            db.reset_queries()
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3],
+                                 list(entry1.tags.all()))
+            self.failUnlessEqual([self.tag2], list(entry2.tags.all()))
+            self.failUnlessEqual([], list(entry4.tags.all()))
+            self.failUnlessEqual(0, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_prefetch_reverse_foreign_key(self):
+            section = Section.objects.create(name='s1')
+            self.entry2.section = section
+            self.entry2.save()
+            
+            sections = Section.objects.batch_select(Batch('entry_set').prefetch())
+            section = list(sections)[0]
+            
+            db.reset_queries()
+            self.failUnlessEqual([self.entry2], list(section.entry_set.all()))
+            self.failUnlessEqual(0, len(db.connection.queries))
+        
+        def test_batch_prefetch_filtered(self):
+            try:
+                Entry.objects.batch_select(Batch('tags', name='tag1').prefetch())
+                self.fail('prefetched a filtered batch')
+            except ValueError:
+                pass
+        
+        @with_debug_queries
+        def test_batch_lazy(self):
+            batch = Batch('tags').order_by('name').lazy()
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual(1, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag2, self.tag3], entry3.tags_all)
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            # the other entries were filled in by the same query
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2], entry2.tags_all)
+            self.failUnlessEqual([],          entry4.tags_all)
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_lazy_aggregate(self):
+            entries = Entry.objects.batch_count(Batch('tags').lazy()).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual(1, len(db.connection.queries))
+            
+            self.failUnlessEqual([3, 1, 2, 0],
+                                 [e.tags_count for e in entry1, entry2, entry3, entry4])
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_batch_lazy_not_batch_selected(self):
+            list(Entry.objects.batch_select(Batch('tags').lazy()))
+            entry = Entry.objects.get(id=self.entry1.id)
+            self.failIf(hasattr(entry, 'tags_all'))
+        
+        def test_batch_lazy_existing_attribute(self):
+            try:
+                Entry.objects.batch_select(title=Batch('tags').lazy())
+                self.fail('replaced an attribute with a lazy batch')
+            except ValueError:
+                pass
+        
+        @with_debug_queries
+        def test_batch_subquery(self):
+            entries = Entry.objects.batch_select(Batch('tags').order_by('name'))\
+                                   .batch_subquery(2).order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            
+            self.failUnlessEqual(2, len(db.connection.queries))
+            # the entries query is part of the tags query
+            self.failUnlessEqual(2, db.connection.queries[-1]['sql'].count('SELECT'))
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+        
+        @with_debug_queries
+        def test_batch_subquery_below_threshold(self):
+            entries = Entry.objects.batch_select('tags')\
+                                   .batch_subquery(5).order_by('id')
+            list(entries)
+            self.failUnlessEqual(1, db.connection.queries[-1]['sql'].count('SELECT'))
+        
+        @with_debug_queries
+        def test_batch_subquery_sliced(self):
+            entries = Entry.objects.batch_select('tags')\
+                                   .batch_subquery().order_by('id')[1:3]
+            entry2, entry3 = list(entries)
+            self.failUnlessEqual(1, db.connection.queries[-1]['sql'].count('SELECT'))
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(entry3.tags_all))
+        
+        def test_batch_selected_signal(self):
+            sent = []
+            def receiver(sender, **kwargs):
+                sent.append(dict(kwargs, sender=sender))
+            batch_selected.connect(receiver)
+            try:
+                list(Entry.objects.batch_select(Batch('tags').chunked(3)))
+            finally:
+                batch_selected.disconnect(receiver)
+            
+            self.failUnlessEqual(1, len(sent))
+            sent = sent[0]
+            self.failUnlessEqual(Entry,      sent['sender'])
+            self.failUnlessEqual('tags',     sent['relation'])
+            self.failUnlessEqual('tags_all', sent['target'])
+            self.failUnlessEqual(4,          sent['parents'])
+            self.failUnlessEqual(4,          sent['ids'])
+            self.failUnlessEqual(6,          sent['rows'])
+            self.failUnlessEqual(2,          sent['queries'])
+            self.failUnlessEqual(2,          len(sent['sql']))
+            self.failIf(sent['union'])
+        
+        def test_batch_summary_middleware(self):
+            from django.test.client import RequestFactory
+            from django.http import HttpResponse
+            from batch_select.instrumentation import BatchSelectSummaryMiddleware,\
+                                                     current_summary
+            
+            middleware = BatchSelectSummaryMiddleware()
+            request = RequestFactory().get('/entries/')
+            middleware.process_request(request)
+            list(Entry.objects.batch_select('tags', 'authors'))
+            
+            totals = current_summary().totals()
+            self.failUnlessEqual(2, totals['batches'])
+            self.failUnlessEqual(6, totals['rows'])
+            
+            middleware.process_response(request, HttpResponse())
+            self.failUnlessEqual(None, current_summary())
+        
         def test_batch_select_reverse_m2m(self):
             entry1, entry2, entry3, entry4 = _create_entries(4)
             tag1, tag2, tag3 = _create_tags('tag1', 'tag2', 'tag3')
@@ -532,6 +1194,37 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
             self.failUnlessEqual(set([brighton, hove]), set(uk.locations_all))
 
 
+    class TestBenchmark(TransactionTestCase):
+        
+        def test_run_benchmarks(self):
+            from batch_select.benchmarks import EntryDataset
+            from batch_select.harness import run_benchmarks
+            
+            report = run_benchmarks([EntryDataset(tags=4, tags_per_entry=2, sections=2)],
+                                    sizes=(5,), fork=False)
+            results = dict((result['scenario'], result)
+                           for result in report['results'])
+            
+            self.failUnlessEqual(6, results['n+1']['queries'])
+            self.failUnlessEqual(2, results['batch_select']['queries'])
+            self.failUnlessEqual(2, results['prefetch_related']['queries'])
+            # 5 entries and their 10 tags
+            self.failUnlessEqual(15, results['batch_select']['rows'])
+            self.failUnlessEqual(0, Entry.objects.count())
+            # the connection's own cursor method is back
+            self.failIf('cursor' in db.connections[db.DEFAULT_DB_ALIAS].__dict__)
+        
+        def test_run_benchmarks_naive_limit(self):
+            from batch_select.benchmarks import EntryDataset
+            from batch_select.harness import run_benchmarks
+            
+            report = run_benchmarks([EntryDataset(tags=2, tags_per_entry=1, sections=1)],
+                                    sizes=(3,), naive_limit=2, fork=False)
+            results = dict((result['scenario'], result)
+                           for result in report['results'])
+            self.failUnless(results['n+1']['skipped'])
+            self.failIf('skipped' in results['batch_select'])
+    
     class ReplayTestCase(unittest.TestCase):
         
         def setUp(self):
@@ -567,6 +1260,23 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
                                   ('replace', ('id',), {})],
                                  r.upper(name__contains='test').replace('id')._replays)
         
+        def test_replay_equality(self):
+            r = self.instance
+            self.failUnlessEqual(r.upper(1, param='s'), r.upper(1, param='s'))
+            self.failUnlessEqual(hash(r.upper(1, param='s')),
+                                 hash(r.upper(1, param='s')))
+            self.failIfEqual(r.upper(1), r.upper(2))
+            self.failIfEqual(r.upper(), r.lower())
+            self.failUnlessEqual(1, len(set([r.replace(['a']), r.replace(['a'])])))
+
+        def test_replay_equality_frozen_like_batch(self):
+            r = self.instance
+            self.failUnlessEqual(r.replace(set(['a', 'b'])),
+                                 r.replace(frozenset(['b', 'a'])))
+            self.failUnlessEqual(r.upper(Tag(id=1, name='a')),
+                                 r.upper(Tag(id=1, name='b')))
+            self.failIfEqual(r.upper(Tag(id=1)), r.upper(Tag(id=2)))
+
         def test_replay_no_replay(self):
             r = self.instance
             s = 'gfjhGF&'
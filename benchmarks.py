@@ -0,0 +1,84 @@
+# Roster benchmark datasets, see batch_select.harness
+from roster.models import Person, Phone, PersonPhone
+from batch_select.harness import Dataset, bulk_create
+from batch_select.models import Batch
+
+class PersonDataset(Dataset):
+    """People with phones_per_person phones each, as on the phone and
+    contact lists."""
+    name = 'people'
+    models = (Phone, Person, PersonPhone)
+
+    def __init__(self, phones_per_person=2):
+        self.phones_per_person = phones_per_person
+
+    def build(self, parents):
+        person_ids = bulk_create(Person,
+                [Person(firstname='First%d' % i, lastname='Last%d' % i,
+                        gender=i % 2 and 'M' or 'F')
+                 for i in xrange(parents)])
+        locations = [x[0] for x in Phone.LOCATION_CHOICES]
+        phone_ids = bulk_create(Phone,
+                [Phone(phone='555-%03d-%04d' % divmod(i, 10000),
+                       location=locations[i % len(locations)])
+                 for i in xrange(parents * self.phones_per_person)])
+        bulk_create(PersonPhone,
+                [PersonPhone(person_id=person_id,
+                             phone_id=phone_ids[i*self.phones_per_person + j],
+                             primary=(j == 0))
+                 for i, person_id in enumerate(person_ids)
+                 for j in xrange(self.phones_per_person)])
+
+    def scenarios(self):
+        def naive():
+            for person in Person.objects.all():
+                for phone in person.phones.all():
+                    phone.render_normal()
+
+        def batch_select():
+            for person in Person.objects.batch_select('phones'):
+                for phone in person.phones_all:
+                    phone.render_normal()
+
+        def batch_select_values():
+            phones = Batch('phones').values_list('phone', 'ext', 'location')
+            for person in Person.objects.batch_select(phones):
+                for number, ext, location in person.phones_all:
+                    pass
+
+        def batch_select_chunked():
+            for person in Person.objects.batch_select(Batch('phones').chunked(1000)):
+                for phone in person.phones_all:
+                    phone.render_normal()
+
+        def batch_select_windowed():
+            for person in Person.objects.batch_select('phones').iterator(window=1000):
+                for phone in person.phones_all:
+                    phone.render_normal()
+
+        def batch_select_subquery():
+            for person in Person.objects.batch_select('phones').batch_subquery():
+                for phone in person.phones_all:
+                    phone.render_normal()
+
+        def batch_count():
+            for person in Person.objects.batch_count('phones'):
+                person.phones_count
+
+        def prefetch_related():
+            for person in Person.objects.prefetch_related('phones'):
+                for phone in person.phones.all():
+                    phone.render_normal()
+
+        return [
+            ('n+1', naive),
+            ('batch_select', batch_select),
+            ('batch_select_values', batch_select_values),
+            ('batch_select_chunked', batch_select_chunked),
+            ('batch_select_windowed', batch_select_windowed),
+            ('batch_select_subquery', batch_select_subquery),
+            ('batch_count', batch_count),
+            ('prefetch_related', prefetch_related),
+        ]
+
+datasets = [PersonDataset()]
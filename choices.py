@@ -0,0 +1,34 @@
+# Choices for form fields, read from the database when a form is made
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from roster.models import Team
+from roster.versioned import ProcessIndex
+
+class TeamChoices(object):
+    """The teams, by name."""
+    def __init__(self, teams):
+        self.teams = teams
+
+    @classmethod
+    def load(cls):
+        return cls(list(Team.objects.order_by('name')
+                                    .values_list('id', 'name', 'reg_show')))
+
+    def choices(self, reg_show_only=False):
+        return [(id, name) for id, name, reg_show in self.teams
+                if reg_show or not reg_show_only]
+
+# loaded once per process, and again after any process saves or deletes
+# a team
+_teams = ProcessIndex('roster:teams:version', TeamChoices.load)
+
+def team_choices(reg_show_only=False):
+    """(id, name) choices of the teams (only those shown on the
+    registration form if reg_show_only)."""
+    return _teams.get().choices(reg_show_only)
+
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+def _team_changed(sender, **kwargs):
+    _teams.changed()
@@ -1,4 +1,8 @@
 from django import forms
+from django.core.urlresolvers import reverse
+from django.forms.util import flatatt
+from django.utils.encoding import force_unicode
+from django.utils.safestring import mark_safe
 import datetime
 import time
 import settings
@@ -26,3 +30,40 @@ class USDateFormField(forms.DateField):
                 continue
         raise forms.util.ValidationError(self.error_messages['invalid'])
 
+
+class LookupWidget(forms.Widget):
+    """A text box to type a name in, which looks up matches as it's typed
+    (with jQuery UI autocomplete, from the JSON view named url_name),
+    and a hidden input holding the pk of the one picked."""
+    def __init__(self, url_name, attrs=None):
+        super(LookupWidget, self).__init__(attrs)
+        self.url_name = url_name
+
+    def render(self, name, value, attrs=None):
+        if value in forms.fields.EMPTY_VALUES:
+            value = ''
+        # the name of what's picked, looked up by pk (the choices are a
+        # ModelChoiceField's, which are never listed)
+        label = ''
+        queryset = getattr(self.choices, 'queryset', None)
+        if value and queryset is not None:
+            try:
+                label = force_unicode(queryset.get(pk=value))
+            except (queryset.model.DoesNotExist, ValueError):
+                pass
+        final_attrs = self.build_attrs(attrs, type='hidden', name=name,
+                                       value=force_unicode(value))
+        id = final_attrs.get('id', 'id_%s' % name)
+        lookup_attrs = {'type': 'text', 'id': '%s_lookup' % id,
+                        'class': 'lookup', 'value': label,
+                        'data-source': reverse(self.url_name),
+                        'data-target': id}
+        return mark_safe(u'<input%s /><input%s />' %
+                         (flatatt(lookup_attrs), flatatt(final_attrs)))
+
+class LookupField(forms.ModelChoiceField):
+    """A ModelChoiceField picked from with a LookupWidget, so the choices
+    are never all loaded: only the one picked, by its pk."""
+    def __init__(self, queryset, url_name, *args, **kwargs):
+        kwargs.setdefault('widget', LookupWidget(url_name))
+        super(LookupField, self).__init__(queryset, *args, **kwargs)
@@ -4,6 +4,8 @@ from roster.models import *
 from django.contrib.localflavor.us.us_states import STATE_CHOICES
 from django.contrib.localflavor.us.forms import *
 from django.utils.safestring import mark_safe
+from roster.fields import LookupField
+from roster.choices import team_choices
 
 class HorizRadioRenderer(forms.RadioSelect.renderer):
     """ this overrides widget method to put radio buttons horizontally
@@ -13,7 +15,16 @@ class HorizRadioRenderer(forms.RadioSelect.renderer):
             """Outputs radios"""
             return mark_safe(u'\n'.join([u'%s\n' % w for w in self]))
 
-class TeamReportForm(forms.Form):
+class TeamChoicesForm(forms.Form):
+    """A form with a team field, given the current teams as choices
+    each time the form is made rather than once at import."""
+    reg_show_only = False
+
+    def __init__(self, *args, **kwargs):
+        super(TeamChoicesForm, self).__init__(*args, **kwargs)
+        self.fields['team'].choices = team_choices(self.reg_show_only)
+
+class TeamReportForm(TeamChoicesForm):
     who = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
         choices=(
@@ -31,7 +42,7 @@ class TeamReportForm(forms.Form):
 
     team = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
-        choices=[(x.id, x.name) for x in Team.objects.all()])
+        choices=())
 
 class EmailListForm(TeamReportForm):
     cc_on_email = forms.BooleanField(label="Include Parent CC",
@@ -54,7 +65,7 @@ class ContactListForm(TeamReportForm):
 class TshirtListForm(TeamReportForm):
     pass
 
-class HoursListForm(forms.Form):
+class HoursListForm(TeamChoicesForm):
     who = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
         choices=(
@@ -65,7 +76,7 @@ class HoursListForm(forms.Form):
 
     team = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
-        choices=[(x.id, x.name) for x in Team.objects.all()])
+        choices=())
 
     from_date = forms.DateField(required=False)
     to_date = forms.DateField(required=False)
@@ -91,7 +102,7 @@ class EventEmailListForm(forms.Form):
         initial=',',
         required=False)
 
-class TeamRegVerifyForm(forms.Form):
+class TeamRegVerifyForm(TeamChoicesForm):
     who = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
         choices=(
@@ -102,7 +113,7 @@ class TeamRegVerifyForm(forms.Form):
 
     team = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
-        choices=[(x.id, x.name) for x in Team.objects.all()])
+        choices=())
 
 class TeamMembershipForm(forms.Form):
     team = forms.ModelChoiceField(
@@ -114,7 +125,7 @@ class ClassTeamListForm(forms.Form):
     class_begin = forms.IntegerField(label="Beginning class")
     class_end = forms.IntegerField(label="Ending class")
 
-class BadgesForm(forms.Form):
+class BadgesForm(TeamChoicesForm):
     who = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
         choices=(
@@ -125,9 +136,11 @@ class BadgesForm(forms.Form):
 
     team = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
-        choices=[(x.id, x.name) for x in Team.objects.all()])
+        choices=())
+
+class NewYearForm(TeamChoicesForm):
+    reg_show_only = True
 
-class NewYearForm(forms.Form):
     who = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
         choices=(
@@ -138,7 +151,7 @@ class NewYearForm(forms.Form):
 
     team = forms.MultipleChoiceField(
         widget=forms.CheckboxSelectMultiple,
-        choices=[(x.id, x.name) for x in Team.objects.filter(reg_show=True)])
+        choices=())
 
 class AddressForm(forms.ModelForm):
     class Meta:
@@ -157,9 +170,8 @@ class RegInitialForm(forms.Form):
         ),
         initial='returning')
 
-    person = forms.ModelChoiceField(
-        required=False,
-        queryset=Person.objects.all())
+    person = LookupField(Person.objects.all(), 'person_search',
+                         required=False)
 
     def clean(self):
         cleaned_data = super(RegInitialForm, self).clean()
@@ -167,7 +179,7 @@ class RegInitialForm(forms.Form):
         person = None
         if usertype == 'returning':
             person = cleaned_data.get("person")
-            if person is None:
+            if person is None and "person" not in self._errors:
                 self._errors["person"] = self.error_class(["Must select person if returning."])
         if person is None:
             person = Person()
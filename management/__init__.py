@@ -0,0 +1,7 @@
+from django.db.models.signals import post_syncdb
+
+from roster import models
+from roster.versioned import create_versions
+
+post_syncdb.connect(create_versions, sender=models,
+                    dispatch_uid='roster.versioned.create_versions')
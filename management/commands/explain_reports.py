@@ -0,0 +1,135 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from roster.models import *
+from roster.audience import Audience
+from roster.views import email_list_results, contact_list_results, \
+        hours_list_results
+
+from optparse import make_option
+
+class _RecordingCursor(object):
+    """A cursor that notes the (sql, params) of each query it runs."""
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        self.queries.append((sql, params))
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.queries.extend((sql, params) for params in param_list)
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def _run(report):
+    """Runs report (a function the way a view gets its results) and
+    returns the (sql, params) of each query it ran."""
+    # the views use the default database; patch the connection itself
+    # (as django.db.connection is a proxy), with an instance attribute
+    # that hides its cursor method until it's deleted again
+    wrapper = connections[DEFAULT_DB_ALIAS]
+    queries = []
+    cursor = wrapper.cursor
+    wrapper.cursor = lambda: _RecordingCursor(cursor(), queries)
+    try:
+        report()
+    finally:
+        del wrapper.cursor
+    return queries
+
+def report_queries(roles, status, teams):
+    """The reports behind the views for the given roles, statuses and
+    teams, as (view, report) pairs, where report gets the results the
+    way the view does (through the same functions)."""
+    return [
+        ('email_list', lambda: list(email_list_results(
+                Audience(roles, status, teams, parents=True,
+                         cc_on_email=True)))),
+        ('contact_list', lambda: list(contact_list_results(
+                Audience(roles, status, teams, parents=True),
+                status, teams))),
+        ('hours_list', lambda: list(hours_list_results(
+                Audience(roles, ['Active'], teams)))),
+        ('badges', lambda: list(Audience(roles, ['Active'], teams).people())),
+        ('signin_person_list', lambda: list(Person.objects.all())),
+    ]
+
+def _explain(connection, sql, params):
+    """Returns the plan of a query as lines of text, and the tables it
+    reads all of."""
+    cursor = connection.cursor()
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        # rows of (id, parent, notused, detail), where a full scan is
+        # "SCAN TABLE x" (or "SCAN x"), not followed by "USING ... INDEX"
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        lines = [row[-1] for row in cursor.fetchall()]
+        scans = [line.replace('SCAN TABLE ', 'SCAN ').split()[1]
+                 for line in lines
+                 if line.startswith('SCAN ') and 'INDEX' not in line and
+                    'SUBQUERY' not in line]
+    elif vendor == 'mysql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [x[0] for x in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        lines = [', '.join('%s=%s' % (x, row[x]) for x in columns)
+                 for row in rows]
+        scans = [row['table'] for row in rows if row['type'] == 'ALL']
+    elif vendor == 'postgresql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        lines = [row[0] for row in cursor.fetchall()]
+        scans = [line.split('Seq Scan on ')[1].split()[0]
+                 for line in lines if 'Seq Scan on ' in line]
+    else:
+        raise CommandError("Don't know how to explain queries on %s" % vendor)
+    return lines, scans
+
+class Command(BaseCommand):
+    help = ('Runs the email, contact, hours, badge and sign-in lists the way '
+            'their views do, explains each query they run and flags the '
+            'tables those scan in full. Queries answered from the cache (a '
+            'resolved audience, cached batches) are not run, so not '
+            'explained. Run it against a database with realistic data, as '
+            'planners pick sequential scans for small tables whatever the '
+            'indexes.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--team', action='append', dest='teams', default=[],
+            help='Team id to report on (can be given more than once, '
+                 'defaults to all).'),
+        make_option('--who', action='append', dest='roles', default=[],
+            help='Role to report on (defaults to all).'),
+        make_option('--status', action='append', dest='status', default=[],
+            help='Membership status to report on (defaults to Active).'),
+    )
+
+    def handle(self, *args, **options):
+        connection = connections[DEFAULT_DB_ALIAS]
+        teams = options['teams'] or \
+                list(Team.objects.values_list('id', flat=True))
+        roles = options['roles'] or [x[0] for x in PersonTeam.ROLE_CHOICES]
+        status = options['status'] or ['Active']
+
+        flagged = 0
+        for view, report in report_queries(roles, status, teams):
+            for i, (sql, params) in enumerate(_run(report)):
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                lines, scans = _explain(connection, sql, params)
+                self.stdout.write('%s: query %d\n' % (view, i + 1))
+                self.stdout.write('    %s\n    params: %r\n' % (sql, params))
+                for line in lines:
+                    self.stdout.write('    %s\n' % line)
+                for table in scans:
+                    self.stdout.write('    SEQUENTIAL SCAN of %s\n' % table)
+                self.stdout.write('\n')
+                flagged += bool(scans)
+        self.stdout.write('%d quer%s with sequential scans\n' %
+                          (flagged, flagged == 1 and 'y' or 'ies'))
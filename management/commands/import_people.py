@@ -0,0 +1,261 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.localflavor.us.forms import USPhoneNumberField
+from django.db import transaction
+
+from optparse import make_option
+from itertools import islice
+import csv
+import sys
+import time
+
+from roster.models import *
+from roster import audience, search
+
+PERSON_COLUMNS = ['firstname', 'lastname', 'suffix', 'nickname', 'gender',
+                  'grad_year', 'birth_year', 'birth_month', 'birth_day',
+                  'shirt_size', 'medical', 'medications']
+ADDRESS_COLUMNS = ['line1', 'line2', 'city', 'state', 'zipcode']
+PHONE_LOCATIONS = [x[0] for x in Phone.LOCATION_CHOICES]
+
+def _bulk_create(model, instances, size=100):
+    # in slices, so no one insert has too many parameters for the database
+    for i in xrange(0, len(instances), size):
+        model.objects.bulk_create(instances[i:i+size])
+
+def _build(model, row, columns, exclude=None):
+    """An instance of model from the given columns of row, validated
+    field by field (clean_fields doesn't query, unlike full_clean's
+    uniqueness checks)."""
+    values = {}
+    for name in columns:
+        value = row.get(name, '')
+        field = model._meta.get_field(name)
+        if value == '' and field.null:
+            value = None
+        values[name] = value
+    instance = model(**values)
+    instance.clean_fields(exclude)
+    return instance
+
+def _address_key(address):
+    return tuple(getattr(address, name) for name in ADDRESS_COLUMNS)
+
+class Importer(object):
+    """Imports people from CSV rows in batches.  What's already in the
+    database (people, emails, phones and addresses) is loaded into
+    dicts once, so rows are deduplicated without a query each, and each
+    batch is written with bulk_create."""
+    def __init__(self, team=None, role=None, status='Active', dry_run=False):
+        self.team = team
+        self.role = role
+        self.status = status
+        self.dry_run = dry_run
+        self.phone_field = USPhoneNumberField(required=False)
+        self.teams = dict((x.name, x.id) for x in Team.objects.all())
+        self.people = set(Person.objects.values_list('firstname', 'lastname',
+                                                     'suffix'))
+        self.emails = dict((email.lower(), id) for email, id in
+                           Email.objects.values_list('email', 'id'))
+        self.phones = dict(((phone, ext), id) for phone, ext, id in
+                           Phone.objects.values_list('phone', 'ext', 'id'))
+        self.addresses = dict((values[:-1], values[-1]) for values in
+                              Address.objects.values_list(*(ADDRESS_COLUMNS + ['id'])))
+        self.created = 0
+        self.errors = []
+
+    def clean_row(self, row):
+        """Returns what's to be imported for a row (with its values
+        stripped), raising ValidationError if it isn't valid."""
+        row = dict((key.strip(), (value or '').decode('utf-8').strip())
+                   for key, value in row.items() if key)
+        person = _build(Person, row, [x for x in PERSON_COLUMNS if x in row])
+        key = (person.firstname, person.lastname, person.suffix)
+        if key in self.people:
+            raise ValidationError('%s %s %s is already in the roster' % key)
+
+        email = row.get('email', '')
+        if email:
+            email = _build(Email, {'email': email,
+                                   'location': row.get('email_location') or 'Other'},
+                           ['email', 'location'])
+
+        phones = []
+        for location in PHONE_LOCATIONS:
+            number = self.phone_field.clean(row.get('%s_phone' % location.lower(), ''))
+            if number:
+                phones.append(_build(Phone, {
+                        'phone': number,
+                        'ext': row.get('%s_ext' % location.lower(), ''),
+                        'location': location}, ['phone', 'ext', 'location']))
+        primary_phone = row.get('primary_phone') or \
+                (phones and phones[0].location)
+
+        address = None
+        if row.get('line1'):
+            address = _build(Address, row, ADDRESS_COLUMNS)
+
+        team = row.get('team') or self.team
+        membership = None
+        if team:
+            if team not in self.teams:
+                raise ValidationError('No team named %s' % team)
+            membership = _build(PersonTeam, {
+                    'role': row.get('role') or self.role or '',
+                    'status': row.get('status') or self.status},
+                    ['role', 'status'], exclude=['person', 'team'])
+            membership.team_id = self.teams[team]
+        return person, email, phones, primary_phone, address, membership
+
+    def import_rows(self, rows, first_line):
+        """Validates and imports a batch of rows, the first of which is
+        line first_line of the file."""
+        batch = []
+        for line, row in enumerate(rows, first_line):
+            try:
+                cleaned = self.clean_row(row)
+            except ValidationError, e:
+                if hasattr(e, 'message_dict'):
+                    messages = ['%s: %s' % (name, ' '.join(errors))
+                                for name, errors in e.message_dict.items()]
+                else:
+                    messages = e.messages
+                self.errors.append((line, '; '.join(messages)))
+                continue
+            person = cleaned[0]
+            self.people.add((person.firstname, person.lastname, person.suffix))
+            batch.append(cleaned)
+        if batch and not self.dry_run:
+            self.save(batch)
+        self.created += len(batch)
+
+    @transaction.commit_on_success
+    def save(self, batch):
+        # new emails, phones and addresses, once each however many rows
+        # (in this batch or already in the database) share them
+        new_emails, new_phones, new_addresses = {}, {}, {}
+        for person, email, phones, primary_phone, address, membership in batch:
+            if email and email.email.lower() not in self.emails:
+                new_emails.setdefault(email.email.lower(), email)
+            for phone in phones:
+                if (phone.phone, phone.ext) not in self.phones:
+                    new_phones.setdefault((phone.phone, phone.ext), phone)
+            if address and _address_key(address) not in self.addresses:
+                new_addresses.setdefault(_address_key(address), address)
+
+        _bulk_create(Email, new_emails.values())
+        _bulk_create(Phone, new_phones.values())
+        _bulk_create(Address, new_addresses.values())
+        _bulk_create(Person, [x[0] for x in batch])
+
+        # bulk_create doesn't give back pks, so look them up (by the
+        # unique columns, in slices small enough for any database)
+        for i in xrange(0, len(new_emails), 500):
+            emails = [x.email for x in new_emails.values()[i:i+500]]
+            for email, id in Email.objects.filter(email__in=emails)\
+                    .values_list('email', 'id'):
+                self.emails[email.lower()] = id
+        for i in xrange(0, len(new_phones), 500):
+            numbers = set(x[0] for x in new_phones.keys()[i:i+500])
+            for phone, ext, id in Phone.objects.filter(phone__in=numbers)\
+                    .values_list('phone', 'ext', 'id'):
+                self.phones[(phone, ext)] = id
+        for i in xrange(0, len(new_addresses), 500):
+            lines = set(x[0] for x in new_addresses.keys()[i:i+500])
+            for values in Address.objects.filter(line1__in=lines)\
+                    .values_list(*(ADDRESS_COLUMNS + ['id'])):
+                self.addresses[values[:-1]] = values[-1]
+        person_ids = {}
+        for i in xrange(0, len(batch), 500):
+            lastnames = set(x[0].lastname for x in batch[i:i+500])
+            for firstname, lastname, suffix, id in Person.objects\
+                    .filter(lastname__in=lastnames)\
+                    .values_list('firstname', 'lastname', 'suffix', 'id'):
+                person_ids[(firstname, lastname, suffix)] = id
+
+        person_emails, person_phones, person_addresses, memberships = \
+                [], [], [], []
+        PersonAddress = Person.addresses.through
+        for person, email, phones, primary_phone, address, membership in batch:
+            person.id = person_ids[(person.firstname, person.lastname,
+                                    person.suffix)]
+            if email:
+                person_emails.append(PersonEmail(person_id=person.id,
+                        email_id=self.emails[email.email.lower()]))
+            for phone in phones:
+                person_phones.append(PersonPhone(person_id=person.id,
+                        phone_id=self.phones[(phone.phone, phone.ext)],
+                        primary=(phone.location == primary_phone)))
+            if address:
+                person_addresses.append(PersonAddress(person_id=person.id,
+                        address_id=self.addresses[_address_key(address)]))
+            if membership:
+                membership.person_id = person.id
+                memberships.append(membership)
+        _bulk_create(PersonEmail, person_emails)
+        _bulk_create(PersonPhone, person_phones)
+        _bulk_create(PersonAddress, person_addresses)
+        _bulk_create(PersonTeam, memberships)
+
+        # bulk_create doesn't send post_save, which keeps student current
+        # and the resolved report audiences and name index fresh
+        Person.objects.update_students([x[0] for x in batch])
+        audience.invalidate()
+        search.invalidate()
+
+class Command(BaseCommand):
+    help = ('Imports people, with their email, phones, address and team '
+            'membership, from a CSV file with a header row. Columns are '
+            'the Person fields (firstname, lastname, gender, grad_year...), '
+            'email, email_location, home_phone, home_ext, mobile_phone, '
+            'mobile_ext, work_phone, work_ext, other_phone, other_ext, '
+            'primary_phone (Home, Mobile, Work or Other), line1, line2, '
+            'city, state, zipcode, team (name), role and status. People '
+            'already in the roster are skipped; existing emails, phones '
+            'and addresses are reused.')
+    args = '<file.csv or - for stdin>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--team', dest='team', default=None,
+            help='Team (name) for rows without a team column.'),
+        make_option('--role', dest='role', default=None,
+            help='Role for rows without one.'),
+        make_option('--status', dest='status', default='Active',
+            help='Membership status for rows without one.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Rows to validate and save at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only validate the file.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give one CSV file to import')
+        if args[0] == '-':
+            input = sys.stdin
+        else:
+            try:
+                input = open(args[0], 'rU')
+            except IOError, e:
+                raise CommandError(str(e))
+
+        importer = Importer(options['team'], options['role'],
+                            options['status'], options['dry_run'])
+        if options['team'] and options['team'] not in importer.teams:
+            raise CommandError('No team named %s' % options['team'])
+        reader = csv.DictReader(input)
+        start = time.time()
+        line = 2
+        while True:
+            rows = list(islice(reader, options['batch_size']))
+            if not rows:
+                break
+            importer.import_rows(rows, line)
+            line += len(rows)
+
+        for line, message in importer.errors:
+            self.stderr.write('line %d: %s\n' % (line, message.encode('utf-8')))
+        elapsed = time.time() - start
+        self.stdout.write('%s %d people (%d rows skipped) in %.1fs\n' %
+                          (options['dry_run'] and 'Validated' or 'Imported',
+                           importer.created, len(importer.errors), elapsed))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from roster.models import Person
+
+class Command(BaseCommand):
+    help = ('Recomputes the stored student/adult classification of everyone. '
+            'Saves keep it current, but the graduation year and age rules '
+            'depend on the date, so run this periodically (e.g. from cron '
+            'at the start of each season).')
+
+    def handle(self, *args, **options):
+        classified = Person.objects.update_students()
+        counts = {True: 0, False: 0, None: 0}
+        for student in classified.values():
+            counts[student] += 1
+        self.stdout.write('%d students, %d adults, %d unknown\n' %
+                          (counts[True], counts[False], counts[None]))
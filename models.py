@@ -1,6 +1,9 @@
 from django.db import models, IntegrityError
+from django.db.models.query import QuerySet
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.localflavor.us.models import *
-from batch_select.models import BatchManager
+from batch_select.models import Batch, BatchManager
 from stdimage import StdImageField
 
 # Base models
@@ -178,6 +181,85 @@ class RelationshipType(models.Model):
     class Meta:
         ordering = ['sort_order']
 
+class PersonManager(BatchManager):
+    # the phone lists select phones from the cache
+    cached_batches = ('phones',)
+
+    def classify_students(self, people=None, parent_relationships=None):
+        """Classify people as students (True), adults (False) or unknown
+        (None), returning a dict keyed by person id.  Uses the same
+        priority as Person.is_student, but for a whole queryset (or list)
+        of people at once, with at most three queries."""
+        if people is None:
+            people = self.all()
+        if isinstance(people, QuerySet):
+            rows = list(people.values_list('id', 'grad_year', 'birth_year'))
+            if people.query.low_mark or people.query.high_mark is not None:
+                person_filter = [x[0] for x in rows]
+            else:
+                person_filter = people.order_by().values('pk')
+        else:
+            rows = [(x.id, x.grad_year, x.birth_year) for x in people]
+            person_filter = [x[0] for x in rows]
+        if parent_relationships is None:
+            parent_relationships = RelationshipType.objects.filter(parent=True)\
+                    .values('id')
+
+        from datetime import date
+        today = date.today()
+        classified = {}
+        for person_id, grad_year, birth_year in rows:
+            student = None
+            # graduation year
+            if grad_year and grad_year > 100 and grad_year > today.year:
+                student = True
+            if (student is None and grad_year and
+                    grad_year > 100 and grad_year < today.year):
+                student = False
+            # age
+            if (student is None and birth_year and birth_year > 100 and
+                    (today.year - birth_year) > 20):
+                student = False
+            classified[person_id] = student
+        if not classified:
+            return classified
+
+        # roles: a current student role beats everything else, any other
+        # role only decides people not decided by the above
+        roles = PersonTeam.objects.filter(person__in=person_filter)\
+                .values_list('person', 'role', 'status')
+        for person_id, role, status in roles:
+            if person_id not in classified:
+                continue
+            if role == 'Student' and status != 'Alumnus':
+                classified[person_id] = True
+            elif classified[person_id] is None and role != 'Student':
+                classified[person_id] = False
+
+        # relationships
+        if None in classified.values():
+            children = Relationship.objects.filter(person_from__in=person_filter,
+                    relationship__in=parent_relationships)\
+                    .values_list('person_from', flat=True).distinct()
+            for person_id in children:
+                if classified.get(person_id, False) is None:
+                    classified[person_id] = True
+
+        return classified
+
+    def update_students(self, people=None):
+        """Recompute and store the student column for people (a queryset
+        or list, defaults to everyone).  Returns the classification."""
+        classified = self.classify_students(people)
+        by_value = {}
+        for person_id, student in classified.items():
+            by_value.setdefault(student, []).append(person_id)
+        # update() doesn't send signals, so this doesn't recurse
+        for student, person_ids in by_value.items():
+            for i in xrange(0, len(person_ids), 500):
+                self.filter(id__in=person_ids[i:i+500]).update(student=student)
+        return classified
+
 class Person(models.Model):
     firstname = models.CharField("First Name", max_length=100)
     lastname = models.CharField("Last Name", max_length=100)
@@ -226,6 +308,12 @@ class Person(models.Model):
 
     position = models.CharField(max_length=50, blank=True)
 
+    # Stored result of is_student, kept current when Person, PersonTeam,
+    # Relationship or RelationshipType change.  As it depends on today's
+    # date, run "manage.py rebuild_students" at least once a year.
+    student = models.NullBooleanField("Student", db_index=True,
+                                      editable=False)
+
     emails = models.ManyToManyField(Email, through='PersonEmail', blank=True)
     addresses = models.ManyToManyField(Address, blank=True)
     phones = models.ManyToManyField(Phone, through='PersonPhone', blank=True)
@@ -264,46 +352,18 @@ class Person(models.Model):
         # 4) age > 20 => adult
         # 5) any non-student role on any team => adult
         # 6) any parent relationships => student
-        if parent_relationships is None:
-            parent_relationships = RelationshipType.objects.filter(parent=True)\
-                    .values_list('id', flat=True)
-
-        student = None
-
-        from datetime import date
-        today = date.today()
-        # graduation year
-        if (student is None and self.grad_year and
-                self.grad_year > 100 and self.grad_year > today.year):
-            student = True
-        if (student is None and self.grad_year and
-                self.grad_year > 100 and self.grad_year < today.year):
-            student = False
-        # age
-        if (student is None and self.birth_year and
-                self.birth_year > 100 and
-                (today.year - self.birth_year) > 20):
-            student = False
-
-        # roles
-        for x in PersonTeam.objects.filter(person=self):
-            if student is None and x.role != 'Student':
-                student = False
-            if x.role == 'Student' and x.status != 'Alumnus':
-                student = True
-
-        # relationships
-        if student is None:
-            if Relationship.objects.filter(person_from=self,
-                    relationship__in=parent_relationships):
-                student = True
-
-        return student
+        # For more than one person use Person.objects.classify_students.
+        return Person.objects.classify_students([self],
+                parent_relationships).get(self.id)
 
     def active_roles(self):
-        results = PersonTeam.objects.filter(person=self,
-                status__in=('Active', 'Prospective'))
-        results = results.select_related('team.name')
+        # use the rows selected by batch_select(active_personteams=
+        # ACTIVE_ROLES) if there are any, saving a query per person
+        results = getattr(self, 'active_personteams', None)
+        if results is None:
+            results = PersonTeam.objects.filter(person=self,
+                    status__in=('Active', 'Prospective'))
+            results = results.select_related('team')
         return ", ".join("%s (%s%s)" %
                 (x.team.name,
                  x.status == 'Prospective' and "Prospective " or "",
@@ -311,7 +371,7 @@ class Person(models.Model):
                 for x in results)
     active_roles.short_description = 'Active Roles'
 
-    objects = BatchManager()
+    objects = PersonManager()
 
     def clean(self):
         for field in self._meta.fields:
@@ -323,6 +383,11 @@ class Person(models.Model):
         ordering = ['lastname', 'firstname']
         unique_together = ['firstname', 'lastname', 'suffix']
 
+# Selects what Person.active_roles needs for a whole queryset in two
+# queries, e.g. Person.objects.batch_select(active_personteams=ACTIVE_ROLES)
+ACTIVE_ROLES = Batch('personteam_set__team')\
+        .filter(status__in=('Active', 'Prospective')).order_by('id')
+
 class PersonTeam(models.Model):
     person = models.ForeignKey(Person)
     team = models.ForeignKey(Team)
@@ -441,3 +506,60 @@ class TimeRecord(models.Model):
     hours = models.FloatField("Hours")
     recorded = models.DateField("Recorded")
 
+class Version(models.Model):
+    """The version of something each process keeps a copy of (see
+    roster.versioned), bumped in the transaction that changes it."""
+    key = models.CharField(max_length=50, primary_key=True)
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s: %s" % (self.key, self.version)
+
+# Keep Person.student up to date, only for the people affected by a change.
+
+@receiver(post_save, sender=Person)
+def _person_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance.student = Person.objects.update_students([instance])\
+            .get(instance.id)
+
+# the person field of the rows that affect whether their person is a
+# student
+_STUDENT_PERSON_FIELDS = {PersonTeam: 'person', Relationship: 'person_from'}
+
+@receiver(pre_save, sender=PersonTeam)
+@receiver(pre_save, sender=Relationship)
+def _remember_person(sender, instance, raw=False, **kwargs):
+    # a save may move the row to someone else, in which case the person
+    # it belonged to needs classifying again too
+    if raw or instance.pk is None:
+        return
+    instance._previous_person_ids = list(sender.objects.filter(pk=instance.pk)
+            .values_list(_STUDENT_PERSON_FIELDS[sender], flat=True))
+
+def _update_students(instance, person_id):
+    person_ids = set([person_id])
+    person_ids.update(instance.__dict__.pop('_previous_person_ids', ()))
+    Person.objects.update_students(Person.objects.filter(id__in=person_ids))
+
+@receiver(post_save, sender=PersonTeam)
+@receiver(post_delete, sender=PersonTeam)
+def _personteam_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    _update_students(instance, instance.person_id)
+
+@receiver(post_save, sender=Relationship)
+@receiver(post_delete, sender=Relationship)
+def _relationship_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    _update_students(instance, instance.person_from_id)
+
+@receiver(post_save, sender=RelationshipType)
+def _relationshiptype_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    Person.objects.update_students(Person.objects.filter(
+            relationship_to_set__relationship=instance).distinct())
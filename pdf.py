@@ -0,0 +1,622 @@
+# PDF documents: registration verification forms and badges.  Only the
+# views making them import this, so a worker doesn't load reportlab or
+# the fonts until the first PDF is asked for.
+from django.utils.html import escape
+from settings import MEDIA_ROOT
+
+from roster.models import *
+from roster.relationships import get_graph
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter, landscape
+from reportlab.lib.units import inch
+from reportlab.platypus import Paragraph, BaseDocTemplate, SimpleDocTemplate, Table, TableStyle, PageBreak, ActionFlowable, Frame, PageTemplate
+from reportlab.platypus.flowables import Flowable
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.utils import ImageReader
+from reportlab.graphics.barcode import code39
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+import os
+import math
+import threading
+
+team_color1 = (55.0/255.0, 88.0/255.0, 150.0/255.0)
+team_color2 = (236.0/255.0, 108.0/255.0, 29.0/255.0)
+
+_fonts_registered = False
+_fonts_lock = threading.Lock()
+
+def register_fonts():
+    """Registers the Calibri fonts with reportlab (parsing the TTF files
+    only the first time it's called)."""
+    global _fonts_registered
+    with _fonts_lock:
+        if not _fonts_registered:
+            pdfmetrics.registerFont(TTFont('Calibri', 'calibri.ttf'))
+            pdfmetrics.registerFont(TTFont('Calibri-Bold', 'calibrib.ttf'))
+            pdfmetrics.registerFont(TTFont('Calibri-Italic', 'calibrii.ttf'))
+            _fonts_registered = True
+
+class Checkbox(Flowable):
+    """A checkbox flowable."""
+    def __init__(self, checked, size=0.25*inch, color=colors.black):
+        self.checked = checked
+        self.size = size
+
+    def wrap(self, *args):
+        return (0, self.size)
+
+    def draw(self):
+        canvas = self.canv
+        canvas.setLineWidth(1)
+        canvas.setStrokeColor(self.color)
+        canvas.rect(0, 0, self.size, self.size)
+        if self.checked:
+            canvas.line(0, 0, self.size, self.size)
+            canvas.line(0, self.size, self.size, 0)
+
+class StartPerson(ActionFlowable):
+    def __init__(self, id, firstname, lastname, suffix, adult, team):
+        ActionFlowable.__init__(self, ('startPerson', id, firstname,
+            lastname, suffix, adult, team))
+
+class RegVerifyDocTemplate(BaseDocTemplate):
+    _invalidInitArgs = ('pageTemplates')
+
+    def afterInit(self):
+        self.name = None
+        self.id = None
+        self.team = None
+        self.adult = False
+
+        frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id='normal')
+        self.addPageTemplates([PageTemplate(id='First',frames=frame,onPageEnd=self.afterFirstPage,pagesize=self.pagesize),
+                               PageTemplate(id='Later',frames=frame,onPageEnd=self.afterNextPage,pagesize=self.pagesize)])
+
+    def afterFirstPage(self, canv, self2):
+        #self.pageTemplate = self.pageTemplates[1]
+
+        # Name in upper left corner
+        canv.setFont("Calibri-Bold", 14)
+        canv.setFillColor(colors.black)
+        canv.drawString(0.5*inch, self.pagesize[1]-0.5*inch, self.name)
+
+        # Box with first letter of last name in upper right corner
+        # Color it based on adult
+        wh = 0.375*inch
+        c = (self.pagesize[0]-0.75*inch, self.pagesize[1]-0.5*inch)
+        canv.setFillColor(self.adult and team_color2 or team_color1)
+        canv.rect(c[0]-wh/2, c[1]-wh/2,
+                  wh, wh, fill=1, stroke=0)
+
+        lsize = 30
+        canv.setFillColor(colors.black)
+        canv.setFont("Calibri-Bold", lsize)
+        canv.drawCentredString(c[0], c[1]-lsize/2/1.4, self.name[0].upper())
+
+        # Admin fields
+        canv.setStrokeColor(colors.black)
+        canv.setFillColor(colors.black)
+        canv.setLineWidth(1)
+        title = "Administration Only"
+        title_width = canv.stringWidth(title, "Calibri-Italic", 8)
+        canv.line(0.5*inch, 0.7*inch,
+                  self.pagesize[0]/2-title_width/2, 0.7*inch)
+        canv.line(self.pagesize[0]/2+title_width/2, 0.7*inch,
+                  self.pagesize[0]-0.5*inch, 0.7*inch)
+        #canv.line(0.5*inch, 0.7*inch, self.pagesize[0]-0.5*inch, 0.7*inch)
+        canv.setFont("Calibri-Italic", 8)
+        canv.drawCentredString(self.pagesize[0]/2, 0.675*inch, title)
+        canv.setFont("Calibri", 8)
+        canv.setLineWidth(0.5)
+        for r, c, sw, vw, s, v in \
+                [(0, 0, 0.75, 0.5, "Id:", "%d" % self.id),
+                 (1, 0, 0.75, 0.5, "Printed On:",
+                  self.today.strftime("%b %-d, %Y")),
+                 (0, 1, 0.75, 0.5, "Cash/Check #", None),
+                 (1, 1, 0.75, 0.5, "Amount:", None),
+                 (0, 2, 0.75, 0.5, "Team:", self.team),
+                 (1, 2, 0.75, 0.5, "Paid Date:", None),
+                 (0, 3, 1, 0.25, "Release Form:", None),
+                 (1, 3, 1, 0.25, "Student Contract:", None)]:
+            x = 0.5*inch + c*2*inch
+            y = 0.5*inch - r*0.125*inch
+            canv.drawString(x, y, s)
+            if v is None:
+                canv.line(x+sw*inch, y, x+(sw+vw)*inch, y)
+            else:
+                canv.drawString(x+sw*inch, y, v)
+
+    def afterNextPage(self, canv, self2):
+        pass
+
+    def handle_startPerson(self, id, firstname, lastname, suffix, adult,
+                           team):
+        #self.pageTemplate = self.pageTemplates[0]
+        self.name = "%s, %s %s" % (lastname, firstname, suffix)
+        self.id = id
+        self.adult = adult
+        self.team = team
+
+def person_to_pdf(elements, person, title, adult=False, parent=None,
+                  contact=None):
+    base_style = [
+        # default font and text color for table
+        ('FONT', (0,0), (-1,-1), 'Calibri', 8),
+        ('TEXTCOLOR', (0,0), (-1,-1), colors.black),
+        # default to top alignment for table
+        ('VALIGN', (0,0), (-1,-1), 'TOP'),
+        # reduce padding for table
+        ('TOPPADDING', (0,0), (-1,-1), 2),
+        ('BOTTOMPADDING', (0,0), (-1,-1), 2),
+        # bold first column
+        ('FONT', (0,0), (0,-1), 'Calibri-Bold', 8),
+        # set up header row
+        ('BACKGROUND', (0,0), (-1,0), team_color1),
+        ('TEXTCOLOR', (0,0), (-1,0), colors.white),
+        ('SPAN', (0,0), (-1,0)),
+        # lines around the table, between each row, and between cols 2 and 3
+        ('BOX', (0,0), (-1,-1), 1, colors.black),
+        ('LINEBELOW', (0,0), (-1,-1), 1, colors.black),
+        ('LINEAFTER', (1,1), (1,-1), 1, colors.black),
+        ]
+    if person:
+        empty_person = False
+        def highlight(style, data):
+            style.add('BACKGROUND', (2,len(data)), (2,len(data)), colors.yellow)
+    else:
+        empty_person = True
+        def highlight(style, data):
+            pass
+        person = Person()
+
+    data = []
+    style = TableStyle(base_style)
+
+    # Basic information
+    data.append((title, "", ""))
+    data.append(((parent or contact) and "Name" or "Legal Name",
+        "First and Last",
+        "%s %s %s" % (person.firstname, person.lastname, person.suffix)))
+    if isinstance(contact, Relationship):
+        style.add('SPAN', (0,len(data)-1), (0,len(data)))
+        data.append(("", "Relationship", contact.relationship))
+    elif contact or (parent and not isinstance(parent, Relationship)):
+        style.add('SPAN', (0,len(data)-1), (0,len(data)))
+        data.append(("", "Relationship", ""))
+
+    if not parent and not contact:
+        data.append(("Nickname", "", person.nickname))
+        if not person.gender or person.gender == 'U':
+            highlight(style, data)
+        data.append(("Gender", "", person.get_gender_display()))
+        if not person.birth_month or not person.birth_day or person.birth_year is not None and (person.birth_year > 2050 or person.birth_year < 1900):
+            highlight(style, data)
+        data.append(("Date of Birth", "m/d/yyyy", not empty_person and
+            "%s / %s / %s" % (person.birth_month, person.birth_day, person.birth_year) or ""))
+
+    # - School
+    if not adult:
+        if not person.school:
+            highlight(style, data)
+        data.append(("School", "", person.school))
+        if not person.grad_year:
+            highlight(style, data)
+        data.append(("HS Graduation Year", "", person.grad_year))
+
+    if not contact:
+        # - Company
+        if adult and not person.company:
+            highlight(style, data)
+        data.append(("Company", "", person.company))
+
+        # - Shirt Size
+        if not parent:
+            if not person.shirt_size:
+                highlight(style, data)
+            data.append(("Shirt Size", "", person.shirt_size))
+
+        # Parent specific info
+        #if isinstance(parent, Relationship):
+        #    data.append(("Emergency Contact", "",
+        #        parent.emergency_contact and "Yes" or "No"))
+        #elif parent:
+        #    data.append(("Emergency Contact", "", "Yes / No"))
+
+        # Emails
+        emails = PersonEmail.objects.filter(person=person)
+        start = len(data)
+        first = "Email"
+        for email in emails:
+            data.append((first, email.email.location, "%s%s" %
+                (email.email.email, email.primary and " (primary)" or "")))
+            first = ""
+        if not emails:
+            data.append((first, "Address", ""))
+            first = ""
+        # - Parent specific info
+        if isinstance(parent, Relationship):
+            data.append((first, "CC on Student Emails",
+                parent.cc_on_email and "Yes" or "No"))
+            first = ""
+        elif parent:
+            data.append((first, "CC on Student Emails", "Yes / No"))
+            first = ""
+        if len(data)-1 > start:
+            style.add('SPAN', (0,start), (0,len(data)-1))
+
+    # Phones
+    phones = PersonPhone.objects.filter(person=person)
+    wanted_phone_locations = set([u'Cell', u'Home', u'Work'])
+    start = len(data)
+    first = "Phone"
+    for phone in phones:
+        location = phone.phone.get_location_display()
+        wanted_phone_locations.discard(location)
+        data.append((first, location, "%s%s" %
+            (phone.phone.render_normal(),
+             phone.primary and " (primary)" or "")))
+        first = ""
+    for location in sorted(wanted_phone_locations):
+        #highlight(style, data)
+        data.append((first, location, ""))
+        first = ""
+    if len(data)-1 > start:
+        style.add('SPAN', (0,start), (0,len(data)-1))
+
+    if not contact:
+        # Addresses
+        addresses = not empty_person and person.addresses.all() or []
+        for address in addresses:
+            style.add('SPAN', (0,len(data)), (0,len(data)+2))
+            data.append(("Address", "Line 1", address.line1))
+            data.append(("", "Line 2", address.line2))
+            data.append(("", "City, State, Zip", "%s, %s %s" %
+                (address.city, address.state, address.zipcode)))
+        if not addresses:
+            style.add('SPAN', (0,len(data)), (0,len(data)+2))
+            highlight(style, data)
+            data.append(("Address", "Line 1", ""))
+            highlight(style, data)
+            data.append(("", "Line 2", ""))
+            highlight(style, data)
+            data.append(("", "City, State, Zip", ""))
+
+        # Medical
+        if not parent:
+            style.add('SPAN', (0,len(data)), (0,len(data)+1))
+            #if not person.medical:
+            #    highlight(style, data)
+            data.append(("Medical", "Conditions/Allergies", person.medical))
+            #if not person.medications:
+            #    highlight(style, data)
+            data.append(("", "Medications", person.medications))
+
+    elements.append(Table(data, colWidths=(0.75*inch, 1.25*inch, 5*inch),
+                    style=style))
+
+def make_reg_verify_pdf(response, people):
+    register_fonts()
+    from datetime import date
+    today = date.today()
+
+    doc = RegVerifyDocTemplate(response,
+            pagesize=letter,
+            allowSplitting=0,
+            leftMargin=0.5*inch,
+            rightMargin=0.5*inch,
+            topMargin=0.75*inch,
+            bottomMargin=0.75*inch,
+            title="Team Registration Verification",
+            author="Beach Cities Robotics")
+    doc.today = today
+
+    # container for the 'Flowable' objects
+    elements = []
+
+    styles = getSampleStyleSheet()
+    normal_para_style = styles['Normal']
+
+    # guardians and emergency contacts of everyone, with one query for
+    # the people they are
+    people = list(people)
+    for reload in (False, True):
+        graph = get_graph(reload)
+        guardians = dict((x.id, graph.relationships(x.id, 'legal_guardian'))
+                         for x in people)
+        contacts = dict((x.id, graph.relationships(x.id, 'emergency_contact'))
+                        for x in people)
+        ids = set(r.person_to_id for rs in guardians.values() +
+                  contacts.values() for r in rs)
+        related = Person.objects.in_bulk(ids)
+        # someone missing means the graph is out of date, so load it again
+        if len(related) == len(ids):
+            break
+    for rs in guardians.values() + contacts.values():
+        rs[:] = [r for r in rs if r.person_to_id in related]
+        for r in rs:
+            r._person_to_cache = related[r.person_to_id]
+
+    for person in people:
+        adult = person.company or \
+                (person.birth_year and person.birth_year > 1900 and
+                 (today.year - person.birth_year) > 20)
+        team = None
+        pts = PersonTeam.objects.filter(person=person, status='Active')
+        if pts:
+            team = "%s" % pts[0].team
+        elements.append(StartPerson(person.id, person.firstname,
+                                    person.lastname, person.suffix, adult,
+                                    team))
+        person_to_pdf(elements, person,
+                "%s Information" % (adult and "Mentor" or "Student"),
+                adult=adult)
+        elements.append(Paragraph("", normal_para_style))
+
+        parents = []
+        if not adult:
+            # Parents
+            parents = guardians[person.id]
+            extra_parents = [1, 2]
+            for parent in parents:
+                person_to_pdf(elements, parent.person_to,
+                    "%s's Information" % parent.relationship,
+                    adult=True,
+                    parent=parent)
+                elements.append(Paragraph("", normal_para_style))
+            for parent in extra_parents[len(parents):]:
+                person_to_pdf(elements, None,
+                    "Legal Guardian %d Information" % parent,
+                    adult=True,
+                    parent=True)
+                elements.append(Paragraph("", normal_para_style))
+        parent_ids = set(x.id for x in parents)
+
+        # Emergency Contacts
+        if adult:
+            person_contacts = [x for x in contacts[person.id]
+                               if x.id not in parent_ids]
+            for contact in person_contacts:
+                person_to_pdf(elements, contact.person_to,
+                    "Emergency Contact Information",
+                    adult=True,
+                    contact=contact)
+                elements.append(Paragraph("", normal_para_style))
+            if not person_contacts:
+                person_to_pdf(elements, None,
+                    "Emergency Contact Information",
+                    adult=True,
+                    contact=True)
+        elements.append(PageBreak())
+
+    # Generate the document
+    doc.build(elements)
+
+class Badge(Flowable):
+    """A badge flowable."""
+    # badge dimensions
+    width = 2.25*inch
+    height = 3.5*inch
+
+    # border thickness
+    border_size = 0.125*inch
+
+    # logo location and size
+    logo = 0
+    logo_width = 0.5*inch
+    logo_height = 0.75*inch
+    logo_x = width - logo_width - 0.125*inch
+    logo_y = height - logo_height - 0.125*inch
+
+    # team name location and size
+    team_font = 'Calibri-Bold'
+    team_fontsize = 18
+    team_x = width / 2.0
+    team_y = (1/16.0)*inch
+    team_name = "Beach Cities Robotics"
+
+    # photo location and size
+    photo_width = 1.25*inch
+    photo_height = 1.5*inch
+    photo_x = (1/16.0)*inch
+    photo_y = height - photo_height - (3/16.0)*inch
+    photo_corner = 0.125*inch  # rounded corner radius
+
+    # name location and size
+    fullname_font = 'Calibri'
+    fullname_fontsize = 10
+    fullname_x = 0.125*inch
+    fullname_y = photo_y - 0.125*inch
+    firstname_font = 'Calibri-Bold'
+    firstname_fontsize = 24
+    firstname_x = 0.125*inch
+    firstname_y = fullname_y - 0.3*inch
+
+    # position location and size
+    position_font = 'Calibri'
+    position_fontsize = 14
+    position_x = 0.125*inch
+    position_y = 1*inch
+    position_width = width - position_x - 0.125*inch
+    position_height = 0.5*inch
+
+    # id font
+    id_font = 'Calibri'
+    id_fontsize = 8
+
+    # barcode location and size
+    barcode_x = 0
+    barcode_y = 0.375*inch
+
+    def __init__(self, person, student):
+        self.styles = getSampleStyleSheet()
+        self.person = person
+        self.student = student
+
+    def wrap(self, *args):
+        return (0, self.height)
+
+    def draw(self):
+        canvas = self.canv
+        canvas.saveState()
+        canvas.setLineWidth(1)
+        canvas.setStrokeColor(colors.black)
+        canvas.setFillColor(colors.black)
+
+        # clip to badge boundary
+        p = canvas.beginPath()
+        p.rect(0, 0, self.width, self.height)
+        canvas.clipPath(p)
+
+        # Badge outline / background
+        canvas.saveState()
+        if self.student:
+            color1 = team_color2
+            color2 = team_color1
+        else:
+            color1 = team_color1
+            color2 = team_color2
+        canvas.radialGradient(0, 0,
+                math.sqrt(self.width*self.width+self.height*self.height),
+                [colors.white, color1], [0.10, 1])
+
+        canvas.setFillColor(color2)
+        canvas.rect(0, 0, self.width, 0.3*inch, stroke=0, fill=1)
+
+        canvas.drawPath(p)
+        canvas.restoreState()
+
+        # Team logo
+        if self.logo:
+            canvas.drawImage(os.path.join(MEDIA_ROOT, "logo.jpeg"),
+                    self.logo_x, self.logo_y, self.logo_width, self.logo_height,
+                    preserveAspectRatio=True)
+
+        # Team name
+        canvas.saveState()
+        canvas.setFillColor(colors.black)
+        canvas.setFont(self.team_font, self.team_fontsize)
+        canvas.drawCentredString(self.team_x, self.team_y, self.team_name)
+        canvas.restoreState()
+
+        # Photo
+        if self.person.photo:
+            # round corners by using a clip path
+            canvas.saveState()
+            p = canvas.beginPath()
+            p.roundRect(self.photo_x, self.photo_y, self.photo_width,
+                    self.photo_height, self.photo_corner)
+            canvas.clipPath(p, stroke=0)
+
+            # load image
+            photopath = os.path.join(MEDIA_ROOT, self.person.photo.name)
+            img = ImageReader(photopath)
+
+            # scale/center image so it fills entire area
+            imgw, imgh = img.getSize()
+            newimgw, newimgh = imgw, imgh
+            rw = int(imgh * self.photo_width / self.photo_height)
+            if rw <= imgw:
+                newimgw = rw
+            else:
+                newimgh = int(imgw * self.photo_height / self.photo_width)
+            width = self.photo_width*((1.0*imgw)/newimgw)
+            height = self.photo_height*((1.0*imgh)/newimgh)
+            x = self.photo_x - (width-self.photo_width)/2.0
+            y = self.photo_y - (height-self.photo_height)/2.0
+
+            # draw image
+            canvas.drawImage(img, x, y, width, height)
+
+            # restore state (clip path)
+            canvas.restoreState()
+        else:
+            canvas.saveState()
+            canvas.setFillColor(colors.white)
+            canvas.roundRect(self.photo_x, self.photo_y, self.photo_width,
+                    self.photo_height, self.photo_corner, stroke=1, fill=1)
+            canvas.restoreState()
+
+        # Name
+        canvas.saveState()
+        fullname = "%s, %s %s" % (self.person.lastname, self.person.firstname, self.person.suffix)
+        canvas.setFont(self.fullname_font, self.fullname_fontsize)
+        canvas.drawString(self.fullname_x, self.fullname_y, fullname)
+        canvas.restoreState()
+
+        canvas.saveState()
+        canvas.setFont(self.firstname_font, self.firstname_fontsize)
+        canvas.drawString(self.firstname_x, self.firstname_y, self.person.get_firstname())
+        canvas.restoreState()
+
+        # Position
+        position = str(self.person.position)
+        if not position:
+            if self.student:
+                position = "Student"
+            else:
+                position = "Mentor"
+        t = '<font name="%s" size="%d">%s</font>' % \
+                (self.position_font, self.position_fontsize, escape(position))
+        p = Paragraph(t, style=self.styles['Normal'])
+        p.wrapOn(canvas, self.position_width, self.position_height)
+        p.drawOn(canvas, self.position_x, self.position_y)
+
+        # Barcode
+        idstr = "B%05d" % self.person.get_badge()
+        canvas.saveState()
+        barcode = code39.Standard39(idstr, humanReadable=0, checksum=1)
+        canvas.setFillColor(colors.black)
+        barcode.drawOn(canvas, self.barcode_x, self.barcode_y)
+        canvas.restoreState()
+
+        # ID
+        idstr = "%d" % self.person.get_badge()
+        canvas.saveState()
+        canvas.setFont(self.id_font, self.id_fontsize)
+        canvas.drawString(self.barcode_x + barcode.lquiet,
+                self.barcode_y + barcode.height + 3, idstr)
+        canvas.restoreState()
+
+        canvas.restoreState()
+
+class BadgesDocTemplate(BaseDocTemplate):
+    _invalidInitArgs = ('pageTemplates')
+
+    def afterInit(self):
+        width = 2.25*inch
+        left = self.leftMargin
+        frames = [Frame(self.leftMargin+width*x, self.bottomMargin, width,
+            self.height, leftPadding=0, bottomPadding=0, rightPadding=0,
+            topPadding=0) for x in range(4)]
+        self.addPageTemplates([PageTemplate(id='Page',frames=frames,pagesize=self.pagesize)])
+
+
+def make_badges_pdf(response, people):
+    register_fonts()
+    doc = BadgesDocTemplate(response,
+            pagesize=landscape(letter),
+            allowSplitting=0,
+            leftMargin=1*inch,
+            rightMargin=1*inch,
+            topMargin=0.75*inch,
+            bottomMargin=0.5*inch,
+            title="Badges",
+            author="Beach Cities Robotics")
+
+    # container for the 'Flowable' objects
+    elements = []
+
+    styles = getSampleStyleSheet()
+    normal_para_style = styles['Normal']
+
+    for person in people:
+        student = person.student
+        elements.append(Badge(person, student))
+        elements.append(Paragraph("", normal_para_style))
+
+    # Generate the document
+    doc.build(elements)
@@ -0,0 +1,159 @@
+# In-process index of who is related to whom
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from roster.models import Person, Relationship, RelationshipType
+from roster.versioned import ProcessIndex
+
+# the columns of Relationship kept for each relationship, by field name
+# and by attribute name
+COLUMNS = ('id', 'person_from', 'person_to', 'relationship', 'cc_on_email',
+           'legal_guardian', 'emergency_contact')
+ATTNAMES = ('id', 'person_from_id', 'person_to_id', 'relationship_id',
+            'cc_on_email', 'legal_guardian', 'emergency_contact')
+
+# the kinds of edge, by which a relationship is in each
+KINDS = ('parent', 'legal_guardian', 'emergency_contact', 'cc_on_email')
+
+def _set_ids(lists, person, ids):
+    if ids:
+        lists[person] = ids
+    else:
+        lists.pop(person, None)
+
+class RelationshipGraph(object):
+    """Every Relationship, as edges from person_from to person_to, with
+    an edge list for each of KINDS (a relationship is a parent edge if
+    its RelationshipType is a parent one).  Built whole by load, or from
+    an older graph by update, and never changed after."""
+    def __init__(self, types, rows):
+        self.types = types
+        self.rows = {}
+        # the ids of each person's relationships, and of those of each kind
+        self.people = {}
+        self.edges = dict((kind, {}) for kind in KINDS)
+        # rows come in id order, so each edge list is in the order the
+        # relationships were made
+        for row in rows:
+            self.rows[row[0]] = row
+            self.people.setdefault(row[1], []).append(row[0])
+            for kind in self._kinds(row):
+                self.edges[kind].setdefault(row[1], []).append(row[0])
+
+    @classmethod
+    def load(cls):
+        types = dict((x.id, x) for x in RelationshipType.objects.all())
+        return cls(types, Relationship.objects.order_by('id')
+                                              .values_list(*COLUMNS))
+
+    @classmethod
+    def update(cls, graph, changes):
+        """graph with the relationships changed since read again, where
+        each change is the ids of the relationships saved or deleted (or
+        None for a change to the types, which needs a whole new graph)."""
+        if None in changes:
+            return None
+        pks = set()
+        for change in changes:
+            pks.update(change)
+        return graph.replaced(pks, Relationship.objects.filter(id__in=pks)
+                                               .values_list(*COLUMNS))
+
+    def replaced(self, pks, rows):
+        """A copy of the graph with the relationships pks (ids) replaced
+        by rows, those of them that are still in the database."""
+        rows = list(rows)
+        graph = RelationshipGraph(self.types, ())
+        # only the lists of the people affected are made anew, the rest
+        # are shared with this graph
+        graph.rows = dict(self.rows)
+        graph.people = dict(self.people)
+        graph.edges = dict((kind, dict(edges))
+                           for kind, edges in self.edges.items())
+        people = set()
+        for pk in pks:
+            row = graph.rows.pop(pk, None)
+            if row is not None:
+                people.add(row[1])
+        for row in rows:
+            graph.rows[row[0]] = row
+            people.add(row[1])
+        for person in people:
+            ids = [pk for pk in self.people.get(person, ()) if pk not in pks]
+            ids.extend(row[0] for row in rows if row[1] == person)
+            ids.sort()
+            _set_ids(graph.people, person, ids)
+            for kind in KINDS:
+                _set_ids(graph.edges[kind], person,
+                           [pk for pk in ids
+                            if kind in graph._kinds(graph.rows[pk])])
+        return graph
+
+    def _kinds(self, row):
+        pk, person_from, person_to, type_id, cc_on_email, legal_guardian, \
+                emergency_contact = row
+        parent = type_id in self.types and self.types[type_id].parent
+        return [kind for kind, flag in zip(KINDS, (parent, legal_guardian,
+                                                   emergency_contact,
+                                                   cc_on_email))
+                if flag]
+
+    def related(self, people, kind):
+        """The ids of the people any of people (ids) have a kind edge to."""
+        edges = self.edges[kind]
+        return set(self.rows[pk][2] for person in people
+                   for pk in edges.get(person, ()))
+
+    def links(self, people, kind):
+        """A dict of the ids of the people any of people (ids) have a
+        kind edge to, to the person they're related to."""
+        edges = self.edges[kind]
+        return dict((self.rows[pk][2], person) for person in people
+                    for pk in edges.get(person, ()))
+
+    def relationships(self, person, kind):
+        """The kind relationships from person (an id), in the order they
+        were made, as Relationship instances (with their relationship
+        already there, but person_to still to be fetched)."""
+        results = []
+        for pk in self.edges[kind].get(person, ()):
+            row = self.rows[pk]
+            relationship = Relationship(**dict(zip(ATTNAMES, row)))
+            if row[3] in self.types:
+                relationship._relationship_cache = self.types[row[3]]
+            results.append(relationship)
+        return results
+
+_graph = ProcessIndex('roster:relationships:version', RelationshipGraph.load,
+                      RelationshipGraph.update)
+
+def get_graph(reload=False):
+    """The graph, loaded the first time it's needed in a process and
+    again whenever any process has changed a relationship (or if reload,
+    e.g. when it has someone who isn't in the database any more)."""
+    return _graph.get(reload)
+
+def get_relationships(person, kind):
+    """The graph's kind relationships from person (an id), with person_to
+    fetched in one query (loading the graph again if it has someone who
+    isn't in the database any more)."""
+    for reload in (False, True):
+        relationships = get_graph(reload).relationships(person, kind)
+        related = Person.objects.in_bulk([x.person_to_id
+                                          for x in relationships])
+        if len(related) == len(relationships):
+            break
+    relationships = [x for x in relationships if x.person_to_id in related]
+    for x in relationships:
+        x._person_to_cache = related[x.person_to_id]
+    return relationships
+
+@receiver(post_save, sender=Relationship)
+@receiver(post_delete, sender=Relationship)
+def _relationship_changed(sender, instance, **kwargs):
+    _graph.changed([instance.pk])
+
+@receiver(post_save, sender=RelationshipType)
+@receiver(post_delete, sender=RelationshipType)
+def _relationshiptype_changed(sender, **kwargs):
+    _graph.changed()
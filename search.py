@@ -0,0 +1,104 @@
+# In-process index of people's names, for finding people as they're typed
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from roster.models import Person
+from roster.versioned import ProcessIndex
+
+from bisect import bisect_left
+import heapq
+import re
+import unicodedata
+
+COLUMNS = ('id', 'firstname', 'lastname', 'suffix', 'nickname')
+
+def _words(text):
+    """The words of text to match searches against: lowercase, without
+    accents, and with each word also run together without punctuation
+    (so "o'br" finds O'Brien as well as "brien" does)."""
+    text = unicodedata.normalize('NFKD', unicode(text or ''))\
+            .encode('ascii', 'ignore').lower()
+    words = set()
+    for chunk in text.split():
+        words.update(re.findall(r'[a-z0-9]+', chunk))
+        words.add(re.sub(r'[^a-z0-9]', '', chunk))
+    words.discard('')
+    return words
+
+class NameIndex(object):
+    """The words of everyone's first, last and nick names in one sorted
+    list, so the people with a word starting with a prefix are a slice
+    of it found by bisection.  Built whole by load, and never changed
+    after."""
+    def __init__(self, rows):
+        self.people = {}
+        words = []
+        for pk, firstname, lastname, suffix, nickname in rows:
+            person = Person(firstname=firstname, lastname=lastname,
+                            suffix=suffix, nickname=nickname)
+            person_words = _words(firstname) | _words(lastname) | \
+                    _words(nickname)
+            self.people[pk] = ((lastname.lower(), firstname.lower(), pk),
+                               unicode(person), person_words)
+            words.extend((word, pk) for word in person_words)
+        words.sort()
+        self.words = words
+
+    @classmethod
+    def load(cls):
+        return cls(Person.objects.values_list(*COLUMNS))
+
+    def search(self, query, limit=10):
+        """The people with a name word starting with each word of query,
+        in name order, as up to limit (id, name) pairs."""
+        terms = list(_words(query))
+        if not terms:
+            return []
+        # find candidates by the longest term, as it matches fewest
+        first = max(terms, key=len)
+        candidates = set()
+        for i in xrange(bisect_left(self.words, (first,)), len(self.words)):
+            word, pk = self.words[i]
+            if not word.startswith(first):
+                break
+            candidates.add(pk)
+        people = self.people
+        if len(terms) == 1:
+            matches = [people[x] for x in candidates]
+        else:
+            matches = [people[x] for x in candidates
+                       if all(any(word.startswith(term)
+                                  for word in people[x][2])
+                              for term in terms)]
+        return [(key[2], name) for key, name, words in
+                heapq.nsmallest(limit, matches)]
+
+_index = ProcessIndex('roster:names:version', NameIndex.load)
+
+def search_people(query, limit=10):
+    """Up to limit (id, name) pairs of the people whose names have words
+    starting with each word of query."""
+    return _index.get().search(query, limit)
+
+def invalidate():
+    """Have every process load the names again, e.g. after adding people
+    without sending signals (bulk_create, update)."""
+    _index.changed()
+
+@receiver(pre_save, sender=Person)
+def _remember_names(sender, instance, **kwargs):
+    # most saves (in the admin, or when registering again) change no
+    # names, and needn't have every process build the index again
+    if instance.pk is not None:
+        instance._previous_names = list(Person.objects
+                .filter(pk=instance.pk).values_list(*COLUMNS[1:]))
+
+@receiver(post_save, sender=Person)
+def _person_saved(sender, instance, **kwargs):
+    names = tuple(getattr(instance, x) for x in COLUMNS[1:])
+    if instance.__dict__.pop('_previous_names', None) != [names]:
+        invalidate()
+
+@receiver(post_delete, sender=Person)
+def _person_deleted(sender, **kwargs):
+    invalidate()
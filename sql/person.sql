@@ -0,0 +1,2 @@
+-- Person's default ordering
+CREATE INDEX roster_person_name ON roster_person (lastname, firstname);
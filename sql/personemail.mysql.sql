@@ -0,0 +1,2 @@
+-- Primary emails of people: filter(primary=True, person__in=...)
+CREATE INDEX roster_personemail_primary_person ON roster_personemail (`primary`, person_id, email_id);
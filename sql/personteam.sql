@@ -0,0 +1,5 @@
+-- Report views find people by role, status and team, e.g.
+-- PersonTeam.objects.filter(role__in=..., status__in=..., team__in=...)
+--     .values('person')
+-- so this index answers them without reading the table.
+CREATE INDEX roster_personteam_status_role_team ON roster_personteam (status, role, team_id, person_id);
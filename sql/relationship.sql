@@ -0,0 +1,4 @@
+-- Parents of students: filter(person_from__in=..., relationship__in=...)
+CREATE INDEX roster_relationship_from_type ON roster_relationship (person_from_id, relationship_id, person_to_id);
+-- CC on email: filter(person_from__in=..., cc_on_email=True)
+CREATE INDEX roster_relationship_from_cc ON roster_relationship (person_from_id, cc_on_email, person_to_id);
@@ -1,16 +1,926 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Roster tests, run with "manage.py test roster".
 """
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from roster.models import *
+from roster import choices, relationships, search
+
+from StringIO import StringIO
+from datetime import date
+import csv
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+class ImportTimeTest(SimpleTestCase):
+    # seconds importing roster.views may take in a new process
+    budget = 2.0
+
+    def test_views_import(self):
+        """
+        Importing the views (as every worker does at startup) is quick,
+        and leaves reportlab and its fonts to the first PDF.
+        """
+        script = ('import sys, time\n'
+                  'start = time.time()\n'
+                  'import roster.views\n'
+                  'print time.time() - start\n'
+                  'print "reportlab" in sys.modules\n')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        process = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual(process.returncode, 0, err)
+        seconds, reportlab = out.split()
+        self.assertEqual(reportlab, 'False',
+                         'importing roster.views imported reportlab')
+        self.assertTrue(float(seconds) < self.budget,
+                        'importing roster.views took %ss' % seconds)
+
+class RosterTestMixin(object):
+    """A team, a second team and the relationship types, with helpers
+    to add people to them."""
+    def setUp(self):
+        # what's cached or loaded under a version rolled back (or flushed)
+        # with another test's changes would otherwise be read again
+        cache.clear()
+        for index in (relationships._graph, search._index, choices._teams):
+            index.index = index.version = None
+        org = Organization.objects.create(name='Org')
+        program = Program.objects.create(name='FRC', longname='FIRST',
+                                         org=org, grade_start=9,
+                                         grade_end=12)
+        self.team = Team.objects.create(name='Team1', program=program,
+                                        startdate=date(2000, 1, 1))
+        self.team2 = Team.objects.create(name='Team2', program=program,
+                                         startdate=date(2000, 1, 1))
+        self.mother = RelationshipType.objects.create(type='Mother',
+                                                      parent=True,
+                                                      sort_order=1)
+        self.friend = RelationshipType.objects.create(type='Friend',
+                                                      sort_order=2)
+        self.year = date.today().year
+
+    def person(self, firstname, **kwargs):
+        kwargs.setdefault('lastname', 'Smith')
+        kwargs.setdefault('gender', 'F')
+        return Person.objects.create(firstname=firstname, **kwargs)
+
+    def member(self, person, role, status='Active', team=None):
+        return PersonTeam.objects.create(person=person, team=team or self.team,
+                                         role=role, status=status)
+
+    def relate(self, person_from, person_to, relationship=None, **kwargs):
+        return Relationship.objects.create(person_from=person_from,
+                person_to=person_to,
+                relationship=relationship or self.mother, **kwargs)
+
+    def reload(self, person):
+        return Person.objects.get(id=person.id)
+
+    def count_queries(self, function, *args, **kwargs):
+        connection.use_debug_cursor = True
+        try:
+            connection.queries = []
+            function(*args, **kwargs)
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+
+    def login(self):
+        User.objects.create_user('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+
+class RosterTestCase(RosterTestMixin, TestCase):
+    pass
+
+class RosterTransactionTestCase(RosterTestMixin, TransactionTestCase):
+    pass
+
+class ClassifyStudentsTest(RosterTestCase):
+    def setUp(self):
+        super(ClassifyStudentsTest, self).setUp()
+        year = self.year
+        self.expected = {}
+        def add(student, firstname, **kwargs):
+            person = self.person(firstname, **kwargs)
+            self.expected[person.id] = student
+            return person
+
+        # 1) a student role on any team, unless an alumnus
+        self.student = add(True, 'Student', grad_year=year - 2,
+                           birth_year=year - 30)
+        self.member(self.student, 'Student')
+        self.mentor_student = add(True, 'MentorStudent')
+        self.member(self.mentor_student, 'Mentor')
+        self.member(self.mentor_student, 'Student', team=self.team2)
+        self.alumnus = add(None, 'Alumnus')
+        self.member(self.alumnus, 'Student', status='Alumnus')
+        # 2) graduating in a later year, 3) graduated in an earlier one
+        self.graduating = add(True, 'Graduating', grad_year=year + 1)
+        self.member(self.graduating, 'Mentor')
+        self.graduated = add(False, 'Graduated', grad_year=year - 1)
+        self.relate(self.graduated, self.student)
+        # 4) older than 20
+        self.old = add(False, 'Old', birth_year=year - 21,
+                       grad_year=year)
+        self.relate(self.old, self.student)
+        self.young = add(None, 'Young', birth_year=year - 20)
+        # 5) any other role
+        self.mentor = add(False, 'Mentor')
+        self.member(self.mentor, 'Mentor', status='Alumnus')
+        self.relate(self.mentor, self.student)
+        self.alumnus_fan = add(False, 'AlumnusFan')
+        self.member(self.alumnus_fan, 'Student', status='Alumnus')
+        self.member(self.alumnus_fan, 'Fan', team=self.team2)
+        # 6) a parent
+        self.child = add(True, 'Child')
+        self.relate(self.child, self.mentor)
+        self.friend_of = add(None, 'FriendOf')
+        self.relate(self.friend_of, self.mentor, self.friend)
+        # years of two digits or less don't count
+        self.short_years = add(None, 'ShortYears', grad_year=12,
+                               birth_year=80)
+
+    def test_rules(self):
+        """
+        Each rule decides whoever the rules before it leave undecided.
+        """
+        self.assertEqual(Person.objects.classify_students(), self.expected)
+
+    def test_one_at_a_time(self):
+        """
+        Each person classified alone (as is_student does) comes out the
+        same as with everyone else.
+        """
+        for person in Person.objects.all():
+            self.assertEqual(person.is_student(), self.expected[person.id],
+                             person.firstname)
+
+    def test_subset(self):
+        """
+        Only the people asked about are classified, whether as a
+        queryset (sliced or not) or a list.
+        """
+        people = [self.student, self.mentor, self.child, self.young]
+        expected = dict((x.id, self.expected[x.id]) for x in people)
+        ids = [x.id for x in people]
+        self.assertEqual(Person.objects.classify_students(
+                Person.objects.filter(id__in=ids)), expected)
+        self.assertEqual(Person.objects.classify_students(
+                Person.objects.filter(id__in=ids).order_by('id')[:4]),
+                expected)
+        self.assertEqual(Person.objects.classify_students(people), expected)
+        self.assertEqual(Person.objects.classify_students([]), {})
+
+    def test_queries(self):
+        """
+        Everyone is classified with three queries at most.
+        """
+        with self.assertNumQueries(3):
+            Person.objects.classify_students(Person.objects.all())
+
+    def test_signin_person_list(self):
+        """
+        The sign-in list (like the badges) reads the stored column, which
+        update_students fills in for everyone, defaulting to adult.
+        """
+        Person.objects.update(student=None)
+        Person.objects.update_students()
+        self.login()
+        response = self.client.get(reverse('signin_person_list'))
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(response.content.splitlines()))[1:]
+        self.assertEqual(dict((int(row[0]), row[2]) for row in rows),
+                         dict((id, str(bool(student)))
+                              for id, student in self.expected.items()))
+
+class StudentColumnTest(RosterTestCase):
+    def setUp(self):
+        super(StudentColumnTest, self).setUp()
+        self.alice = self.person('Alice')
+        self.bob = self.person('Bob')
+
+    def assertStudents(self, alice, bob):
+        self.assertEqual(self.reload(self.alice).student, alice)
+        self.assertEqual(self.reload(self.bob).student, bob)
+
+    def test_person_saved(self):
+        """
+        Saving a person classifies them, on the instance too.
+        """
+        self.assertStudents(None, None)
+        self.alice.grad_year = self.year + 1
+        self.alice.save()
+        self.assertEqual(self.alice.student, True)
+        self.assertStudents(True, None)
+
+    def test_personteam(self):
+        """
+        Adding, changing and deleting a membership reclassifies its
+        person, and moving it to someone else reclassifies both.
+        """
+        membership = self.member(self.alice, 'Student')
+        self.assertStudents(True, None)
+        membership.role = 'Mentor'
+        membership.save()
+        self.assertStudents(False, None)
+        membership.person = self.bob
+        membership.save()
+        self.assertStudents(None, False)
+        membership.delete()
+        self.assertStudents(None, None)
+
+    def test_relationship(self):
+        """
+        The same for a parent relationship, which is a student's.
+        """
+        relationship = self.relate(self.alice, self.bob)
+        self.assertStudents(True, None)
+        relationship.person_from = self.bob
+        relationship.person_to = self.alice
+        relationship.save()
+        self.assertStudents(None, True)
+        relationship.relationship = self.friend
+        relationship.save()
+        self.assertStudents(None, None)
+        relationship.relationship = self.mother
+        relationship.save()
+        self.assertStudents(None, True)
+        relationship.delete()
+        self.assertStudents(None, None)
+
+    def test_relationshiptype(self):
+        """
+        Changing whether a type is a parent one reclassifies everyone
+        with a relationship of that type.
+        """
+        self.relate(self.alice, self.bob, self.friend)
+        self.assertStudents(None, None)
+        self.friend.parent = True
+        self.friend.save()
+        self.assertStudents(True, None)
+
+    def test_rebuild_students(self):
+        """
+        rebuild_students fixes a column left stale by changes that send
+        no signals.
+        """
+        self.member(self.alice, 'Student')
+        PersonTeam.objects.filter(person=self.alice).update(person=self.bob)
+        Person.objects.filter(id=self.alice.id).update(student=False)
+        self.assertStudents(False, None)
+        out = StringIO()
+        call_command('rebuild_students', stdout=out)
+        self.assertStudents(None, True)
+        self.assertEqual(out.getvalue(), '1 students, 0 adults, 1 unknown\n')
+
+class ActiveRolesTest(RosterTestCase):
+    def setUp(self):
+        super(ActiveRolesTest, self).setUp()
+        self.alice = self.person('Alice', grad_year=2010)
+        self.member(self.alice, 'Mentor', team=self.team2)
+        self.member(self.alice, 'Student', status='Prospective')
+        self.bob = self.person('Bob', grad_year=2011)
+        self.member(self.bob, 'Fan', status='Pending')
+        self.member(self.bob, 'Student', status='Alumnus', team=self.team2)
+        self.carol = self.person('Carol', grad_year=2011)
+        self.member(self.carol, 'Mentor')
+
+    def add_people(self, count):
+        for i in xrange(count):
+            person = self.person('Extra%d' % i, grad_year=2010)
+            self.member(person, 'Student')
+            self.member(person, 'Mentor', team=self.team2)
+
+    def test_batched(self):
+        """
+        The roles selected for a whole queryset read the same as those
+        each person selects for themself: active and prospective ones
+        only, in the order they were added.
+        """
+        people = Person.objects.order_by('id')
+        expected = ['Team2 (Mentor), Team1 (Prospective Student)', '',
+                    'Team1 (Mentor)']
+        self.assertEqual([x.active_roles() for x in people], expected)
+        batched = list(people.batch_select(active_personteams=ACTIVE_ROLES))
+        with self.assertNumQueries(0):
+            self.assertEqual([x.active_roles() for x in batched], expected)
+
+    def test_admin_changelist(self):
+        """
+        The admin's person list takes as many queries whatever the
+        number of people on the page.
+        """
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        url = reverse('admin:roster_person_changelist')
+        count = self.count_queries(self.client.get, url)
+        self.assertContains(self.client.get(url), 'Team1 (Mentor)')
+        self.add_people(5)
+        with self.assertNumQueries(count):
+            response = self.client.get(url)
+        self.assertContains(response, 'Team1 (Student), Team2 (Mentor)', 5)
+
+    def test_class_team_list(self):
+        """
+        So does the class team list.
+        """
+        self.login()
+        url = reverse('class_team_list')
+        data = {'class_begin': 2010, 'class_end': 2011}
+        count = self.count_queries(self.client.get, url, data)
+        self.assertContains(self.client.get(url, data),
+                            'Team2 (Mentor), Team1 (Prospective Student)')
+        self.add_people(5)
+        with self.assertNumQueries(count):
+            response = self.client.get(url, data)
+        self.assertContains(response, 'Team1 (Student), Team2 (Mentor)', 5)
+
+class ImportPeopleTest(RosterTestCase):
+    def setUp(self):
+        super(ImportPeopleTest, self).setUp()
+        self.email = Email.objects.create(email='shared@example.com',
+                                          location='Home')
+        self.phone = Phone.objects.create(phone='555-555-0100',
+                                          location='Home')
+        self.address = Address.objects.create(line1='1 Main St', city='Town',
+                                              state='MI', zipcode='48000')
+        self.existing = self.person('Existing', lastname='Person')
+
+    def import_csv(self, text, **options):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, text)
+        os.close(handle)
+        out, err = StringIO(), StringIO()
+        try:
+            call_command('import_people', path, stdout=out, stderr=err,
+                         **options)
+        finally:
+            os.remove(path)
+        return out.getvalue(), err.getvalue()
+
+    def test_import(self):
+        """
+        Rows are imported with their through rows, reusing the emails,
+        phones and addresses already there (or earlier in the file), and
+        the bad ones are reported by line.
+        """
+        out, err = self.import_csv(
+            'firstname,lastname,gender,grad_year,email,home_phone,'
+            'mobile_phone,primary_phone,line1,city,state,zipcode,role\n'
+            'Ann,New,F,,shared@example.com,555-555-0100,555-555-0101,Mobile,'
+            '1 Main St,Town,MI,48000,\n'
+            'Ben,New,M,,ben@example.com,555-555-0101,,,2 Main St,Town,MI,'
+            '48000,Mentor\n'
+            'Cat,New,X,,,,,,,,,,\n'
+            'Existing,Person,F,,,,,,,,,,\n'
+            'Dan,New,M,,,555-0100,,,,,,,\n', team='Team1', role='Student')
+        self.assertEqual(err.splitlines(), [
+            'line 4: gender: Value u\'X\' is not a valid choice.',
+            'line 5: Existing Person  is already in the roster',
+            'line 6: Phone numbers must be in XXX-XXX-XXXX format.'])
+        self.assertTrue(out.startswith('Imported 2 people (3 rows skipped)'))
+
+        ann = Person.objects.get(firstname='Ann', lastname='New')
+        ben = Person.objects.get(firstname='Ben', lastname='New')
+        self.assertEqual(Email.objects.count(), 2)
+        self.assertEqual(Phone.objects.count(), 2)
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(list(ann.emails.all()), [self.email])
+        self.assertEqual([x.primary for x in
+                          PersonEmail.objects.filter(person=ann)], [True])
+        self.assertEqual(sorted((x.phone.phone, x.primary) for x in
+                                PersonPhone.objects.filter(person=ann)),
+                         [('555-555-0100', False), ('555-555-0101', True)])
+        self.assertEqual([(x.phone.phone, x.primary) for x in
+                          PersonPhone.objects.filter(person=ben)],
+                         [('555-555-0101', True)])
+        self.assertEqual(list(ann.addresses.all()), [self.address])
+        self.assertEqual(ben.addresses.get().line1, '2 Main St')
+        self.assertEqual([(x.team, x.role, x.status) for x in
+                          PersonTeam.objects.filter(person__lastname='New')
+                                            .order_by('person__firstname')],
+                         [(self.team, 'Student', 'Active'),
+                          (self.team, 'Mentor', 'Active')])
+
+    def test_brought_up_to_date(self):
+        """
+        bulk_create sends no signals, but the student column, the
+        resolved audiences and the name index all see the people
+        imported.
+        """
+        from roster.audience import Audience
+        from roster.search import _index, search_people
+        students = Audience(['Student'], ['Active'], [self.team.id])
+        self.assertEqual(students.person_ids(), [])
+        self.assertEqual(search_people('ann'), [])
+        # (a test's changes are never committed, so the name index is
+        # loaded again on every search anyway: check its version too)
+        version = _index.shared_version.get()
+        self.import_csv('firstname,lastname,gender\nAnn,New,F\n',
+                        team='Team1', role='Student')
+        ann = Person.objects.get(firstname='Ann')
+        self.assertEqual(ann.student, True)
+        self.assertEqual(students.person_ids(), [ann.id])
+        self.assertEqual(search_people('ann'), [(ann.id, 'Ann New')])
+        self.assertTrue(_index.shared_version.get() > version)
+
+    def test_dry_run(self):
+        """
+        A dry run only validates.
+        """
+        out, err = self.import_csv('firstname,lastname,gender\nAnn,New,F\n',
+                                   dry_run=True)
+        self.assertTrue(out.startswith('Validated 1 people'))
+        self.assertFalse(Person.objects.filter(firstname='Ann').exists())
+
+class AudienceTest(RosterTestCase):
+    def setUp(self):
+        super(AudienceTest, self).setUp()
+        self.student = self.person('Student')
+        self.member(self.student, 'Student')
+        self.member(self.student, 'Student', 'Alumnus', self.team2)
+        self.mum = self.person('Mum')
+        self.relate(self.student, self.mum, cc_on_email=True)
+        self.prospect = self.person('Prospect')
+        self.member(self.prospect, 'Student', 'Prospective', self.team2)
+        self.dad = self.person('Dad')
+        self.member(self.dad, 'Mentor', team=self.team2)
+        self.relate(self.prospect, self.dad)
+        self.mentor = self.person('Mentor')
+        self.member(self.mentor, 'Mentor')
+        self.member(self.mentor, 'Fan', 'Prospective', self.team2)
+        self.spouse = self.person('Spouse')
+        self.relate(self.mentor, self.spouse, self.friend, cc_on_email=True)
+        self.friend_of = self.person('FriendOf')
+        self.relate(self.student, self.friend_of, self.friend)
+        self.person('Nobody')
+
+    def old_people(self, roles, status, teams, parents=False,
+                   cc_on_email=False):
+        # how the report views found their people before Audience
+        people = PersonTeam.objects.filter(role__in=roles,
+                status__in=status, team__in=teams).values('person')
+        results = Person.objects.filter(id__in=people)
+        if parents:
+            parent_relationships = RelationshipType.objects\
+                    .filter(parent=True).values('id')
+            students = PersonTeam.objects.filter(role='Student',
+                    status__in=status, team__in=teams).values('person')
+            results |= Person.objects.filter(id__in=Relationship.objects
+                    .filter(person_from__in=students,
+                            relationship__in=parent_relationships)
+                    .values('person_to'))
+        if cc_on_email:
+            results |= Person.objects.filter(id__in=Relationship.objects
+                    .filter(person_from__in=people, cc_on_email=True)
+                    .values('person_to'))
+        return set(results.distinct().values_list('id', flat=True))
+
+    def criteria(self):
+        teams = [self.team.id, self.team2.id]
+        for roles in (['Student'], ['Mentor', 'Fan'],
+                      ['Student', 'Mentor', 'Fan'], []):
+            for status in (['Active'], ['Active', 'Prospective'],
+                           ['Alumnus']):
+                for team_ids in (teams[:1], teams[1:], teams):
+                    for parents in (False, True):
+                        for cc_on_email in (False, True):
+                            yield (roles, status, team_ids, parents,
+                                   cc_on_email)
+
+    def test_matches_old_querysets(self):
+        """
+        The audience is who the views' ORed querysets found, for each
+        combination of roles, status, teams, parents and cc_on_email.
+        """
+        from roster.audience import Audience
+        for criteria in self.criteria():
+            expected = self.old_people(*criteria)
+            audience = Audience(*criteria)
+            self.assertEqual(set(audience.person_ids()), expected, criteria)
+            self.assertEqual(set(audience.people()
+                                 .values_list('id', flat=True)),
+                             expected, criteria)
+            # and selected with subqueries when there are a lot of them
+            audience.max_ids = 0
+            self.assertEqual(set(audience.people()
+                                 .values_list('id', flat=True)),
+                             expected, criteria)
+
+    def test_parent_links(self):
+        """
+        Each parent is linked to the student they're in the audience for.
+        """
+        from roster.audience import Audience
+        audience = Audience(['Student'], ['Active', 'Prospective'],
+                            [self.team.id, self.team2.id], parents=True)
+        self.assertEqual(audience.parent_links(),
+                         {self.mum.id: self.student.id,
+                          self.dad.id: self.prospect.id})
+        self.assertEqual(Audience(['Student'], ['Active'], [self.team.id])
+                         .parent_links(), {})
+
+    def test_invalidated(self):
+        """
+        The cached ids are resolved again after a membership or
+        relationship is saved or deleted.
+        """
+        from roster.audience import Audience
+        audience = Audience(['Student'], ['Active'], [self.team.id],
+                            parents=True)
+        ids = lambda: sorted(audience.person_ids())
+        self.assertEqual(ids(), [self.student.id, self.mum.id])
+        with self.assertNumQueries(1):
+            # the version, then the ids from the cache
+            ids()
+
+        membership = self.member(self.prospect, 'Student')
+        self.assertEqual(ids(), [self.student.id, self.mum.id,
+                                 self.prospect.id, self.dad.id])
+        relationship = Relationship.objects.get(person_from=self.prospect)
+        relationship.relationship = self.friend
+        relationship.save()
+        self.assertEqual(ids(), [self.student.id, self.mum.id,
+                                 self.prospect.id])
+        membership.delete()
+        self.assertEqual(ids(), [self.student.id, self.mum.id])
+        Relationship.objects.get(person_to=self.mum).delete()
+        self.assertEqual(ids(), [self.student.id])
+
+class RelationshipGraphTest(RosterTestCase):
+    def setUp(self):
+        super(RelationshipGraphTest, self).setUp()
+        self.student = self.person('Student')
+        self.mum = self.person('Mum')
+        self.aunt = self.person('Aunt')
+        self.coach = self.person('Coach')
+        self.mum_relationship = self.relate(self.student, self.mum,
+                legal_guardian=True, emergency_contact=True,
+                cc_on_email=True)
+        self.aunt_relationship = self.relate(self.student, self.aunt,
+                self.friend, emergency_contact=True)
+        self.coach_relationship = self.relate(self.student, self.coach,
+                self.friend, cc_on_email=True)
+        self.relate(self.aunt, self.coach, self.friend)
+
+    def test_edges(self):
+        """
+        Each kind of edge comes from its own flag, and parent ones from
+        the relationship type.
+        """
+        graph = relationships.get_graph()
+        student = self.student.id
+        expected = {'parent': [self.mum_relationship],
+                    'legal_guardian': [self.mum_relationship],
+                    'emergency_contact': [self.mum_relationship,
+                                          self.aunt_relationship],
+                    'cc_on_email': [self.mum_relationship,
+                                    self.coach_relationship]}
+        for kind, edges in expected.items():
+            self.assertEqual([(x.id, x.person_to_id, x.relationship)
+                              for x in graph.relationships(student, kind)],
+                             [(x.id, x.person_to_id, x.relationship)
+                              for x in edges], kind)
+            self.assertEqual(graph.related([student], kind),
+                             set(x.person_to_id for x in edges), kind)
+            self.assertEqual(graph.links([student], kind),
+                             dict((x.person_to_id, student) for x in edges),
+                             kind)
+            self.assertEqual(graph.related([self.aunt.id], kind), set())
+
+    def test_get_relationships(self):
+        """
+        The people related come with the relationships.
+        """
+        guardians = relationships.get_relationships(self.student.id,
+                                                    'legal_guardian')
+        with self.assertNumQueries(0):
+            self.assertEqual([x.person_to for x in guardians], [self.mum])
+            self.assertEqual([x.relationship for x in guardians],
+                             [self.mother])
+
+class RelationshipGraphUpdateTest(RosterTransactionTestCase):
+    def setUp(self):
+        super(RelationshipGraphUpdateTest, self).setUp()
+        self.student = self.person('Student')
+        self.sister = self.person('Sister')
+        self.mum = self.person('Mum')
+        self.dad = self.person('Dad')
+        self.mum_relationship = self.relate(self.student, self.mum,
+                                            legal_guardian=True)
+        self.graph = relationships.get_graph()
+
+    def guardians(self, graph, person):
+        return [x.person_to_id
+                for x in graph.relationships(person.id, 'legal_guardian')]
+
+    def test_updated(self):
+        """
+        A process updates its graph with the relationships changed since
+        it was loaded, reading only those.
+        """
+        dad_relationship = self.relate(self.student, self.dad,
+                                       legal_guardian=True)
+        with self.assertNumQueries(2):
+            graph = relationships.get_graph()
+        self.assertEqual(self.guardians(graph, self.student),
+                         [self.mum.id, self.dad.id])
+        # the graph it was made from is never changed
+        self.assertEqual(self.guardians(self.graph, self.student),
+                         [self.mum.id])
+
+        # moved to someone else, and deleted
+        self.mum_relationship.person_from = self.sister
+        self.mum_relationship.save()
+        dad_relationship.delete()
+        with self.assertNumQueries(2):
+            graph = relationships.get_graph()
+        self.assertEqual(self.guardians(graph, self.student), [])
+        self.assertEqual(self.guardians(graph, self.sister), [self.mum.id])
+        self.assertEqual(graph.related([self.student.id], 'parent'), set())
+        self.assertEqual(graph.related([self.sister.id], 'parent'),
+                         set([self.mum.id]))
+        self.assertEqual(sorted(graph.rows),
+                         sorted(relationships.RelationshipGraph.load().rows))
+
+    def test_loaded(self):
+        """
+        It loads the whole graph again after a change to the types, or
+        if the changes have been evicted from the cache.
+        """
+        self.mother.parent = False
+        self.mother.save()
+        with self.assertNumQueries(3):
+            graph = relationships.get_graph()
+        self.assertEqual(graph.related([self.student.id], 'parent'), set())
+
+        self.relate(self.student, self.dad, legal_guardian=True)
+        cache.clear()
+        with self.assertNumQueries(3):
+            graph = relationships.get_graph()
+        self.assertEqual(self.guardians(graph, self.student),
+                         [self.mum.id, self.dad.id])
+
+    def test_missing_person(self):
+        """
+        Someone related who isn't in the database any more (deleted
+        without signals) has the graph loaded again.
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM roster_relationship WHERE id = %s',
+                       [self.mum_relationship.id])
+        cursor.execute('DELETE FROM roster_person WHERE id = %s',
+                       [self.mum.id])
+        transaction.commit_unless_managed()
+        self.assertTrue(relationships.get_graph() is self.graph)
+        self.assertEqual(relationships.get_relationships(self.student.id,
+                                                         'legal_guardian'),
+                         [])
+        self.assertEqual(self.guardians(relationships.get_graph(),
+                                        self.student), [])
+
+class NameIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.index = search.NameIndex([
+            (1, u'Ann', u'Smith', u'', u''),
+            (2, u'Andrew', u'Smithers', u'Jr.', u'Andy'),
+            (3, u'Zoe', u'Anderson', u'', u''),
+            (4, u'Sean', u"O'Brien", u'', u''),
+            (5, u'Ren\xe9e', u'Adams', u'', u''),
+            (6, u'Anna', u'Smith', u'', u'')])
+
+    def test_prefix(self):
+        """
+        Each word searched for starts a first, last or nick name, and
+        matches are in name order.
+        """
+        search_people = self.index.search
+        self.assertEqual([pk for pk, name in search_people('an')],
+                         [3, 1, 6, 2])
+        self.assertEqual(search_people('smi an'),
+                         [(1, u'Ann Smith'), (6, u'Anna Smith'),
+                          (2, u'Andy Smithers Jr.')])
+        self.assertEqual(search_people('ANDY smithers'),
+                         [(2, u'Andy Smithers Jr.')])
+        self.assertEqual(search_people('ann smithers'), [])
+        self.assertEqual(search_people(''), [])
+
+    def test_accents_and_punctuation(self):
+        """
+        Accents and punctuation needn't be typed.
+        """
+        search_people = self.index.search
+        self.assertEqual(search_people('renee'), [(5, u'Ren\xe9e Adams')])
+        self.assertEqual(search_people("o'br"), [(4, u"Sean O'Brien")])
+        self.assertEqual(search_people('obr'), [(4, u"Sean O'Brien")])
+        self.assertEqual(search_people('brien'), [(4, u"Sean O'Brien")])
+
+    def test_limit(self):
+        """
+        Only the first limit matches (in name order) are given.
+        """
+        self.assertEqual(self.index.search('a', limit=2),
+                         [(5, u'Ren\xe9e Adams'), (3, u'Zoe Anderson')])
+        self.assertEqual(self.index.search('smith', limit=1),
+                         [(1, u'Ann Smith')])
+
+class PersonSearchTest(RosterTestCase):
+    def setUp(self):
+        super(PersonSearchTest, self).setUp()
+        self.ann = self.person('Ann')
+        self.anna = self.person('Anna')
+        self.bob = self.person('Bob', lastname='Jones')
+
+    def test_view(self):
+        """
+        The autocomplete view gives the matches as JSON, up to a limit
+        (of 50 at most), searching q or jQuery UI's term.
+        """
+        import json
+        self.login()
+        url = reverse('person_search')
+        response = self.client.get(url, {'q': 'an smi'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), [
+            {'id': self.ann.id, 'label': 'Ann Smith', 'value': 'Ann Smith'},
+            {'id': self.anna.id, 'label': 'Anna Smith',
+             'value': 'Anna Smith'}])
+        response = self.client.get(url, {'term': 'an', 'limit': '1'})
+        self.assertEqual([x['id'] for x in json.loads(response.content)],
+                         [self.ann.id])
+        response = self.client.get(url, {'term': 'jo', 'limit': 'x'})
+        self.assertEqual([x['id'] for x in json.loads(response.content)],
+                         [self.bob.id])
+
+    def test_names_changed(self):
+        """
+        Only a change to someone's names has every process load the
+        index again.
+        """
+        version = search._index.shared_version.get()
+        self.ann.medical = 'None'
+        self.ann.save()
+        self.assertEqual(search._index.shared_version.get(), version)
+        self.ann.nickname = 'Annie'
+        self.ann.save()
+        self.assertEqual(search._index.shared_version.get(), version + 1)
+        self.assertEqual(search.search_people('annie'),
+                         [(self.ann.id, 'Annie Smith')])
+        self.person('Annabel')
+        self.assertEqual(search._index.shared_version.get(), version + 2)
+        self.bob.delete()
+        self.assertEqual(search._index.shared_version.get(), version + 3)
+
+class LookupFieldTest(RosterTestCase):
+    def setUp(self):
+        super(LookupFieldTest, self).setUp()
+        self.ann = self.person('Ann')
+
+    def form(self, person):
+        from roster.forms import RegInitialForm
+        return RegInitialForm({'usertype': 'returning', 'person': person})
+
+    def test_clean(self):
+        """
+        A person's id cleans to the person, in one query.
+        """
+        form = self.form(str(self.ann.id))
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['person'], self.ann)
+
+    def test_invalid(self):
+        """
+        An id no one has, or one that isn't a number, is an error.
+        """
+        for value in (str(self.ann.id + 100), 'Ann'):
+            form = self.form(value)
+            self.assertFalse(form.is_valid())
+            self.assertEqual(form.errors['person'], [
+                'Select a valid choice. That choice is not one of the '
+                'available choices.'], value)
+        form = self.form('')
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['person'],
+                         ['Must select person if returning.'])
+
+    def test_render(self):
+        """
+        The widget shows the name of the person picked, with their id in
+        the hidden input.
+        """
+        from roster.forms import RegInitialForm
+        def inputs(form):
+            # the attributes of the text box and the hidden input
+            html = unicode(form['person'])
+            return [dict(re.findall(r'([\w-]+)="([^"]*)"', x))
+                    for x in re.findall(r'<input([^>]*)/>', html)]
+        lookup, hidden = inputs(RegInitialForm(
+                initial={'person': self.ann.id}))
+        self.assertEqual((lookup['type'], lookup['value'],
+                          lookup['data-source'], lookup['data-target']),
+                         ('text', 'Ann Smith', reverse('person_search'),
+                          'id_person'))
+        self.assertEqual((hidden['type'], hidden['name'], hidden['value']),
+                         ('hidden', 'person', str(self.ann.id)))
+        lookup, hidden = inputs(RegInitialForm())
+        self.assertEqual((lookup['value'], hidden['value']), ('', ''))
+        lookup, hidden = inputs(self.form('Ann'))
+        self.assertEqual((lookup['value'], hidden['value']), ('', 'Ann'))
+
+class TeamChoicesTest(RosterTransactionTestCase):
+    def setUp(self):
+        super(TeamChoicesTest, self).setUp()
+        self.team2.reg_show = False
+        self.team2.save()
 
+    def test_new_and_deleted(self):
+        """
+        The choices are loaded once, and again after a team is added,
+        renamed or deleted.
+        """
+        from roster.forms import TeamReportForm
+        team_choices = choices.team_choices
+        expected = [(self.team.id, 'Team1'), (self.team2.id, 'Team2')]
+        self.assertEqual(team_choices(), expected)
+        with self.assertNumQueries(1):
+            # the version
+            self.assertEqual(TeamReportForm().fields['team'].choices,
+                             expected)
+
+        team3 = Team.objects.create(name='Team0', program=self.team.program,
+                                    startdate=date(2000, 1, 1))
+        self.assertEqual(team_choices(), [(team3.id, 'Team0')] + expected)
+        self.team.name = 'Team4'
+        self.team.save()
+        self.assertEqual(team_choices(), [(team3.id, 'Team0'),
+                                          (self.team2.id, 'Team2'),
+                                          (self.team.id, 'Team4')])
+        team3.delete()
+        self.assertEqual(team_choices(), [(self.team2.id, 'Team2'),
+                                          (self.team.id, 'Team4')])
+
+    def test_reg_show(self):
+        """
+        The new year form only offers the teams shown on registration.
+        """
+        from roster.forms import NewYearForm, TeamReportForm
+        self.assertEqual(NewYearForm().fields['team'].choices,
+                         [(self.team.id, 'Team1')])
+        self.assertEqual(TeamReportForm().fields['team'].choices,
+                         [(self.team.id, 'Team1'), (self.team2.id, 'Team2')])
+        form = NewYearForm({'who': ['Student'], 'team': [self.team2.id]})
+        self.assertFalse(form.is_valid())
+        self.assertTrue('team' in form.errors)
+
+class SharedVersionTest(RosterTransactionTestCase):
+    def test_rows(self):
+        """
+        syncdb (and flush) create a row for each version, so a bump is
+        one UPDATE.
+        """
+        from roster import versioned
+        self.assertEqual(set(Version.objects.values_list('key', flat=True)),
+                         set(versioned.keys))
+        version = choices._teams.shared_version
+        before = version.get()
+        with self.assertNumQueries(1):
+            version.bump()
+        self.assertEqual(version.get(), before + 1)
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+    def test_once_per_request(self):
         """
-        Tests that 1 + 1 always equals 2.
+        In a request, a version is read from the database once, and
+        again only after this process bumps it.
         """
-        self.assertEqual(1 + 1, 2)
+        from django.core.signals import request_started, request_finished
+        version = choices._teams.shared_version
+        choices.team_choices()
+        request_started.send(sender=self.__class__)
+        try:
+            with self.assertNumQueries(1):
+                before = version.get()
+                version.get()
+                choices.team_choices()
+            Version.objects.filter(key=version.key).update(version=100)
+            self.assertEqual(version.get(), before)
+            version.bump()
+            self.assertEqual(version.get(), 101)
+        finally:
+            request_finished.send(sender=self.__class__)
+        with self.assertNumQueries(2):
+            version.get()
+            version.get()
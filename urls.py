@@ -16,6 +16,7 @@ urlpatterns = patterns('roster.views',
     url(r'^badges/$', 'badges', name="badges"),
     url(r'^class_team_list/$', 'class_team_list', name="class_team_list"),
     url(r'^signin_person_list/$', 'signin_person_list', name="signin_person_list"),
+    url(r'^person_search/$', 'person_search', name="person_search"),
     url(r'^time_record_bulk_add/$', 'time_record_bulk_add', name="time_record_bulk_add"),
     url(r'^registration/$', 'registration', name="registration"),
     url(r'^new_year/$', 'new_year', name="new_year"),
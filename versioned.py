@@ -0,0 +1,132 @@
+# Data each process keeps a copy of, kept in step through the database
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.db import transaction
+from django.db.models import F
+from django.dispatch import receiver
+
+from roster.models import Version
+
+import threading
+
+# the keys of every SharedVersion, whose rows syncdb creates
+keys = []
+
+# the versions read in this thread during the current request
+_request = threading.local()
+
+@receiver(request_started)
+def _request_started(sender, **kwargs):
+    _request.versions = {}
+
+@receiver(request_finished)
+def _request_finished(sender, **kwargs):
+    _request.versions = None
+
+class SharedVersion(object):
+    """A version number in the database, bumped whenever the data it's
+    the version of changes in any process.  The bump is part of the
+    transaction making the change, so other processes see the new
+    version when they can see the change, and never if it's rolled
+    back.  It's read once per request (and whenever it's read outside
+    one), and again after a bump by the same process."""
+    def __init__(self, key):
+        self.key = key
+        keys.append(key)
+
+    def get(self):
+        versions = getattr(_request, 'versions', None)
+        if versions is not None and self.key in versions:
+            return versions[self.key]
+        version = Version.objects.filter(key=self.key)\
+                                 .values_list('version', flat=True)
+        version = version and version[0] or 0
+        if versions is not None:
+            versions[self.key] = version
+        return version
+
+    def bump(self):
+        # the row is there from syncdb (see create_versions), so this is
+        # one UPDATE, which waits for any other transaction bumping it
+        Version.objects.filter(key=self.key)\
+                       .update(version=F('version') + 1)
+        versions = getattr(_request, 'versions', None)
+        if versions is not None:
+            versions.pop(self.key, None)
+
+def create_versions(**kwargs):
+    """Creates the row of each SharedVersion that's missing, connected
+    to post_syncdb (which flush sends too)."""
+    # the modules with the versions, so they're all in keys
+    from roster import audience, choices, relationships, search
+    existing = set(Version.objects.values_list('key', flat=True))
+    for key in keys:
+        if key not in existing:
+            Version.objects.create(key=key)
+
+class ProcessIndex(object):
+    """An index loaded from the database into each process, and loaded
+    again when any process changes what it was loaded from.  load makes
+    a new index, which is never changed after (so it can be read without
+    a lock, while another thread swaps in a newer one); call changed
+    from signal receivers.
+
+    If given, update(index, changes) makes a new index from an older one
+    and the changes made since (what changed was called with for each
+    version, in order), or returns None if it can't.  The changes are
+    kept in the cache, and a process with an index too many versions old
+    (or whose changes have been evicted) loads it whole."""
+    max_changes = 100
+
+    def __init__(self, key, load, update=None):
+        self.key = key
+        self.shared_version = SharedVersion(key)
+        self.load = load
+        self.update = update
+        self.index = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def _change_key(self, version):
+        return '%s:change:%d' % (self.key, version)
+
+    def _updated(self, version):
+        if (self.update is None or self.index is None or
+                self.version is None or
+                not 0 < version - self.version <= self.max_changes):
+            return None
+        keys = [self._change_key(x)
+                for x in xrange(self.version + 1, version + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) < len(keys):
+            return None
+        return self.update(self.index, [changes[key] for key in keys])
+
+    def get(self, reload=False):
+        """The index, up to date with every process's committed changes
+        (or loaded again anyway if reload)."""
+        version = self.shared_version.get()
+        with self.lock:
+            if reload or self.index is None or self.version != version:
+                index = None
+                if not reload:
+                    index = self._updated(version)
+                if index is None:
+                    index = self.load()
+                self.index = index
+                # what's loaded in a transaction with changes still to
+                # be committed may be rolled back, so load again after
+                if transaction.is_dirty():
+                    self.version = None
+                else:
+                    self.version = version
+            return self.index
+
+    def changed(self, change=None):
+        """Have every process (this one included) load again, or update
+        with change, once the change is committed."""
+        self.shared_version.bump()
+        if self.update is not None:
+            # a rolled back change's entry is replaced by whatever
+            # change next gets its version, before that is committed
+            cache.set(self._change_key(self.shared_version.get()), change)
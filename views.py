@@ -1,6 +1,6 @@
 # Roster views
 from django.http import HttpResponse
-from django.utils.html import escape, linebreaks
+from django.utils.html import linebreaks
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.template import RequestContext
@@ -9,38 +9,27 @@ from django.views.decorators.csrf import csrf_exempt
 from django.db import transaction
 from django.contrib.formtools.wizard.views import SessionWizardView
 
-from settings import MEDIA_ROOT
-
 from roster.models import *
 from roster.forms import *
+from roster.audience import Audience
+from roster.relationships import get_graph, get_relationships
+from roster.search import search_people
+from batch_select.models import Batch
 
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter, landscape
-from reportlab.lib.units import inch
-from reportlab.platypus import Paragraph, BaseDocTemplate, SimpleDocTemplate, Table, TableStyle, PageBreak, ActionFlowable, Frame, PageTemplate
-from reportlab.platypus.flowables import Flowable
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.utils import ImageReader
-from reportlab.graphics.barcode import code39
-
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-pdfmetrics.registerFont(TTFont('Calibri', 'calibri.ttf'))
-pdfmetrics.registerFont(TTFont('Calibri-Bold', 'calibrib.ttf'))
-pdfmetrics.registerFont(TTFont('Calibri-Italic', 'calibrii.ttf'))
-
-import os
 import csv
-import math
-
-team_color1 = (55.0/255.0, 88.0/255.0, 150.0/255.0)
-team_color2 = (236.0/255.0, 108.0/255.0, 29.0/255.0)
+import json
 
 @login_required(login_url='/roster/login/')
 def front(request):
     return render_to_response("roster/front.html", locals(),
                               context_instance=RequestContext(request))
 
+def email_list_results(audience):
+    """The primary emails of the audience, as the email list shows them."""
+    return PersonEmail.objects.filter(primary=True,
+            person__in=audience.people())\
+            .select_related('person', 'email.email')
+
 @login_required(login_url='/roster/login/')
 def email_list(request):
     """Team email list."""
@@ -52,30 +41,15 @@ def email_list(request):
             include_parents = 'Parent' in who
             who.discard('Parent')
 
-            people = PersonTeam.objects.filter(role__in=who,
-                    status__in=form.data.getlist('status'),
-                    team__in=form.data.getlist('team')).values('person')
-
-            results = PersonEmail.objects.filter(primary=True, person__in=people)
-
-            # Follow relationship to parents from students if enabled.
-            if include_parents:
-                parent_relationships = RelationshipType.objects.filter(parent=True).values('id')
-                students = PersonTeam.objects.filter(role='Student',
-                        status__in=form.data.getlist('status'),
-                        team__in=form.data.getlist('team')).values('person')
-                parents = Relationship.objects.filter(person_from__in=students,
-                        relationship__in=parent_relationships).values('person_to')
-                results |= PersonEmail.objects.filter(primary=True, person__in=parents)
-
-            # CC on emails if enabled.  Only does one level.
-            if results and 'cc_on_email' in form.data:
-                cc = Relationship.objects.filter(person_from__in=people,
-                        cc_on_email=True).values('person_to')
-                results |= PersonEmail.objects.filter(primary=True, person__in=cc)
+            # Follow relationship to parents from students and CC on
+            # emails if enabled.  CC only does one level.
+            audience = Audience(who, form.data.getlist('status'),
+                                form.data.getlist('team'),
+                                parents=include_parents,
+                                cc_on_email='cc_on_email' in form.data)
 
-            # Uniquify and get related info to avoid additional queries
-            results = results.select_related('person', 'email.email').distinct()
+            # Get related info to avoid additional queries
+            results = email_list_results(audience)
 
             include_name = 'include_name' in form.data
             separator = form.data['separator']
@@ -86,6 +60,15 @@ def email_list(request):
     return render_to_response("roster/email_list.html", locals(),
                               context_instance=RequestContext(request))
 
+def contact_list_results(audience, status, teams):
+    """The audience, with the phones, memberships of status on teams and
+    primary emails the contact list shows selected in."""
+    return audience.people(Person.objects.batch_select(
+            Batch('phones').cache(),
+            memberships=Batch('personteam_set', status__in=status,
+                              team__in=teams),
+            primary_emails=Batch('emails').through(primary=True)))
+
 @login_required(login_url='/roster/login/')
 def contact_list(request):
     """Team contact list (phone and email)."""
@@ -102,42 +85,42 @@ def contact_list(request):
             team_index = dict((int(x[1]), x[0]) for x in enumerate(teams))
             print team_index
 
-            people = PersonTeam.objects.filter(role__in=who,
-                    status__in=status, team__in=teams).values('person')
-
-            results = Person.objects.batch_select('phones')\
-                    .filter(id__in=people)
-
             # Follow relationship to parents from students if enabled.
-            if include_parents:
-                parent_relationships = RelationshipType.objects.filter(parent=True).values('id')
-                students = PersonTeam.objects.filter(role='Student',
-                        status__in=form.data.getlist('status'),
-                        team__in=form.data.getlist('team')).values('person')
-                parents = Relationship.objects.filter(person_from__in=students,
-                        relationship__in=parent_relationships)
-                parents_map = dict(parents.values_list('person_to', 'person_from'))
-                results |= Person.objects.batch_select('phones')\
-                        .filter(id__in=parents_map.keys())
+            audience = Audience(who, status, teams, parents=include_parents)
+            results = contact_list_results(audience, status, teams)
 
-            # Uniquify and get related info to avoid additional queries
-            results = results.distinct()
+            if include_parents:
+                parents_map = audience.parent_links()
+                parent_memberships = {}
+                for x in PersonTeam.objects.filter(
+                        person__in=parents_map.values(),
+                        status__in=status, team__in=teams):
+                    parent_memberships.setdefault(x.person_id, []).append(x)
 
             cc_on_email = 'cc_on_email' in form.data
+            if cc_on_email:
+                results = list(results)
+                graph = get_graph()
+                cc_map = dict((x.id, graph.related([x.id], 'cc_on_email'))
+                              for x in results)
+                cc_email_map = {}
+                for pe in PersonEmail.objects.filter(primary=True,
+                        person__in=set().union(*cc_map.values()))\
+                        .select_related('email'):
+                    cc_email_map.setdefault(pe.person_id, set()).add(pe.email)
+
             final_results = []
             for result in results:
                 name = result.render_normal()
 
                 roles = [""]*len(teams)
                 if include_parents and result.id in parents_map:
-                    for x in PersonTeam.objects.filter(person__id=parents_map[result.id],
-                            status__in=status, team__in=teams):
-                        roles[team_index[x.team.id]] = "%sParent" % \
+                    for x in parent_memberships.get(parents_map[result.id], []):
+                        roles[team_index[x.team_id]] = "%sParent" % \
                             (x.status == 'Prospective' and "Prospective " or "",)
 
-                for x in PersonTeam.objects.filter(person=result,
-                        status__in=status, team__in=teams):
-                    roles[team_index[x.team.id]] = "%s%s" % \
+                for x in result.memberships:
+                    roles[team_index[x.team_id]] = "%s%s" % \
                          (x.status == 'Prospective' and "Prospective " or "",
                           x.role)
 
@@ -149,14 +132,11 @@ def contact_list(request):
                     elif phone.location == 'Home':
                         home = phone.render_normal()
 
-                emails = [pe.email for pe in
-                        PersonEmail.objects.filter(primary=True, person=result)]
+                emails = result.primary_emails
                 cc_emails = []
                 if cc_on_email:
-                    cc = Relationship.objects.filter(person_from=result,
-                            cc_on_email=True).values('person_to')
-                    cc_emails = sorted(set(pe.email for pe in
-                            PersonEmail.objects.filter(primary=True, person__in=cc)))
+                    cc_emails = sorted(set().union(*[cc_email_map.get(x, ())
+                                                     for x in cc_map[result.id]]))
 
                 final_results.append(dict(name=name, roles=roles, cell=cell,
                                           home=home, emails=emails,
@@ -185,25 +165,21 @@ def phone_list(request):
             team_index = dict((int(x[1]), x[0]) for x in enumerate(teams))
             print team_index
 
-            people = PersonTeam.objects.filter(role__in=who,
-                    status__in=status, team__in=teams).values('person')
-
-            results = Person.objects.batch_select('phones').filter(id__in=people)
-
             # Follow relationship to parents from students if enabled.
-            if include_parents:
-                parent_relationships = RelationshipType.objects.filter(parent=True).values('id')
-                students = PersonTeam.objects.filter(role='Student',
-                        status__in=form.data.getlist('status'),
-                        team__in=form.data.getlist('team')).values('person')
-                parents = Relationship.objects.filter(person_from__in=students,
-                        relationship__in=parent_relationships)
-                parents_map = dict(parents.values_list('person_to', 'person_from'))
-                results |= Person.objects.batch_select('phones').filter(
-                        id__in=parents_map.keys())
+            audience = Audience(who, status, teams, parents=include_parents)
+            phones = Batch('phones').values_list('phone', 'ext', 'location')\
+                    .cache()
+            results = audience.people(Person.objects.batch_select(phones,
+                    memberships=Batch('personteam_set', status__in=status,
+                                      team__in=teams)))
 
-            # Uniquify and get related info to avoid additional queries
-            results = results.distinct()
+            if include_parents:
+                parents_map = audience.parent_links()
+                parent_memberships = {}
+                for x in PersonTeam.objects.filter(
+                        person__in=parents_map.values(),
+                        status__in=status, team__in=teams):
+                    parent_memberships.setdefault(x.person_id, []).append(x)
 
             final_results = []
             for result in results:
@@ -211,24 +187,24 @@ def phone_list(request):
 
                 roles = [""]*len(teams)
                 if include_parents and result.id in parents_map:
-                    for x in PersonTeam.objects.filter(person__id=parents_map[result.id],
-                            status__in=status, team__in=teams):
-                        roles[team_index[x.team.id]] = "%sParent" % \
+                    for x in parent_memberships.get(parents_map[result.id], []):
+                        roles[team_index[x.team_id]] = "%sParent" % \
                             (x.status == 'Prospective' and "Prospective " or "",)
 
-                for x in PersonTeam.objects.filter(person=result,
-                        status__in=status, team__in=teams):
-                    roles[team_index[x.team.id]] = "%s%s" % \
+                for x in result.memberships:
+                    roles[team_index[x.team_id]] = "%s%s" % \
                          (x.status == 'Prospective' and "Prospective " or "",
                           x.role)
 
                 cell = ""
                 home = ""
-                for phone in result.phones_all:
-                    if phone.location == 'Mobile':
-                        cell = phone.render_normal()
-                    elif phone.location == 'Home':
-                        home = phone.render_normal()
+                for number, ext, location in result.phones_all:
+                    if ext:
+                        number = "%s x%s" % (number, ext)
+                    if location == 'Mobile':
+                        cell = number
+                    elif location == 'Home':
+                        home = number
                 final_results.append(dict(name=name, roles=roles, cell=cell,
                                           home=home))
 
@@ -250,21 +226,10 @@ def tshirt_list(request):
             include_parents = 'Parent' in who
             who.discard('Parent')
 
-            people = PersonTeam.objects.filter(role__in=who,
-                    status__in=form.data.getlist('status'),
-                    team__in=form.data.getlist('team')).values('person')
-
-            results = Person.objects.filter(id__in=people)
-
             # Follow relationship to parents from students if enabled.
-            if include_parents:
-                parent_relationships = RelationshipType.objects.filter(parent=True).values('id')
-                students = PersonTeam.objects.filter(role='Student',
-                        status__in=form.data.getlist('status'),
-                        team__in=form.data.getlist('team')).values('person')
-                parents = Relationship.objects.filter(person_from__in=students,
-                        relationship__in=parent_relationships).values('person_to')
-                results |= Person.objects.filter(id__in=parents)
+            results = Audience(who, form.data.getlist('status'),
+                               form.data.getlist('team'),
+                               parents=include_parents).people()
 
             totals_dict = {}
             for tot in results.values('shirt_size').annotate(Count('shirt_size')).order_by():
@@ -286,6 +251,19 @@ def tshirt_list(request):
     return render_to_response("roster/tshirt_list.html", locals(),
                               context_instance=RequestContext(request))
 
+def hours_list_results(audience, from_date=None, to_date=None):
+    """The audience with their total hours (of time clocked in between
+    from_date and to_date, if given), most hours first."""
+    results = audience.people()
+    if from_date and to_date:
+        results = results.filter(timerecord__clock_in__range=(from_date, to_date))
+    elif from_date:
+        results = results.filter(timerecord__clock_in__gt=from_date)
+    elif to_date:
+        results = results.filter(timerecord__clock_in__lt=to_date)
+    return results.annotate(total_hours=Sum('timerecord__hours'))\
+                  .order_by('-total_hours')
+
 @login_required(login_url='/roster/login/')
 def hours_list(request):
     """Team hours list."""
@@ -295,22 +273,11 @@ def hours_list(request):
         if form.is_valid():
             who = set(form.data.getlist('who'))
 
-            people = PersonTeam.objects.filter(role__in=who,
-                    status='Active',
-                    team__in=form.data.getlist('team')).values('person')
-
-            results = Person.objects.filter(id__in=people)
-
             from_date = form.cleaned_data.get('from_date', None)
             to_date = form.cleaned_data.get('to_date', None)
-            if from_date and to_date:
-                results = results.filter(timerecord__clock_in__range=(from_date, to_date))
-            elif from_date:
-                results = results.filter(timerecord__clock_in__gt=from_date)
-            elif to_date:
-                results = results.filter(timerecord__clock_in__lt=to_date)
-
-            results = results.annotate(total_hours=Sum('timerecord__hours')).order_by('-total_hours')
+            results = hours_list_results(
+                    Audience(who, ['Active'], form.data.getlist('team')),
+                    from_date, to_date)
 
             total = sum((x.total_hours or 0.0) for x in results)
             show_hours = 'include_hours' in form.data
@@ -373,6 +340,8 @@ def class_team_list(request):
                         .filter(person__in=results.values('id'))\
                         .values('person')
                 results = results.exclude(id__in=exclude_people)
+
+            results = results.batch_select(active_personteams=ACTIVE_ROLES)
     else:
         form = ClassTeamListForm()
 
@@ -380,347 +349,6 @@ def class_team_list(request):
                               context_instance=RequestContext(request))
 
 
-class Checkbox(Flowable):
-    """A checkbox flowable."""
-    def __init__(self, checked, size=0.25*inch, color=colors.black):
-        self.checked = checked
-        self.size = size
-
-    def wrap(self, *args):
-        return (0, self.size)
-
-    def draw(self):
-        canvas = self.canv
-        canvas.setLineWidth(1)
-        canvas.setStrokeColor(self.color)
-        canvas.rect(0, 0, self.size, self.size)
-        if self.checked:
-            canvas.line(0, 0, self.size, self.size)
-            canvas.line(0, self.size, self.size, 0)
-
-class StartPerson(ActionFlowable):
-    def __init__(self, id, firstname, lastname, suffix, adult, team):
-        ActionFlowable.__init__(self, ('startPerson', id, firstname,
-            lastname, suffix, adult, team))
-
-class RegVerifyDocTemplate(BaseDocTemplate):
-    _invalidInitArgs = ('pageTemplates')
-
-    def afterInit(self):
-        self.name = None
-        self.id = None
-        self.team = None
-        self.adult = False
-
-        frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id='normal')
-        self.addPageTemplates([PageTemplate(id='First',frames=frame,onPageEnd=self.afterFirstPage,pagesize=self.pagesize),
-                               PageTemplate(id='Later',frames=frame,onPageEnd=self.afterNextPage,pagesize=self.pagesize)])
-
-    def afterFirstPage(self, canv, self2):
-        #self.pageTemplate = self.pageTemplates[1]
-
-        # Name in upper left corner
-        canv.setFont("Calibri-Bold", 14)
-        canv.setFillColor(colors.black)
-        canv.drawString(0.5*inch, self.pagesize[1]-0.5*inch, self.name)
-
-        # Box with first letter of last name in upper right corner
-        # Color it based on adult
-        wh = 0.375*inch
-        c = (self.pagesize[0]-0.75*inch, self.pagesize[1]-0.5*inch)
-        canv.setFillColor(self.adult and team_color2 or team_color1)
-        canv.rect(c[0]-wh/2, c[1]-wh/2,
-                  wh, wh, fill=1, stroke=0)
-
-        lsize = 30
-        canv.setFillColor(colors.black)
-        canv.setFont("Calibri-Bold", lsize)
-        canv.drawCentredString(c[0], c[1]-lsize/2/1.4, self.name[0].upper())
-
-        # Admin fields
-        canv.setStrokeColor(colors.black)
-        canv.setFillColor(colors.black)
-        canv.setLineWidth(1)
-        title = "Administration Only"
-        title_width = canv.stringWidth(title, "Calibri-Italic", 8)
-        canv.line(0.5*inch, 0.7*inch,
-                  self.pagesize[0]/2-title_width/2, 0.7*inch)
-        canv.line(self.pagesize[0]/2+title_width/2, 0.7*inch,
-                  self.pagesize[0]-0.5*inch, 0.7*inch)
-        #canv.line(0.5*inch, 0.7*inch, self.pagesize[0]-0.5*inch, 0.7*inch)
-        canv.setFont("Calibri-Italic", 8)
-        canv.drawCentredString(self.pagesize[0]/2, 0.675*inch, title)
-        canv.setFont("Calibri", 8)
-        canv.setLineWidth(0.5)
-        for r, c, sw, vw, s, v in \
-                [(0, 0, 0.75, 0.5, "Id:", "%d" % self.id),
-                 (1, 0, 0.75, 0.5, "Printed On:",
-                  self.today.strftime("%b %-d, %Y")),
-                 (0, 1, 0.75, 0.5, "Cash/Check #", None),
-                 (1, 1, 0.75, 0.5, "Amount:", None),
-                 (0, 2, 0.75, 0.5, "Team:", self.team),
-                 (1, 2, 0.75, 0.5, "Paid Date:", None),
-                 (0, 3, 1, 0.25, "Release Form:", None),
-                 (1, 3, 1, 0.25, "Student Contract:", None)]:
-            x = 0.5*inch + c*2*inch
-            y = 0.5*inch - r*0.125*inch
-            canv.drawString(x, y, s)
-            if v is None:
-                canv.line(x+sw*inch, y, x+(sw+vw)*inch, y)
-            else:
-                canv.drawString(x+sw*inch, y, v)
-
-    def afterNextPage(self, canv, self2):
-        pass
-
-    def handle_startPerson(self, id, firstname, lastname, suffix, adult,
-                           team):
-        #self.pageTemplate = self.pageTemplates[0]
-        self.name = "%s, %s %s" % (lastname, firstname, suffix)
-        self.id = id
-        self.adult = adult
-        self.team = team
-
-def person_to_pdf(elements, person, title, adult=False, parent=None,
-                  contact=None):
-    base_style = [
-        # default font and text color for table
-        ('FONT', (0,0), (-1,-1), 'Calibri', 8),
-        ('TEXTCOLOR', (0,0), (-1,-1), colors.black),
-        # default to top alignment for table
-        ('VALIGN', (0,0), (-1,-1), 'TOP'),
-        # reduce padding for table
-        ('TOPPADDING', (0,0), (-1,-1), 2),
-        ('BOTTOMPADDING', (0,0), (-1,-1), 2),
-        # bold first column
-        ('FONT', (0,0), (0,-1), 'Calibri-Bold', 8),
-        # set up header row
-        ('BACKGROUND', (0,0), (-1,0), team_color1),
-        ('TEXTCOLOR', (0,0), (-1,0), colors.white),
-        ('SPAN', (0,0), (-1,0)),
-        # lines around the table, between each row, and between cols 2 and 3
-        ('BOX', (0,0), (-1,-1), 1, colors.black),
-        ('LINEBELOW', (0,0), (-1,-1), 1, colors.black),
-        ('LINEAFTER', (1,1), (1,-1), 1, colors.black),
-        ]
-    if person:
-        empty_person = False
-        def highlight(style, data):
-            style.add('BACKGROUND', (2,len(data)), (2,len(data)), colors.yellow)
-    else:
-        empty_person = True
-        def highlight(style, data):
-            pass
-        person = Person()
-
-    data = []
-    style = TableStyle(base_style)
-
-    # Basic information
-    data.append((title, "", ""))
-    data.append(((parent or contact) and "Name" or "Legal Name",
-        "First and Last",
-        "%s %s %s" % (person.firstname, person.lastname, person.suffix)))
-    if isinstance(contact, Relationship):
-        style.add('SPAN', (0,len(data)-1), (0,len(data)))
-        data.append(("", "Relationship", contact.relationship))
-    elif contact or (parent and not isinstance(parent, Relationship)):
-        style.add('SPAN', (0,len(data)-1), (0,len(data)))
-        data.append(("", "Relationship", ""))
-
-    if not parent and not contact:
-        data.append(("Nickname", "", person.nickname))
-        if not person.gender or person.gender == 'U':
-            highlight(style, data)
-        data.append(("Gender", "", person.get_gender_display()))
-        if not person.birth_month or not person.birth_day or person.birth_year is not None and (person.birth_year > 2050 or person.birth_year < 1900):
-            highlight(style, data)
-        data.append(("Date of Birth", "m/d/yyyy", not empty_person and
-            "%s / %s / %s" % (person.birth_month, person.birth_day, person.birth_year) or ""))
-
-    # - School
-    if not adult:
-        if not person.school:
-            highlight(style, data)
-        data.append(("School", "", person.school))
-        if not person.grad_year:
-            highlight(style, data)
-        data.append(("HS Graduation Year", "", person.grad_year))
-
-    if not contact:
-        # - Company
-        if adult and not person.company:
-            highlight(style, data)
-        data.append(("Company", "", person.company))
-
-        # - Shirt Size
-        if not parent:
-            if not person.shirt_size:
-                highlight(style, data)
-            data.append(("Shirt Size", "", person.shirt_size))
-
-        # Parent specific info
-        #if isinstance(parent, Relationship):
-        #    data.append(("Emergency Contact", "",
-        #        parent.emergency_contact and "Yes" or "No"))
-        #elif parent:
-        #    data.append(("Emergency Contact", "", "Yes / No"))
-
-        # Emails
-        emails = PersonEmail.objects.filter(person=person)
-        start = len(data)
-        first = "Email"
-        for email in emails:
-            data.append((first, email.email.location, "%s%s" %
-                (email.email.email, email.primary and " (primary)" or "")))
-            first = ""
-        if not emails:
-            data.append((first, "Address", ""))
-            first = ""
-        # - Parent specific info
-        if isinstance(parent, Relationship):
-            data.append((first, "CC on Student Emails",
-                parent.cc_on_email and "Yes" or "No"))
-            first = ""
-        elif parent:
-            data.append((first, "CC on Student Emails", "Yes / No"))
-            first = ""
-        if len(data)-1 > start:
-            style.add('SPAN', (0,start), (0,len(data)-1))
-
-    # Phones
-    phones = PersonPhone.objects.filter(person=person)
-    wanted_phone_locations = set([u'Cell', u'Home', u'Work'])
-    start = len(data)
-    first = "Phone"
-    for phone in phones:
-        location = phone.phone.get_location_display()
-        wanted_phone_locations.discard(location)
-        data.append((first, location, "%s%s" %
-            (phone.phone.render_normal(),
-             phone.primary and " (primary)" or "")))
-        first = ""
-    for location in sorted(wanted_phone_locations):
-        #highlight(style, data)
-        data.append((first, location, ""))
-        first = ""
-    if len(data)-1 > start:
-        style.add('SPAN', (0,start), (0,len(data)-1))
-
-    if not contact:
-        # Addresses
-        addresses = not empty_person and person.addresses.all() or []
-        for address in addresses:
-            style.add('SPAN', (0,len(data)), (0,len(data)+2))
-            data.append(("Address", "Line 1", address.line1))
-            data.append(("", "Line 2", address.line2))
-            data.append(("", "City, State, Zip", "%s, %s %s" %
-                (address.city, address.state, address.zipcode)))
-        if not addresses:
-            style.add('SPAN', (0,len(data)), (0,len(data)+2))
-            highlight(style, data)
-            data.append(("Address", "Line 1", ""))
-            highlight(style, data)
-            data.append(("", "Line 2", ""))
-            highlight(style, data)
-            data.append(("", "City, State, Zip", ""))
-
-        # Medical
-        if not parent:
-            style.add('SPAN', (0,len(data)), (0,len(data)+1))
-            #if not person.medical:
-            #    highlight(style, data)
-            data.append(("Medical", "Conditions/Allergies", person.medical))
-            #if not person.medications:
-            #    highlight(style, data)
-            data.append(("", "Medications", person.medications))
-
-    elements.append(Table(data, colWidths=(0.75*inch, 1.25*inch, 5*inch),
-                    style=style))
-
-def make_reg_verify_pdf(response, people):
-    from datetime import date
-    today = date.today()
-
-    doc = RegVerifyDocTemplate(response,
-            pagesize=letter,
-            allowSplitting=0,
-            leftMargin=0.5*inch,
-            rightMargin=0.5*inch,
-            topMargin=0.75*inch,
-            bottomMargin=0.75*inch,
-            title="Team Registration Verification",
-            author="Beach Cities Robotics")
-    doc.today = today
-
-    # container for the 'Flowable' objects
-    elements = []
-
-    styles = getSampleStyleSheet()
-    normal_para_style = styles['Normal']
-
-    parent_relationships = RelationshipType.objects.filter(parent=True).values_list('id', flat=True)
-
-    for person in people:
-        adult = person.company or \
-                (person.birth_year and person.birth_year > 1900 and
-                 (today.year - person.birth_year) > 20)
-        team = None
-        pts = PersonTeam.objects.filter(person=person, status='Active')
-        if pts:
-            team = "%s" % pts[0].team
-        elements.append(StartPerson(person.id, person.firstname,
-                                    person.lastname, person.suffix, adult,
-                                    team))
-        person_to_pdf(elements, person,
-                "%s Information" % (adult and "Mentor" or "Student"),
-                adult=adult)
-        elements.append(Paragraph("", normal_para_style))
-
-        parents = []
-        if not adult:
-            # Parents
-            parents = Relationship.objects.filter(
-                    person_from=person,
-                    legal_guardian=True) \
-                            .select_related('person_to')
-            extra_parents = [1, 2]
-            for parent in parents:
-                person_to_pdf(elements, parent.person_to,
-                    "%s's Information" % parent.relationship,
-                    adult=True,
-                    parent=parent)
-                elements.append(Paragraph("", normal_para_style))
-            for parent in extra_parents[len(parents):]:
-                person_to_pdf(elements, None,
-                    "Legal Guardian %d Information" % parent,
-                    adult=True,
-                    parent=True)
-                elements.append(Paragraph("", normal_para_style))
-            parents = parents.values('id')
-
-        # Emergency Contacts
-        if adult:
-            contacts = Relationship.objects.filter(
-                    person_from=person, emergency_contact=True) \
-                    .exclude(id__in=parents) \
-                    .select_related('person_to')
-            for contact in contacts:
-                person_to_pdf(elements, contact.person_to,
-                    "Emergency Contact Information",
-                    adult=True,
-                    contact=contact)
-                elements.append(Paragraph("", normal_para_style))
-            if not contacts:
-                person_to_pdf(elements, None,
-                    "Emergency Contact Information",
-                    adult=True,
-                    contact=True)
-        elements.append(PageBreak())
-
-    # Generate the document
-    doc.build(elements)
-
 @login_required(login_url='/roster/login/')
 def team_reg_verify(request):
     """Team registration verification."""
@@ -737,21 +365,30 @@ def team_reg_verify(request):
     # configure PDF output
     response = HttpResponse(mimetype='application/pdf')
     response['Content-Disposition'] = 'attachment; filename=TeamRegVerify.pdf'
-    people = PersonTeam.objects.filter(
-            role__in=form.data.getlist('who'),
-            status='Active',
-            team__in=form.data.getlist('team')).values('person')
-
-    people = Person.objects.filter(id__in=people)
+    people = Audience(form.data.getlist('who'), ['Active'],
+                      form.data.getlist('team')).people(
+            Person.objects.batch_select(Batch('addresses').prefetch()))
+    from roster.pdf import make_reg_verify_pdf
     make_reg_verify_pdf(response, people)
     return response
 
+@login_required(login_url='/roster/login/')
+def person_search(request):
+    """People whose names start with the words of the q parameter, as
+    JSON for autocompletion: a list of {id, label, value}."""
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        limit = 10
+    results = [dict(id=id, label=name, value=name) for id, name in
+               search_people(request.GET.get('q', request.GET.get('term', '')),
+                             limit)]
+    return HttpResponse(json.dumps(results), mimetype='application/json')
+
 @login_required(login_url='/roster/login/')
 def signin_person_list(request):
     """Basic easy to parse list of people for signin application."""
 
-    parent_relationships = RelationshipType.objects.filter(parent=True).values_list('id', flat=True)
-
     people = PersonTeam.objects.filter(status='Active').values('person')
     results = Person.objects.all()#filter(id__in=people)
     #results = results.distinct()
@@ -763,7 +400,7 @@ def signin_person_list(request):
     writer.writerow(['id', 'name', 'student', 'photo', 'photo size', 'badge'])
     for person in results:
         name = person.render_normal()
-        student = person.is_student(parent_relationships)
+        student = person.student
 
         # Default to adult if we can't figure out if this is a student or not.
         if student is None:
@@ -816,205 +453,6 @@ def time_record_bulk_add(request):
 
     return HttpResponse(str(ok)+"\n"+"\n".join(errs), content_type="text/plain")
 
-class Badge(Flowable):
-    """A badge flowable."""
-    # badge dimensions
-    width = 2.25*inch
-    height = 3.5*inch
-
-    # border thickness
-    border_size = 0.125*inch
-
-    # logo location and size
-    logo = 0
-    logo_width = 0.5*inch
-    logo_height = 0.75*inch
-    logo_x = width - logo_width - 0.125*inch
-    logo_y = height - logo_height - 0.125*inch
-
-    # team name location and size
-    team_font = 'Calibri-Bold'
-    team_fontsize = 18
-    team_x = width / 2.0
-    team_y = (1/16.0)*inch
-    team_name = "Beach Cities Robotics"
-
-    # photo location and size
-    photo_width = 1.25*inch
-    photo_height = 1.5*inch
-    photo_x = (1/16.0)*inch
-    photo_y = height - photo_height - (3/16.0)*inch
-    photo_corner = 0.125*inch  # rounded corner radius
-
-    # name location and size
-    fullname_font = 'Calibri'
-    fullname_fontsize = 10
-    fullname_x = 0.125*inch
-    fullname_y = photo_y - 0.125*inch
-    firstname_font = 'Calibri-Bold'
-    firstname_fontsize = 24
-    firstname_x = 0.125*inch
-    firstname_y = fullname_y - 0.3*inch
-
-    # position location and size
-    position_font = 'Calibri'
-    position_fontsize = 14
-    position_x = 0.125*inch
-    position_y = 1*inch
-    position_width = width - position_x - 0.125*inch
-    position_height = 0.5*inch
-
-    # id font
-    id_font = 'Calibri'
-    id_fontsize = 8
-
-    # barcode location and size
-    barcode_x = 0
-    barcode_y = 0.375*inch
-
-    def __init__(self, person, student):
-        self.styles = getSampleStyleSheet()
-        self.person = person
-        self.student = student
-
-    def wrap(self, *args):
-        return (0, self.height)
-
-    def draw(self):
-        canvas = self.canv
-        canvas.saveState()
-        canvas.setLineWidth(1)
-        canvas.setStrokeColor(colors.black)
-        canvas.setFillColor(colors.black)
-
-        # clip to badge boundary
-        p = canvas.beginPath()
-        p.rect(0, 0, self.width, self.height)
-        canvas.clipPath(p)
-
-        # Badge outline / background
-        canvas.saveState()
-        if self.student:
-            color1 = team_color2
-            color2 = team_color1
-        else:
-            color1 = team_color1
-            color2 = team_color2
-        canvas.radialGradient(0, 0,
-                math.sqrt(self.width*self.width+self.height*self.height),
-                [colors.white, color1], [0.10, 1])
-
-        canvas.setFillColor(color2)
-        canvas.rect(0, 0, self.width, 0.3*inch, stroke=0, fill=1)
-
-        canvas.drawPath(p)
-        canvas.restoreState()
-
-        # Team logo
-        if self.logo:
-            canvas.drawImage(os.path.join(MEDIA_ROOT, "logo.jpeg"),
-                    self.logo_x, self.logo_y, self.logo_width, self.logo_height,
-                    preserveAspectRatio=True)
-
-        # Team name
-        canvas.saveState()
-        canvas.setFillColor(colors.black)
-        canvas.setFont(self.team_font, self.team_fontsize)
-        canvas.drawCentredString(self.team_x, self.team_y, self.team_name)
-        canvas.restoreState()
-
-        # Photo
-        if self.person.photo:
-            # round corners by using a clip path
-            canvas.saveState()
-            p = canvas.beginPath()
-            p.roundRect(self.photo_x, self.photo_y, self.photo_width,
-                    self.photo_height, self.photo_corner)
-            canvas.clipPath(p, stroke=0)
-
-            # load image
-            photopath = os.path.join(MEDIA_ROOT, self.person.photo.name)
-            img = ImageReader(photopath)
-
-            # scale/center image so it fills entire area
-            imgw, imgh = img.getSize()
-            newimgw, newimgh = imgw, imgh
-            rw = int(imgh * self.photo_width / self.photo_height)
-            if rw <= imgw:
-                newimgw = rw
-            else:
-                newimgh = int(imgw * self.photo_height / self.photo_width)
-            width = self.photo_width*((1.0*imgw)/newimgw)
-            height = self.photo_height*((1.0*imgh)/newimgh)
-            x = self.photo_x - (width-self.photo_width)/2.0
-            y = self.photo_y - (height-self.photo_height)/2.0
-
-            # draw image
-            canvas.drawImage(img, x, y, width, height)
-
-            # restore state (clip path)
-            canvas.restoreState()
-        else:
-            canvas.saveState()
-            canvas.setFillColor(colors.white)
-            canvas.roundRect(self.photo_x, self.photo_y, self.photo_width,
-                    self.photo_height, self.photo_corner, stroke=1, fill=1)
-            canvas.restoreState()
-
-        # Name
-        canvas.saveState()
-        fullname = "%s, %s %s" % (self.person.lastname, self.person.firstname, self.person.suffix)
-        canvas.setFont(self.fullname_font, self.fullname_fontsize)
-        canvas.drawString(self.fullname_x, self.fullname_y, fullname)
-        canvas.restoreState()
-
-        canvas.saveState()
-        canvas.setFont(self.firstname_font, self.firstname_fontsize)
-        canvas.drawString(self.firstname_x, self.firstname_y, self.person.get_firstname())
-        canvas.restoreState()
-
-        # Position
-        position = str(self.person.position)
-        if not position:
-            if self.student:
-                position = "Student"
-            else:
-                position = "Mentor"
-        t = '<font name="%s" size="%d">%s</font>' % \
-                (self.position_font, self.position_fontsize, escape(position))
-        p = Paragraph(t, style=self.styles['Normal'])
-        p.wrapOn(canvas, self.position_width, self.position_height)
-        p.drawOn(canvas, self.position_x, self.position_y)
-
-        # Barcode
-        idstr = "B%05d" % self.person.get_badge()
-        canvas.saveState()
-        barcode = code39.Standard39(idstr, humanReadable=0, checksum=1)
-        canvas.setFillColor(colors.black)
-        barcode.drawOn(canvas, self.barcode_x, self.barcode_y)
-        canvas.restoreState()
-
-        # ID
-        idstr = "%d" % self.person.get_badge()
-        canvas.saveState()
-        canvas.setFont(self.id_font, self.id_fontsize)
-        canvas.drawString(self.barcode_x + barcode.lquiet,
-                self.barcode_y + barcode.height + 3, idstr)
-        canvas.restoreState()
-
-        canvas.restoreState()
-
-class BadgesDocTemplate(BaseDocTemplate):
-    _invalidInitArgs = ('pageTemplates')
-
-    def afterInit(self):
-        width = 2.25*inch
-        left = self.leftMargin
-        frames = [Frame(self.leftMargin+width*x, self.bottomMargin, width,
-            self.height, leftPadding=0, bottomPadding=0, rightPadding=0,
-            topPadding=0) for x in range(4)]
-        self.addPageTemplates([PageTemplate(id='Page',frames=frames,pagesize=self.pagesize)])
-
 @login_required(login_url='/roster/login/')
 def badges(request):
     """Badge generation."""
@@ -1031,44 +469,16 @@ def badges(request):
                                       context_instance=RequestContext(request))
 
         # generate list of people
-        people = PersonTeam.objects.filter(
-                role__in=form.data.getlist('who'),
-                status='Active',
-                team__in=form.data.getlist('team')).values('person')
-        people = Person.objects.filter(id__in=people)
+        people = Audience(form.data.getlist('who'), ['Active'],
+                          form.data.getlist('team')).people()
         return render_to_response("roster/badges.html", locals(),
                                   context_instance=RequestContext(request))
 
     # configure PDF output
     response = HttpResponse(mimetype='application/pdf')
     response['Content-Disposition'] = 'attachment; filename=Badges.pdf'
-    doc = BadgesDocTemplate(response,
-            pagesize=landscape(letter),
-            allowSplitting=0,
-            leftMargin=1*inch,
-            rightMargin=1*inch,
-            topMargin=0.75*inch,
-            bottomMargin=0.5*inch,
-            title="Badges",
-            author="Beach Cities Robotics")
-
-    # container for the 'Flowable' objects
-    elements = []
-
-    styles = getSampleStyleSheet()
-    normal_para_style = styles['Normal']
-
-    parent_relationships = RelationshipType.objects.filter(parent=True).values_list('id', flat=True)
-
-    people = Person.objects.filter(id__in=[int(x) for x in ids])
-
-    for person in people:
-        student = person.is_student(parent_relationships)
-        elements.append(Badge(person, student))
-        elements.append(Paragraph("", normal_para_style))
-
-    # Generate the document
-    doc.build(elements)
+    from roster.pdf import make_badges_pdf
+    make_badges_pdf(response, Person.objects.filter(id__in=[int(x) for x in ids]))
     return response
 
 @login_required(login_url='/roster/login/')
@@ -1088,14 +498,15 @@ def new_year(request):
                                       context_instance=RequestContext(request))
 
         # generate list of people
-        pts = PersonTeam.objects.filter(
-                role__in=form.data.getlist('who'),
-                status='Active',
-                team__in=form.data.getlist('team')).select_related('person').order_by("person__lastname", "person__firstname")
+        pts = Audience(form.data.getlist('who'), ['Active'],
+                       form.data.getlist('team')).memberships()\
+                .select_related('person')\
+                .order_by("person__lastname", "person__firstname")
         return render_to_response("roster/new_year.html", locals(),
                                   context_instance=RequestContext(request))
 
-    pts = PersonTeam.objects.filter(id__in=[int(x) for x in ids])
+    pts = PersonTeam.objects.filter(id__in=[int(x) for x in ids])\
+            .select_related('person', 'team__program')
 
     actions = []
     with transaction.commit_on_success():
@@ -1235,7 +646,7 @@ class RegistrationWizard(SessionWizardView):
                 if pp.primary:
                     newdata["primary"] = pp.phone.location
         elif step == 'guardian1' or step == 'guardian2':
-            guardians = Relationship.objects.filter(person_from=person, legal_guardian=True).order_by('id')
+            guardians = get_relationships(person.id, 'legal_guardian')
             n = int(step[-1:]) - 1
             newdata["guardian"] = Person()
             if len(guardians) > n:
@@ -1251,7 +662,7 @@ class RegistrationWizard(SessionWizardView):
             elif person.id and step == 'guardian2':
                 newdata["only_one_guardian"] = True
         elif step == 'emergency':
-            guardians = Relationship.objects.filter(person_from=person, emergency_contact=True).order_by('id')
+            guardians = get_relationships(person.id, 'emergency_contact')
             newdata["guardian"] = Person()
             if len(guardians) > 0:
                 newdata["relationship"] = guardians[0].relationship
@@ -1301,7 +712,7 @@ class RegistrationWizard(SessionWizardView):
             if emails:
                 newdata["email"] = emails[0].email
             # guardian emails
-            guardians = Relationship.objects.filter(person_from=person, legal_guardian=True).order_by('id')
+            guardians = get_relationships(person.id, 'legal_guardian')
             for n in range(1, 3):
                 guardiandata = self.get_cleaned_data_for_step("guardian%d" % n) or {}
                 guardian = guardiandata.get("guardian")
@@ -1510,6 +921,7 @@ class RegistrationWizard(SessionWizardView):
         response = HttpResponse(mimetype='application/pdf')
         response['Content-Disposition'] = \
                 'attachment; filename=RegVerify%d.pdf' % person.id
+        from roster.pdf import make_reg_verify_pdf
         make_reg_verify_pdf(response, [person])
         return response
 